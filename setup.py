@@ -4,6 +4,9 @@ from setuptools import find_namespace_packages
 
 entry_points = {
     'console_scripts': [
+        'nti-intid-benchmark = nti.intid.benchmark:main',
+        'nti-intid-check = nti.intid.check:main',
+        'nti-intid-deferred = nti.intid.deferred:main',
     ],
 }
 
@@ -13,6 +16,7 @@ TESTS_REQUIRE = [
     'nti.site',
     'nti.testing',
     'persistent',
+    'pyperf',
     'transaction',
     'zope.dottedname',
     'zope.site',
@@ -62,9 +66,12 @@ setup(
     install_requires=[
         'Acquisition',
         'BTrees',
+        'ZODB',
         'nti.externalization',
         'nti.ntiids',
         'nti.wref',
+        'persistent',
+        'transaction',
         'zc.intid',
         'zope.component',
         'zope.deferredimport',
@@ -78,6 +85,9 @@ setup(
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'benchmark': [
+            'pyperf',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
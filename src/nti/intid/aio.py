@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Looking up objects by id from :mod:`asyncio` code.
+
+Loading objects from ZODB blocks, so calling a weak reference or
+:meth:`~nti.intid.utility.IntIds.getObject` from a coroutine stalls
+the event loop for as long as the storage takes to answer.
+:class:`AsyncIntIds` does the lookups in a bounded pool of threads
+instead. Each thread has its own connection to the database, which
+it keeps between lookups, so its pickle cache stays warm::
+
+    lookups = AsyncIntIds(db, 'path/to/site')
+    titles = await lookups.get_objects(ids, lambda ob: ob.title)
+    titles = await lookups.resolve(weak_refs, lambda ob: ob.title)
+
+Large requests are split into batches, which are looked up in order
+of id. Each call runs only a limited number of batches at once, so
+that one large request does not hold every thread while others wait.
+
+The objects themselves never leave the worker threads: they belong
+to a connection that only its thread may use, and touching them (or
+any persistent object they refer to) from the event loop could load
+them through that connection while the thread is using it, and would
+block the loop. Instead, each lookup takes a function, which is
+called on each object in the worker thread, after the objects of the
+batch have been loaded; its results are returned. They must not be,
+or refer to, persistent objects.
+
+This module requires :mod:`ZODB`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+
+from nti.intid.parallel import find_intids
+
+__all__ = [
+    'AsyncIntIds',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _activate(obs):
+    """
+    Load the ghosts among *obs*, prefetching them from their
+    connections in bulk where possible.
+    """
+    # id(jar) -> [ghost, ...]
+    ghosts = {}
+    for ob in obs:
+        if ob is not None and getattr(ob, '_p_changed', 0) is None:
+            ghosts.setdefault(id(ob._p_jar), []).append(ob)
+    for jar_obs in ghosts.values():
+        prefetch = getattr(jar_obs[0]._p_jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(jar_obs)
+        for ob in jar_obs:
+            ob._p_activate()
+
+
+def _get_objects(intids, ids):
+    return [intids.queryObject(uid) for uid in ids]
+
+
+def _resolve(intids, refs):
+    # Don't fill the caches of the refs: they are used by the
+    # caller's thread, and the objects belong to this one.
+    # pylint:disable=protected-access
+    return [ref._check_and_cache(intids.queryObject(ref._entity_id), False)
+            for ref in refs]
+
+
+class AsyncIntIds(object):
+    """
+    Look up objects in the intid utility found at *path* (see
+    :func:`nti.intid.parallel.find_intids`) of the database *db*,
+    without blocking the event loop.
+
+    :keyword int max_workers: How many threads, and so connections,
+        to use.
+    :keyword int max_concurrency: How many batches each call may
+        have waiting for, or running in, the threads at once.
+        Defaults to *max_workers*.
+    :keyword int batch_size: How many objects each thread looks up
+        at a time.
+    """
+
+    def __init__(self, db, path='', max_workers=4, max_concurrency=None, batch_size=500):
+        # pylint:disable=too-many-arguments
+        if batch_size < 1:
+            raise ValueError("Batch size must be positive", batch_size)
+        self.db = db
+        self.path = path
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency or max_workers
+        self._executor = ThreadPoolExecutor(max_workers,
+                                            thread_name_prefix='nti.intid.aio')
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self.db.open(transaction.TransactionManager())
+            self._local.connection = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run(self, lookup, items, func):
+        """
+        Run in a worker thread.
+        """
+        txm = self._connection().transaction_manager
+        # Start a new transaction to see what has been committed
+        # since the last batch.
+        txm.begin()
+        try:
+            intids = find_intids(self._connection().root(), self.path)
+            obs = lookup(intids, items)
+            _activate(obs)
+            return [func(ob) if ob is not None else None for ob in obs]
+        finally:
+            txm.abort()
+
+    async def _lookup(self, lookup, items, key, func):
+        items = list(items)
+        # Look up in order of id, so the BTree buckets are visited
+        # in a single ordered pass.
+        order = sorted(range(len(items)), key=lambda i: key(items[i]))
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def batch(indexes):
+            async with semaphore:
+                return await loop.run_in_executor(self._executor, self._run, lookup,
+                                                  [items[i] for i in indexes], func)
+
+        batches = [order[i:i + self.batch_size]
+                   for i in range(0, len(order), self.batch_size)]
+        batch_results = await asyncio.gather(*[batch(indexes) for indexes in batches])
+        results = [None] * len(items)
+        for indexes, batch_result in zip(batches, batch_results):
+            for i, result in zip(indexes, batch_result):
+                results[i] = result
+        return results
+
+    async def get_objects(self, ids, func):
+        """
+        Return a list of the results of calling *func*, in a worker
+        thread, on each of the objects registered with *ids*, in the
+        same order, with ``None`` for ids that are not registered.
+        """
+        return await self._lookup(_get_objects, ids, lambda uid: uid, func)
+
+    async def resolve(self, refs, func):
+        """
+        Return a list of the results of calling *func*, in a worker
+        thread, on each of the objects that the weak references *refs*
+        refer to, in the same order, with ``None`` for those that
+        have gone away, as calling them would. Their caches are
+        neither used nor filled.
+        """
+        # pylint:disable=protected-access
+        return await self._lookup(_resolve, refs, lambda ref: ref._entity_id, func)
+
+    def close(self):
+        """
+        Wait for the lookups in progress, then stop the threads and
+        close their connections. This blocks.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.transaction_manager.abort()
+            conn.close()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the intid utility and the weak references.
+
+Run them with the ``nti-intid-benchmark`` script, which requires
+:mod:`pyperf` (install the ``benchmark`` extra)::
+
+    nti-intid-benchmark --sizes 1000,100000 -o results.json
+    python -m pyperf compare_to baseline.json results.json
+
+Every benchmark is run against a database holding each of the
+requested numbers of registered objects. By default these are kept
+in a :class:`~ZODB.MappingStorage.MappingStorage`, which must be
+filled again by every pyperf worker process. For the largest sizes,
+pass ``--storage PREFIX``: each size is then kept in a
+:class:`~ZODB.FileStorage.FileStorage` named ``PREFIX-<size>.fs``,
+which is filled once and reused by later runs.
+
+The benchmark functions take the number of loops and a
+:class:`Fixture` and return the elapsed time in seconds, as
+:meth:`pyperf.Runner.bench_time_func` expects; they can also be
+called directly.
+
+The time taken to import the package matters to pre-forking servers
+and task workers, which import it in every new process. It is
+measured separately, with ``python -X importtime``, by
+:func:`import_time`; ``nti-intid-benchmark --import-time`` prints it.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import pickle
+import random
+import subprocess
+
+from time import perf_counter
+
+import BTrees
+
+import transaction
+
+from Acquisition import Implicit
+from Acquisition import ImplicitAcquisitionWrapper
+
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from nti.intid.lookup import clear_cache
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+
+from nti.intid.wref import WeakRef
+from nti.intid.wref import ArbitraryOrderableWeakRef
+
+__all__ = [
+    'Fixture',
+    'BENCHMARKS',
+    'import_times',
+    'import_time',
+    'main',
+]
+
+#: How many objects are registered in each transaction while filling
+#: a database.
+FILL_BATCH_SIZE = 10000
+
+#: The default sizes of the database, in registered objects.
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+#: The modules whose import time :func:`main` reports.
+IMPORT_TIME_MODULES = ('nti.intid', 'nti.intid.utility', 'nti.intid.wref')
+
+
+class _Parent(Implicit):
+    pass
+
+
+class Fixture(object):
+    """
+    A database holding *size* registered objects, an open connection
+    to it, and a random *sample* of those objects, their ids and weak
+    references to them.
+
+    The utility is registered globally while the fixture is open, so
+    that the weak references can find it. Call :meth:`close` when
+    done.
+    """
+
+    def __init__(self, size, storage=None, sample=1000, seed=42):
+        self.size = size
+        self.db = DB(FileStorage(storage) if storage else MappingStorage())
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = self.db.open(self.transaction_manager)
+        root = self.connection.root()
+        if 'intids' not in root:
+            root['intids'] = IntIds('_ds_intid', family=BTrees.family64)
+            self.transaction_manager.commit()
+        self.intids = root['intids']
+        self._fill()
+
+        rnd = random.Random(seed)
+        ids = list(self.intids.refs.iterkeys())
+        self.ids = rnd.sample(ids, min(sample, len(ids)))
+        self.objects = [self.intids.getObject(uid) for uid in self.ids]
+        parent = _Parent()
+        self.wrapped = [ImplicitAcquisitionWrapper(ob, parent) for ob in self.objects]
+
+        component.getGlobalSiteManager().registerUtility(self.intids, IIntIds)
+        clear_cache()
+        self.refs = [ArbitraryOrderableWeakRef(ob) for ob in self.objects]
+
+    def _fill(self):
+        intids = self.intids
+        conn = self.connection
+        while len(intids) < self.size:
+            batch = min(FILL_BATCH_SIZE, self.size - len(intids))
+            obs = [Registered() for _ in range(batch)]
+            for ob in obs:
+                conn.add(ob)
+            intids.register_many(obs)
+            self.transaction_manager.commit()
+            conn.cacheMinimize()
+
+    def close(self):
+        component.getGlobalSiteManager().unregisterUtility(self.intids, IIntIds)
+        clear_cache()
+        self.transaction_manager.abort()
+        self.connection.close()
+        self.db.close()
+
+
+def _cycle(items, loops):
+    count = len(items)
+    return [items[i % count] for i in range(loops)]
+
+
+def bench_register(loops, fixture):
+    """
+    Register *loops* new objects.
+    """
+    obs = [Registered() for _ in range(loops)]
+    register = fixture.intids.register
+    start = perf_counter()
+    for ob in obs:
+        register(ob)
+    elapsed = perf_counter() - start
+    fixture.transaction_manager.abort()
+    return elapsed
+
+
+def bench_unregister(loops, fixture):
+    """
+    Unregister *loops* newly registered objects.
+    """
+    obs = [Registered() for _ in range(loops)]
+    for ob in obs:
+        fixture.intids.register(ob)
+    unregister = fixture.intids.unregister
+    start = perf_counter()
+    for ob in obs:
+        unregister(ob)
+    elapsed = perf_counter() - start
+    fixture.transaction_manager.abort()
+    return elapsed
+
+
+def _bench_id_lookup(loops, fixture, method, wrapped):
+    obs = _cycle(fixture.wrapped if wrapped else fixture.objects, loops)
+    lookup = getattr(fixture.intids, method)
+    start = perf_counter()
+    for ob in obs:
+        lookup(ob)
+    return perf_counter() - start
+
+
+def bench_getId(loops, fixture, wrapped=False):
+    """
+    Look up the ids of sample objects, optionally wrapped in
+    Acquisition wrappers.
+    """
+    return _bench_id_lookup(loops, fixture, 'getId', wrapped)
+
+
+def bench_queryId(loops, fixture, wrapped=False):
+    """
+    Like :func:`bench_getId`, using ``queryId``.
+    """
+    return _bench_id_lookup(loops, fixture, 'queryId', wrapped)
+
+
+def bench_getObject(loops, fixture):
+    """
+    Look up the objects of sample ids.
+    """
+    ids = _cycle(fixture.ids, loops)
+    getObject = fixture.intids.getObject
+    start = perf_counter()
+    for uid in ids:
+        getObject(uid)
+    return perf_counter() - start
+
+
+def bench_wref_construct(loops, fixture):
+    """
+    Create weak references to sample objects.
+    """
+    obs = _cycle(fixture.objects, loops)
+    start = perf_counter()
+    for ob in obs:
+        WeakRef(ob)
+    return perf_counter() - start
+
+
+def bench_wref_pickle(loops, fixture):
+    """
+    Pickle and unpickle weak references.
+    """
+    refs = _cycle(fixture.refs, loops)
+    dumps = pickle.dumps
+    loads = pickle.loads
+    start = perf_counter()
+    for ref in refs:
+        loads(dumps(ref))
+    return perf_counter() - start
+
+
+def bench_wref_dereference(loops, fixture, cached=True):
+    """
+    Call weak references, either allowing them to use their cache or
+    not.
+    """
+    refs = _cycle(fixture.refs, loops)
+    for ref in refs:
+        ref() # Fill the caches
+    start = perf_counter()
+    for ref in refs:
+        ref(cached)
+    return perf_counter() - start
+
+
+def bench_wref_sort(loops, fixture):
+    """
+    Sort the sample of :class:`~nti.intid.wref.ArbitraryOrderableWeakRef`
+    objects, *loops* times.
+    """
+    refs = list(fixture.refs)
+    random.Random(42).shuffle(refs)
+    start = perf_counter()
+    for _ in range(loops):
+        sorted(refs)
+    return perf_counter() - start
+
+
+#: ``(name, function, keyword arguments)`` for each benchmark.
+BENCHMARKS = (
+    ('register', bench_register, {}),
+    ('unregister', bench_unregister, {}),
+    ('getId', bench_getId, {}),
+    ('getId_acquisition', bench_getId, {'wrapped': True}),
+    ('queryId', bench_queryId, {}),
+    ('queryId_acquisition', bench_queryId, {'wrapped': True}),
+    ('getObject', bench_getObject, {}),
+    ('wref_construct', bench_wref_construct, {}),
+    ('wref_pickle', bench_wref_pickle, {}),
+    ('wref_dereference_cached', bench_wref_dereference, {'cached': True}),
+    ('wref_dereference_uncached', bench_wref_dereference, {'cached': False}),
+    ('wref_sort', bench_wref_sort, {}),
+)
+
+
+class _LazyFixtures(object):
+    # pyperf only runs each benchmark in some worker processes;
+    # don't fill a database in processes that won't use it.
+
+    def __init__(self, storage, sample):
+        self.storage = storage
+        self.sample = sample
+        self.fixtures = {}
+
+    def get(self, size):
+        try:
+            return self.fixtures[size]
+        except KeyError:
+            storage = '%s-%d.fs' % (self.storage, size) if self.storage else None
+            fixture = self.fixtures[size] = Fixture(size, storage, self.sample)
+            return fixture
+
+    def close(self):
+        for fixture in self.fixtures.values():
+            fixture.close()
+        self.fixtures.clear()
+
+
+def import_times(module):
+    """
+    Import *module* in a new interpreter with ``-X importtime``, and
+    return a dictionary mapping the name of each module imported as a
+    result to its cumulative import time in seconds.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    return _parse_import_times(proc.stderr)
+
+
+def _parse_import_times(output):
+    times = {}
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times[fields[2].strip()] = int(fields[1]) / 1e6
+        except ValueError:
+            # The header
+            continue
+    return times
+
+
+def import_time(module, runs=5):
+    """
+    Return the shortest of *runs* measurements of the cumulative time,
+    in seconds, to import *module* in a new interpreter.
+    """
+    return min(import_times(module)[module] for _ in range(runs))
+
+
+def _print_import_times():
+    for module in IMPORT_TIME_MODULES:
+        print('%-30s %8.1f ms' % (module, import_time(module) * 1000))
+
+
+def _run(loops, fixtures, size, func, kwargs):
+    return func(loops, fixtures.get(size), **kwargs)
+
+
+def _add_cmdline_args(cmd, args):
+    cmd.extend(('--sizes', args.sizes, '--sample', str(args.sample)))
+    if args.storage:
+        cmd.extend(('--storage', args.storage))
+
+
+def main(argv=None):
+    """
+    Run the benchmarks with :mod:`pyperf`. Accepts all of pyperf's
+    options, such as ``-o FILE`` to write the results as JSON.
+
+    With ``--import-time``, print the import times of
+    :data:`IMPORT_TIME_MODULES` instead.
+    """
+    import pyperf # pylint:disable=import-outside-toplevel
+    runner = pyperf.Runner(add_cmdline_args=_add_cmdline_args)
+    parser = runner.argparser
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help="Comma-separated numbers of registered objects.")
+    parser.add_argument('--sample', type=int, default=1000,
+                        help="How many objects to look up.")
+    parser.add_argument('--storage', default=None,
+                        help="Keep each database in a FileStorage named "
+                        "STORAGE-<size>.fs, reusing it if it exists.")
+    parser.add_argument('--import-time', action='store_true',
+                        help="Print the import times of the package's modules "
+                        "instead of running the benchmarks.")
+    args = runner.parse_args(argv)
+    if args.import_time:
+        _print_import_times()
+        return
+    fixtures = _LazyFixtures(args.storage, args.sample)
+    try:
+        for size in (int(s) for s in args.sizes.split(',')):
+            for name, func, kwargs in BENCHMARKS:
+                runner.bench_time_func('%s_%d' % (name, size),
+                                       _run, fixtures, size, func, kwargs)
+    finally:
+        fixtures.close()
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+An optional, process-local cache in front of
+:meth:`nti.intid.utility.IntIds.getObject` and
+:meth:`~nti.intid.utility.IntIds.queryObject`.
+
+Frequently used objects, such as users, may be looked up by intid
+many times in each request. Each lookup descends the ``refs`` BTree,
+possibly loading buckets. With the cache enabled (see
+:func:`enable`), a hit instead goes straight to the connection's
+pickle cache.
+
+The cache is shared by every connection in the process, so it stores
+the *OID* of each object, never the object itself. Its keys are
+``(database name, utility OID, intid)``.
+
+Only committed registrations are cached. The entries made by a
+transaction are added to the cache when it commits, and discarded if
+it aborts; a transaction that changes the registrations neither makes
+nor uses entries.
+
+The utility keeps two persistent counts: of the transactions that
+registered ids, and of the ids that have been unregistered or
+registered again (by any means, including
+:meth:`~nti.intid.utility.IntIds.force_unregister` and
+:meth:`~nti.intid.utility.IntIds.force_register`). Each entry records
+both counts as they were seen by the connection that made it. An
+entry is only used by a connection that sees the same count of
+removals, and at least as many registrations, so that a connection
+whose view of the database is older than the entry does not find
+ids registered after its view. Changes committed by other processes
+reach the counts as ordinary ZODB invalidations; entries are also
+removed at once when this process unregisters an id. Checking an
+entry costs reading the counts, which are almost always in the
+pickle cache, rather than a descent of the ``refs`` BTree.
+
+Any removal makes every entry for the utility invalid, so the cache
+suits catalogs where lookups are far more frequent than removals.
+Counting registrations costs each registering transaction one more
+(conflict-free) object to store.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+from threading import Lock
+
+__all__ = [
+    'ObjectIdCache',
+    'enable',
+    'disable',
+    'get_cache',
+]
+
+
+class ObjectIdCache(object):
+    """
+    A thread-safe LRU mapping from keys to OIDs that keeps hit
+    and eviction counts.
+    """
+
+    def __init__(self, maxsize=10000):
+        if maxsize < 1:
+            raise ValueError("Size must be positive", maxsize)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Return the value stored for *key*, or ``None``. This is not
+        counted; the caller decides, perhaps after checking the
+        value, whether it was a hit (see :meth:`record`).
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def record(self, hit):
+        """
+        Count a hit, if *hit* is true, or a miss.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, key, value):
+        with self._lock:
+            data = self._data
+            data[key] = value
+            data.move_to_end(key)
+            while len(data) > self.maxsize:
+                data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Return a dictionary of the counters.
+        """
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hit_rate,
+        }
+
+    def __repr__(self):
+        return "<%s.%s %d/%d hit_rate=%.2f>" % (self.__class__.__module__,
+                                               self.__class__.__name__,
+                                               len(self), self.maxsize,
+                                               self.hit_rate)
+
+
+#: The cache in use, or ``None`` if caching is disabled (the default).
+object_cache = None
+
+
+def enable(maxsize=10000):
+    """
+    Start caching object lookups, in a new cache holding up to
+    *maxsize* entries. Return the cache.
+    """
+    global object_cache # pylint:disable=global-statement
+    object_cache = ObjectIdCache(maxsize)
+    return object_cache
+
+
+def disable():
+    """
+    Stop caching object lookups and discard the cache.
+    """
+    global object_cache # pylint:disable=global-statement
+    object_cache = None
+
+
+def get_cache():
+    """
+    Return the cache in use, or ``None``.
+    """
+    return object_cache
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(disable)
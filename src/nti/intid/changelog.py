@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A persistent log of the ids registered and unregistered.
+
+Indexers and caches outside the process need to find out which ids
+have been added or removed since they last looked, without
+subscribing to events in every writer or scanning the whole catalog.
+A :class:`ChangeLog`, kept by :class:`nti.intid.utility.IntIds` when
+enabled (see :meth:`~nti.intid.utility.IntIds.enable_changelog`),
+records every change. A consumer reads it with
+:meth:`ChangeLog.changes_since`, remembering the number of the last
+record it handled::
+
+    cursor = load_cursor()
+    for cursor, tid, op, uid in intids.changelog.changes_since(cursor):
+        if op == ADDED:
+            index(uid)
+        else:
+            unindex(uid)
+        save_cursor(cursor)
+
+The changes made in a transaction are collected in memory and
+written, as a single persistent batch, just before it commits, so
+aborted transactions (and rolled back savepoints) leave nothing
+behind and the batch's ``_p_serial`` is the id of the transaction
+that made the changes. Changes made by other before-commit hooks
+after the batch was written go in another batch; recording a change
+once the transaction has started committing its resources is an
+error.
+Records are numbered consecutively in the order their transactions
+committed, so a consumer never misses a change by remembering a
+number. Reading costs time proportional to the number of changes
+read, not to the size of the catalog.
+
+To keep the order, each batch is added after the last one: two
+transactions that both change the registrations conflict, and one
+of them must be retried. Enable the log only where that is
+acceptable.
+
+The log keeps at most about :attr:`ChangeLog.max_records` records;
+older batches are discarded (see :meth:`ChangeLog.compact`). A
+consumer that falls further behind gets a :exc:`ChangesCompacted`
+error and must rebuild from the catalog.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BTrees
+
+from persistent import Persistent
+
+import transaction
+
+from transaction.interfaces import IDataManagerSavepoint
+from transaction.interfaces import ISavepointDataManager
+
+from zope import interface
+
+__all__ = [
+    'ChangeLog',
+    'ChangesCompacted',
+    'ADDED',
+    'REMOVED',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The operation of a record for an id that was registered.
+ADDED = 'added'
+#: The operation of a record for an id that was unregistered.
+REMOVED = 'removed'
+
+
+class ChangesCompacted(ValueError):
+    """
+    Raised when the changes after a cursor have been discarded.
+    """
+
+
+class _ChangeBatch(Persistent):
+    """
+    The changes made by one transaction. Each is the id, for an
+    addition, or its bitwise inverse (so always negative), for a
+    removal.
+    """
+
+    def __init__(self, changes):
+        self.changes = tuple(changes)
+
+
+@interface.implementer(ISavepointDataManager)
+class _PendingChanges(object):
+    """
+    The changes to a :class:`ChangeLog` recorded in a transaction that
+    have not been written yet.
+
+    This joins the transaction only to follow its savepoints and
+    abort; the changes are written to the log, in the changelog's own
+    connection, by a before-commit hook.
+    """
+
+    committing = False
+    joined = False
+
+    def __init__(self, changelog, txn, transaction_manager):
+        self.changelog = changelog
+        self.transaction = txn
+        self.transaction_manager = transaction_manager
+        self.changes = []
+        # How many of the changes have been written.
+        self.written = 0
+        self.hooked = False
+
+    def record(self, change):
+        if self.committing:
+            raise ValueError("Transaction is already committing", change)
+        if not self.joined:
+            self.joined = True
+            self.transaction.join(self)
+        self.changes.append(change)
+        self._hook()
+
+    def _hook(self):
+        if not self.hooked:
+            self.hooked = True
+            self.transaction.addBeforeCommitHook(self._write)
+
+    def _write(self):
+        self.hooked = False
+        changes = self.changes
+        if len(changes) > self.written:
+            self.changelog._write(changes[self.written:]) # pylint:disable=protected-access
+            self.written = len(changes)
+
+    def rollback(self, length, written):
+        del self.changes[length:]
+        self.written = written
+        if length > written:
+            self._hook()
+
+    def savepoint(self):
+        return _PendingSavepoint(self, len(self.changes), self.written)
+
+    def abort(self, txn):
+        # Also used to roll back savepoints made before we joined,
+        # which leaves the transaction.
+        del self.changes[:]
+        self.written = 0
+        self.joined = False
+
+    def tpc_begin(self, txn):
+        self.committing = True
+        if len(self.changes) > self.written:
+            raise ValueError("Changes were recorded after the changelog was written",
+                             self.changes[self.written:])
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'nti.intid.changelog:%d' % id(self)
+
+
+@interface.implementer(IDataManagerSavepoint)
+class _PendingSavepoint(object):
+
+    def __init__(self, pending, length, written):
+        self.pending = pending
+        self.length = length
+        self.written = written
+
+    def rollback(self):
+        self.pending.rollback(self.length, self.written)
+
+
+class ChangeLog(Persistent):
+    """
+    The changes to the registrations of an intid utility, in batches
+    keyed by the number of their first record.
+    """
+
+    family = BTrees.family64
+
+    #: About how many records are kept. ``None`` to keep everything.
+    max_records = 1000000
+
+    def __init__(self, max_records=None):
+        if max_records is not None:
+            self.max_records = max_records
+        # number of first record -> _ChangeBatch
+        self._batches = self.family.IO.BTree()
+        #: The number the next record will get.
+        self.next_record = 1
+        #: The number of the oldest record kept.
+        self.first_record = 1
+
+    def record(self, op, uid):
+        """
+        Record that *uid* was added or removed (*op*) in the current
+        transaction.
+        """
+        jar = self._p_jar
+        txm = jar.transaction_manager if jar is not None else transaction.manager
+        txn = txm.get()
+        # The pending changes are kept by the transaction, not in a
+        # volatile attribute, which would be lost if this object
+        # were ghosted.
+        try:
+            pending = txn.data(self)
+        except KeyError:
+            pending = _PendingChanges(self, txn, txm)
+            txn.set_data(self, pending)
+        pending.record(uid if op == ADDED else ~uid)
+
+    def _write(self, changes):
+        self._batches[self.next_record] = _ChangeBatch(changes)
+        self.next_record += len(changes)
+        if self.max_records is not None:
+            self.compact(self.max_records)
+
+    def compact(self, keep):
+        """
+        Discard the oldest batches, keeping at least the last *keep*
+        records.
+        """
+        batches = self._batches
+        oldest = self.next_record - keep
+        while len(batches) > 1:
+            first = batches.minKey()
+            following = batches.minKey(first + 1)
+            if following > oldest:
+                break
+            del batches[first]
+            self.first_record = following
+
+    def changes_since(self, cursor=0):
+        """
+        Lazily iterate the records after the record numbered
+        *cursor* (0 for all of them), oldest first, as ``(number,
+        transaction id, operation, id)`` tuples.
+
+        :raises ChangesCompacted: If records after *cursor* have been
+            discarded.
+        """
+        if cursor + 1 < self.first_record:
+            raise ChangesCompacted(cursor, self.first_record)
+        batches = self._batches
+        try:
+            start = batches.maxKey(cursor + 1)
+        except ValueError:
+            start = None
+        for first, batch in batches.iteritems(start):
+            changes = batch.changes
+            # Now that it is loaded.
+            tid = batch._p_serial
+            for number, change in enumerate(changes, first):
+                if number <= cursor:
+                    continue
+                if change < 0:
+                    yield number, tid, REMOVED, ~change
+                else:
+                    yield number, tid, ADDED, change
+
+    def __len__(self):
+        """
+        The number of records kept.
+        """
+        return self.next_record - self.first_record
+
+    def __repr__(self):
+        return "<%s.%s records=%d-%d>" % (self.__class__.__module__,
+                                          self.__class__.__name__,
+                                          self.first_record, self.next_record - 1)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Finding and repairing inconsistencies in an intid catalog.
+
+Each entry of ``IntIds.refs`` is compared with the id the registered
+object carries (its id attribute or, for utilities that keep one, its
+entry in the reverse index). The problems found are:
+
+:data:`MISSING`
+    The object doesn't record any id. Repaired by recording the id
+    it is registered with.
+:data:`MISMATCH`
+    The object records a different id, which is not registered to
+    it. Repaired the same way.
+:data:`DUPLICATE`
+    The object is registered with more than one id; the one it
+    records is correct. Repaired by removing the other entry.
+:data:`BROKEN`
+    The object can't be loaded. Repaired by removing the entry.
+
+The catalog is walked with
+:func:`nti.intid.scan.iter_objects_chunked`, so memory use is bounded
+and, when repairing, each chunk is committed separately.
+:func:`check_intids_parallel` checks ranges of ids in separate
+processes with :mod:`nti.intid.parallel`; this requires a storage
+that several processes can open at once, such as ZEO or RelStorage.
+
+The ``nti-intid-check`` script runs these against a database
+described by a ZConfig file. This module requires :mod:`ZODB`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import json
+import argparse
+import functools
+
+from nti.intid.parallel import find_intids
+from nti.intid.parallel import scan_parallel
+
+from nti.intid.scan import ABORT
+from nti.intid.scan import COMMIT
+from nti.intid.scan import iter_objects_chunked
+
+__all__ = [
+    'Problem',
+    'CheckReport',
+    'check_intids',
+    'check_intids_parallel',
+    'find_intids',
+    'main',
+    'MISSING',
+    'MISMATCH',
+    'DUPLICATE',
+    'BROKEN',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The object records no id.
+MISSING = 'missing'
+#: The object records an id that is not registered to it.
+MISMATCH = 'mismatch'
+#: The object is also registered, correctly, with the id it records.
+DUPLICATE = 'duplicate'
+#: The object cannot be loaded.
+BROKEN = 'broken'
+
+
+class Problem(object):
+    """
+    An inconsistency found for the id *uid*. *recorded_id* is the id
+    the object records, if any.
+    """
+
+    def __init__(self, uid, kind, recorded_id=None, repaired=False):
+        self.uid = uid
+        self.kind = kind
+        self.recorded_id = recorded_id
+        self.repaired = repaired
+
+    def to_dict(self):
+        return {
+            'id': self.uid,
+            'kind': self.kind,
+            'recorded_id': self.recorded_id,
+            'repaired': self.repaired,
+        }
+
+    def __eq__(self, other):
+        try:
+            return self.to_dict() == other.to_dict()
+        except AttributeError: # pragma: no cover
+            return NotImplemented
+
+    def __repr__(self):
+        return "<%s.%s %s %s recorded=%s%s>" % (self.__class__.__module__,
+                                                self.__class__.__name__,
+                                                self.uid, self.kind,
+                                                self.recorded_id,
+                                                ' repaired' if self.repaired else '')
+
+
+class CheckReport(object):
+    """
+    The outcome of a check: how many ids were checked and the
+    problems found.
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.problems = []
+        #: ``(range, exception)`` pairs for ids that could not be checked.
+        self.failed = []
+
+    @property
+    def repaired(self):
+        return sum(1 for p in self.problems if p.repaired)
+
+    def to_dict(self):
+        return {
+            'checked': self.checked,
+            'repaired': self.repaired,
+            'problems': [p.to_dict() for p in self.problems],
+            'failed': [list(r) for r, _ in self.failed],
+        }
+
+    def __repr__(self):
+        return "<%s.%s checked=%d problems=%d repaired=%d>" % (
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.checked, len(self.problems), self.repaired
+        )
+
+
+def _recorded_id(intids, ob):
+    registered_id = getattr(intids, '_registered_id', None)
+    if registered_id is not None:
+        return registered_id(ob)
+    return getattr(ob, intids.attribute, None)
+
+
+def _diagnose(intids, uid, ob):
+    """
+    Return a :class:`Problem` for the entry *uid*, *ob*, or ``None``.
+    """
+    try:
+        recorded = _recorded_id(intids, ob)
+    except KeyError:
+        # Including POSKeyError
+        return Problem(uid, BROKEN)
+    if recorded == uid:
+        return None
+    if recorded is None:
+        return Problem(uid, MISSING)
+    if intids.refs.get(recorded) is ob:
+        return Problem(uid, DUPLICATE, recorded)
+    return Problem(uid, MISMATCH, recorded)
+
+
+def _repair(intids, problem, ob):
+    # pylint:disable=protected-access
+    uid = problem.uid
+    if problem.kind in (BROKEN, DUPLICATE):
+        intids.force_unregister(uid, remove_attribute=False)
+    elif getattr(intids, '_store_id', None) is not None:
+        intids._store_id(ob, uid)
+    else: # pragma: no cover
+        setattr(ob, intids.attribute, uid)
+    problem.repaired = True
+
+
+def check_intids(intids, repair=False, chunk_size=1000,
+                 min_id=None, max_id=None, checkpoint=None):
+    """
+    Check the entries of *intids* and return a :class:`CheckReport`.
+
+    :keyword bool repair: If true, repair the problems, committing
+        the transaction after each chunk. Otherwise, the transaction
+        is aborted after each chunk.
+    :keyword min_id: Check ids starting here (inclusive).
+    :keyword max_id: Check ids up to here (inclusive).
+    :keyword checkpoint: Passed to
+        :func:`~nti.intid.scan.iter_objects_chunked`, so that an
+        interrupted check can be resumed.
+    """
+    # pylint:disable=too-many-arguments
+    report = CheckReport()
+    items = iter_objects_chunked(intids, chunk_size=chunk_size,
+                                 transaction_mode=COMMIT if repair else ABORT,
+                                 min_id=min_id, max_id=max_id,
+                                 checkpoint=checkpoint)
+    for uid, ob in items:
+        report.checked += 1
+        problem = _check_one(intids, uid, ob, repair)
+        if problem is not None:
+            report.problems.append(problem)
+    return report
+
+
+def _check_one(intids, uid, ob, repair=False):
+    problem = _diagnose(intids, uid, ob)
+    if problem is not None:
+        logger.warning("Inconsistent intid: %r", problem)
+        if repair:
+            _repair(intids, problem, ob)
+    return problem
+
+
+def check_intids_parallel(zconfig, path='', workers=4, repair=False, chunk_size=1000,
+                          checkpoint_dir=None, inline=False):
+    """
+    Check the intid utility found at *path* (see
+    :func:`nti.intid.parallel.find_intids`) in the database described
+    by the ZConfig file *zconfig*, with *workers* processes each
+    checking ranges of ids, and return the combined
+    :class:`CheckReport`. Ranges that could not be checked are listed
+    in its ``failed`` attribute.
+
+    This uses :func:`nti.intid.parallel.scan_parallel`, which
+    describes *checkpoint_dir* and *inline*. If *workers* is 1, the
+    check runs in this process.
+    """
+    # pylint:disable=too-many-arguments
+    result = scan_parallel(zconfig, functools.partial(_check_one, repair=repair),
+                           path=path, workers=workers,
+                           chunk_size=chunk_size,
+                           transaction_mode=COMMIT if repair else ABORT,
+                           checkpoint_dir=checkpoint_dir,
+                           inline=inline or workers <= 1)
+    report = CheckReport()
+    report.checked = result.count
+    report.problems = result.value
+    report.failed = result.failed
+    return report
+
+
+def main(argv=None):
+    """
+    Entry point for the ``nti-intid-check`` script.
+
+    Exits with status 1 if problems were found and not repaired, or
+    if any ids could not be checked.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('zconfig', help="A ZConfig file describing the database.")
+    parser.add_argument('--site', default='',
+                        help="The /-separated path from the database root to the "
+                        "intid utility, or to a site that has one.")
+    parser.add_argument('--repair', action='store_true',
+                        help="Repair the problems found.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Check in this many processes. Requires a storage that "
+                        "can be opened by several processes.")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="How many ids to check in each transaction.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+
+    report = check_intids_parallel(args.zconfig, args.site, args.workers,
+                                   repair=args.repair, chunk_size=args.chunk_size)
+    if args.json:
+        print(json.dumps(report.to_dict(), indent=2, sort_keys=True))
+    else:
+        for problem in report.problems:
+            print(problem)
+        print(report)
+    unrepaired = len(report.problems) - report.repaired
+    if unrepaired or report.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Handling intid events outside the transaction that sends them.
+
+Subscribers such as catalog indexers can make registering an object
+much slower than it needs to be for the user waiting on it. A
+subscriber declared with :func:`deferred_handler` does not run when
+the event is sent. Instead, if the current site has an
+:class:`~nti.intid.interfaces.IDeferredEventQueue` utility (such as a
+:class:`DeferredEventQueue`), the id of the object, the kind of
+event and the name of the subscriber are added to the queue, which
+is committed with the rest of the transaction. Without a queue, or
+if the object has no id, the subscriber runs at once as usual::
+
+    @deferred_handler
+    @component.adapter(IContent, IAfterIdAddedEvent)
+    def index(ob, event):
+        ...
+
+A worker process (the ``nti-intid-deferred`` script, or
+:func:`run_worker`) takes the entries from the queue in order and
+calls the subscribers, each batch in its own transaction. The object
+is looked up again by its id, and the event is a
+:class:`DeferredEvent` providing the original kind of event; it has
+no ``original_event``. Entries for objects that are no longer
+registered are dropped, except for removal events
+(:class:`~zc.intid.interfaces.IBeforeIdRemovedEvent`), whose
+subscribers are called with ``None`` and must use the event's
+``id``. A subscriber that raises is tried again later, with an
+increasing delay, and after :data:`MAX_ATTEMPTS` attempts the entry
+is moved to the queue's :attr:`~DeferredEventQueue.failed` entries.
+
+Deferred subscribers must be defined at the top level of a module,
+so that the worker can import them by name.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import random
+import argparse
+import functools
+import importlib
+import itertools
+
+import BTrees
+
+from BTrees.Length import Length
+
+from persistent import Persistent
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from zc.intid.interfaces import ISubscriberEvent
+from zc.intid.interfaces import IBeforeIdRemovedEvent
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site as current_site
+
+from zope.interface import providedBy
+
+from nti.intid.interfaces import IDeferredEventQueue
+
+from nti.intid.lookup import get_intids
+from nti.intid.lookup import query_intids
+
+from nti.intid.parallel import traverse
+from nti.intid.parallel import open_database
+
+__all__ = [
+    'deferred_handler',
+    'DeferredEvent',
+    'DeferredEventQueue',
+    'process_queue',
+    'run_worker',
+    'main',
+    'MAX_ATTEMPTS',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+#: How many times a subscriber is tried before its entry is moved to
+#: the failed entries.
+MAX_ATTEMPTS = 3
+
+#: The delay, in seconds, before the first retry; it doubles after
+#: each further failure.
+RETRY_DELAY = 1.0
+
+# The low bits of each key are random, so that concurrent
+# transactions queueing at the same moment use different keys.
+_RANDOM_BITS = 10
+
+
+def _name_of(ob):
+    return '%s:%s' % (ob.__module__, getattr(ob, '__qualname__', ob.__name__))
+
+
+def _resolve(name):
+    module, qualname = name.split(':')
+    ob = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        ob = getattr(ob, attr)
+    return ob
+
+
+def _event_type(event):
+    for iface in providedBy(event):
+        if iface.isOrExtends(ISubscriberEvent):
+            return iface
+    return ISubscriberEvent # pragma: no cover
+
+
+class _DeferredHandler(object):
+    """
+    A subscriber whose work is queued.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        functools.update_wrapper(self, func)
+
+    def __call__(self, ob, event):
+        queue = component.queryUtility(IDeferredEventQueue)
+        uid = None
+        if queue is not None:
+            intids = query_intids()
+            uid = intids.queryId(ob) if intids is not None else None
+        if uid is None:
+            # Nowhere to queue it, or no way to find the object later.
+            self.func(ob, event)
+        else:
+            queue.put(uid, _name_of(_event_type(event)), _name_of(self))
+
+
+def deferred_handler(func):
+    """
+    Decorate the subscriber *func*, which takes an object and an
+    event, so that its events are queued instead of handled at once.
+    """
+    return _DeferredHandler(func)
+
+
+@interface.implementer(ISubscriberEvent)
+class DeferredEvent(object):
+    """
+    The event given to a deferred subscriber by the worker. It also
+    provides the interface of the event that was queued.
+    """
+
+    original_event = None
+
+    def __init__(self, ob, uid, attempts=0):
+        self.object = ob
+        #: The id of the object.
+        self.id = uid
+        #: How many times handling this event has already failed.
+        self.attempts = attempts
+
+
+@interface.implementer(IDeferredEventQueue)
+class DeferredEventQueue(Persistent):
+    """
+    A queue of deferred events, in order of the time at which they
+    are due.
+
+    Each entry is a tuple ``(id, event type, subscriber name,
+    attempts)``. Entries are kept in a BTree keyed by the time they
+    are due, in microseconds, with some random low bits, so that
+    concurrent transactions usually add different keys.
+
+    Because the keys follow the clock, every writer inserts into the
+    last bucket of the tree. Concurrent inserts there are merged only
+    while the bucket does not split; when it fills up, all but one
+    of the transactions adding to it get a
+    :class:`~ZODB.POSException.ConflictError` and must be retried.
+    Sites with many concurrent writers should expect about one such
+    conflict for each bucketful of queued events.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self):
+        self._entries = self.family.IO.BTree()
+        self._length = Length()
+        #: Entries that failed every attempt, keyed like the queue,
+        #: with the ``repr`` of the last exception appended.
+        self.failed = self.family.IO.BTree()
+
+    def _key(self, when):
+        return int(when * 1e6) << _RANDOM_BITS
+
+    def _insert(self, tree, when, entry):
+        key = self._key(when) | random.getrandbits(_RANDOM_BITS)
+        while not tree.insert(key, entry):
+            key += 1
+
+    def put(self, uid, event_type, handler, attempts=0, delay=0, now=None):
+        # pylint:disable=too-many-arguments
+        now = time.time() if now is None else now
+        self._insert(self._entries, now + delay, (uid, event_type, handler, attempts))
+        self._length.change(1)
+
+    def take(self, limit=None, now=None):
+        now = time.time() if now is None else now
+        due = self._key(now) | ((1 << _RANDOM_BITS) - 1)
+        items = list(itertools.islice(self._entries.items(max=due), limit))
+        for key, _ in items:
+            del self._entries[key]
+        self._length.change(-len(items))
+        return [entry for _, entry in items]
+
+    def fail(self, entry, error, now=None):
+        """
+        Record *entry* as having failed with the exception *error*.
+        """
+        now = time.time() if now is None else now
+        self._insert(self.failed, now, tuple(entry) + (repr(error),))
+
+    def __len__(self):
+        return self._length()
+
+    def __repr__(self):
+        return "<%s.%s len=%d failed=%d>" % (self.__class__.__module__,
+                                             self.__class__.__name__,
+                                             len(self), len(self.failed))
+
+
+def _handle(intids, uid, event_type, handler, attempts):
+    handler = _resolve(handler)
+    event_type = _resolve(event_type)
+    ob = intids.queryObject(uid)
+    if ob is None and not event_type.isOrExtends(IBeforeIdRemovedEvent):
+        logger.debug("Dropping %s for %s, which is no longer registered",
+                     event_type, uid)
+        return
+    event = DeferredEvent(ob, uid, attempts)
+    interface.alsoProvides(event, event_type)
+    getattr(handler, 'func', handler)(ob, event)
+
+
+def _transaction_manager(ob):
+    jar = getattr(ob, '_p_jar', None)
+    return jar.transaction_manager if jar is not None else transaction.manager
+
+
+def process_queue(queue, intids=None, limit=100, max_attempts=MAX_ATTEMPTS,
+                  retry_delay=RETRY_DELAY, now=None):
+    """
+    Handle up to *limit* entries of *queue* that are due, in the
+    current transaction of the connection holding *queue*, which the
+    caller commits. Each entry is handled in a savepoint, so the
+    changes of a subscriber that fails are rolled back, and the
+    entry is queued again.
+
+    Returns ``(handled, retried, failed)`` counts.
+    """
+    # pylint:disable=too-many-arguments
+    if intids is None:
+        intids = get_intids()
+    txm = _transaction_manager(queue)
+    handled = retried = failed = 0
+    for entry in queue.take(limit, now):
+        uid, event_type, handler, attempts = entry
+        savepoint = txm.savepoint(optimistic=True)
+        try:
+            _handle(intids, uid, event_type, handler, attempts)
+        except ConflictError:
+            raise
+        except Exception as e: # pylint:disable=broad-except
+            savepoint.rollback()
+            attempts += 1
+            if attempts >= max_attempts:
+                logger.exception("Giving up on %s for %s", handler, uid)
+                queue.fail(entry, e, now)
+                failed += 1
+            else:
+                logger.warning("Retrying %s for %s: %r", handler, uid, e)
+                queue.put(uid, event_type, handler, attempts,
+                          retry_delay * 2 ** (attempts - 1), now)
+                retried += 1
+        else:
+            handled += 1
+    return handled, retried, failed
+
+
+def _process_site(conn, path, limit, max_attempts, retry_delay):
+    txm = conn.transaction_manager
+    txm.begin()
+    try:
+        with current_site(traverse(conn.root(), path) if path else None):
+            queue = component.getUtility(IDeferredEventQueue)
+            counts = process_queue(queue, limit=limit, max_attempts=max_attempts,
+                                   retry_delay=retry_delay)
+        txm.commit()
+    except ConflictError:
+        logger.info("Conflict processing the deferred events; will try again.")
+        txm.abort()
+        return 0
+    return sum(counts)
+
+
+def run_worker(db, path='', limit=100, poll_interval=1.0, max_attempts=MAX_ATTEMPTS,
+               retry_delay=RETRY_DELAY, stop=None):
+    """
+    Process the queue of the site found at *path* in the database
+    *db* (the global site if *path* is empty) in batches of *limit*
+    entries, each in its own transaction, waiting *poll_interval*
+    seconds whenever the queue has nothing due.
+
+    The subscribers must be registered in this process, for example
+    by loading their ZCML.
+
+    :keyword stop: A :class:`threading.Event`; the worker returns once
+        it is set. Without one, the worker runs until interrupted.
+    """
+    # pylint:disable=too-many-arguments
+    wait = time.sleep if stop is None else stop.wait
+    conn = db.open(transaction.TransactionManager())
+    try:
+        while stop is None or not stop.is_set():
+            if not _process_site(conn, path, limit, max_attempts, retry_delay):
+                wait(poll_interval)
+    finally:
+        conn.transaction_manager.abort()
+        conn.close()
+
+
+def main(argv=None):
+    """
+    Entry point for the ``nti-intid-deferred`` script.
+    """
+    from zope.configuration import xmlconfig # pylint:disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('zconfig', help="A ZConfig file describing the database.")
+    parser.add_argument('--zcml', action='append', default=[],
+                        help="A ZCML file registering the subscribers. May be repeated.")
+    parser.add_argument('--site', default='',
+                        help="The /-separated path from the database root to the "
+                        "site with the queue.")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="How many events to handle in each transaction.")
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help="Seconds to wait when there is nothing to do.")
+    args = parser.parse_args(argv)
+    for zcml in args.zcml:
+        xmlconfig.file(zcml)
+    db = open_database(args.zconfig)
+    try:
+        run_worker(db, args.site, args.batch_size, args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
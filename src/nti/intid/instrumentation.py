@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measuring the time spent in intid operations.
+
+Nothing is measured until :func:`enable` is called with a recorder.
+Enabling replaces the measured methods of
+:class:`nti.intid.utility.IntIds` and the weak reference classes with
+timed wrappers; :func:`disable` puts the originals back, so there is
+no cost at all while disabled.
+
+While enabled, the recorder is given:
+
+- the duration of every call to the operations named in
+  :data:`OPERATIONS`, through :meth:`Recorder.observe`. Only the
+  outermost of these is recorded: for example, the ``queryId`` that
+  ``register`` makes is counted as part of the ``register``;
+- the duration of every call of a subscriber by
+  :func:`nti.intid.subscribers.subscriberEventNotify` (including each
+  call of a batch handler with its batch), as the operation
+  ``subscriber.`` followed by the dotted name of the subscriber.
+  These are recorded even inside one of :data:`OPERATIONS`; for
+  example, the subscribers of the events sent by ``register``;
+- through :meth:`Recorder.count`, a ``intids.allocation_probe`` for each
+  range of ids checked while allocating new ids (each is one BTree
+  search), and a ``intids.object_cache.hit`` or
+  ``intids.object_cache.miss`` for each use of the object cache (see
+  :mod:`nti.intid.cache`).
+
+:class:`MetricsRecorder` keeps call counts and latency histograms in
+memory and can render them for Prometheus with
+:func:`format_prometheus`. :class:`StatsdRecorder` sends everything to a
+statsd client instead.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import bisect
+import functools
+from threading import Lock
+from threading import local
+from time import perf_counter
+
+__all__ = [
+    'Recorder',
+    'MetricsRecorder',
+    'StatsdRecorder',
+    'Histogram',
+    'enable',
+    'disable',
+    'get_recorder',
+    'format_prometheus',
+    'subscriber_operation',
+    'OPERATIONS',
+]
+
+#: The names of the operations that are timed.
+OPERATIONS = (
+    'intids.register',
+    'intids.register_many',
+    'intids.unregister',
+    'intids.getId',
+    'intids.queryId',
+    'intids.getObject',
+    'intids.queryObject',
+    'wref.dereference',
+    'wref.resolve_many',
+)
+
+#: The default upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (
+    0.000005, 0.00001, 0.000025, 0.00005,
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5,
+)
+
+
+class Recorder(object):
+    """
+    Receives measurements. The default implementation discards them.
+    """
+
+    def observe(self, operation, seconds):
+        """
+        Record that a call to *operation* took *seconds*.
+        """
+
+    def count(self, name, value=1):
+        """
+        Add *value* to the counter *name*.
+        """
+
+
+class Histogram(object):
+    """
+    Cumulative latency histogram, in the style of Prometheus.
+
+    Not thread-safe; :class:`MetricsRecorder` locks around it.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One more for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return a list of ``(upper bound, count of values <= bound)``
+        pairs, ending with ``float('inf')``.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRecorder(Recorder):
+    """
+    Keeps counters, and a :class:`Histogram` for each operation, in
+    memory.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            try:
+                histogram = self.histograms[operation]
+            except KeyError:
+                histogram = self.histograms[operation] = Histogram(self._buckets)
+            histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def calls(self, operation):
+        """
+        Return how many times *operation* has been observed.
+        """
+        histogram = self.histograms.get(operation)
+        return histogram.count if histogram is not None else 0
+
+    def snapshot(self):
+        """
+        Return a dictionary of plain data: ``{'counters': {name:
+        value}, 'operations': {name: {'count':, 'sum':, 'buckets':}}}``.
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'operations': {
+                    name: {
+                        'count': h.count,
+                        'sum': h.sum,
+                        'buckets': h.cumulative(),
+                    }
+                    for name, h in self.histograms.items()
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+class StatsdRecorder(Recorder):
+    """
+    Sends measurements to a statsd client, such as the ones from
+    :mod:`perfmetrics` or the ``statsd`` package: anything with
+    ``timing(name, milliseconds)`` and ``incr(name, count)`` methods.
+    """
+
+    def __init__(self, client, prefix='nti.intid'):
+        self.client = client
+        self.prefix = prefix + '.' if prefix else ''
+
+    def observe(self, operation, seconds):
+        self.client.timing(self.prefix + operation, seconds * 1000)
+
+    def count(self, name, value=1):
+        self.client.incr(self.prefix + name, value)
+
+
+def _metric_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def format_prometheus(recorder, prefix='nti_intid'):
+    """
+    Render the contents of a :class:`MetricsRecorder` in the
+    Prometheus text exposition format.
+    """
+    data = recorder.snapshot()
+    lines = []
+    seconds = prefix + '_operation_seconds'
+    lines.append('# TYPE %s histogram' % seconds)
+    for name, op in sorted(data['operations'].items()):
+        label = 'operation="%s"' % _metric_label(name)
+        for bound, count in op['buckets']:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{%s,le="%s"} %d' % (seconds, label, le, count))
+        lines.append('%s_sum{%s} %r' % (seconds, label, op['sum']))
+        lines.append('%s_count{%s} %d' % (seconds, label, op['count']))
+    total = prefix + '_events_total'
+    lines.append('# TYPE %s counter' % total)
+    for name, value in sorted(data['counters'].items()):
+        lines.append('%s{name="%s"} %d' % (total, _metric_label(name), value))
+    return '\n'.join(lines) + '\n'
+
+
+class _Local(local):
+    # Are we inside a timed call?
+    active = False
+
+
+_local = _Local()
+
+_recorder = None
+# [(owner, attribute name, original value)]
+_originals = []
+
+
+def get_recorder():
+    """
+    Return the recorder in use, or ``None`` if disabled.
+    """
+    return _recorder
+
+
+def _timed(func, operation):
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        if _local.active:
+            # Nested; counted as part of the outer call.
+            return func(*args, **kwargs)
+        recorder = _recorder
+        _local.active = True
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.active = False
+            if recorder is not None:
+                recorder.observe(operation, perf_counter() - start)
+    return timed
+
+
+def _counting_probe(func):
+    @functools.wraps(func)
+    def probe(*args, **kwargs):
+        recorder = _recorder
+        if recorder is not None:
+            recorder.count('intids.allocation_probe')
+        return func(*args, **kwargs)
+    return probe
+
+
+def _counting_cache(func):
+    @functools.wraps(func)
+    def cached_object(*args, **kwargs):
+        result = func(*args, **kwargs)
+        recorder = _recorder
+        if recorder is not None:
+            recorder.count('intids.object_cache.miss' if result is None
+                           else 'intids.object_cache.hit')
+        return result
+    return cached_object
+
+
+def subscriber_operation(handler):
+    """
+    Return the name of the operation under which calls of the
+    subscriber *handler* are recorded.
+    """
+    module = getattr(handler, '__module__', None) or '?'
+    name = getattr(handler, '__qualname__', None) or type(handler).__name__
+    return 'subscriber.%s.%s' % (module, name)
+
+
+def _timed_dispatch(func, batch_type):
+    @functools.wraps(func)
+    def dispatch(handlers, ob, event, queue):
+        recorder = _recorder
+        for handler in handlers:
+            if queue is not None and isinstance(handler, batch_type):
+                # Timed when the batch runs.
+                func((handler,), ob, event, queue)
+                continue
+            start = perf_counter()
+            try:
+                func((handler,), ob, event, queue)
+            finally:
+                if recorder is not None:
+                    recorder.observe(subscriber_operation(handler),
+                                     perf_counter() - start)
+    return dispatch
+
+
+def _timed_batch(func):
+    @functools.wraps(func)
+    def run_batch(handler, items):
+        recorder = _recorder
+        start = perf_counter()
+        try:
+            return func(handler, items)
+        finally:
+            if recorder is not None:
+                recorder.observe(subscriber_operation(handler), perf_counter() - start)
+    return run_batch
+
+
+def _replacements():
+    # pylint:disable=protected-access
+    from nti.intid import subscribers
+    from nti.intid import wref
+    from nti.intid.utility import IntIds
+
+    timed_methods = (
+        ('register', ()),
+        ('register_many', ('registerMany',)),
+        ('unregister', ()),
+        ('getId', ('get_id',)),
+        ('queryId', ()),
+        ('getObject', ()),
+        ('queryObject', ()),
+    )
+    for name, aliases in timed_methods:
+        wrapper = _timed(IntIds.__dict__[name], 'intids.' + name)
+        for attr in (name,) + aliases:
+            yield IntIds, attr, wrapper
+
+    yield IntIds, '_is_free', _counting_probe(IntIds._is_free)
+    yield IntIds, '_cached_object', _counting_cache(IntIds._cached_object)
+    yield (wref._AbstractWeakRef, '_cached',
+           _timed(wref._AbstractWeakRef._cached, 'wref.dereference'))
+    yield wref, 'resolve_many', _timed(wref.resolve_many, 'wref.resolve_many')
+    yield (subscribers, '_dispatch',
+           _timed_dispatch(subscribers._dispatch, subscribers._BatchHandler))
+    yield subscribers, '_run_batch', _timed_batch(subscribers._run_batch)
+
+
+def enable(recorder):
+    """
+    Start sending measurements to *recorder* (a :class:`Recorder`),
+    replacing any previous recorder.
+    """
+    global _recorder # pylint:disable=global-statement
+    disable()
+    for owner, attr, replacement in _replacements():
+        _originals.append((owner, attr, owner.__dict__[attr]))
+        setattr(owner, attr, replacement)
+    _recorder = recorder
+    return recorder
+
+
+def disable():
+    """
+    Stop measuring, restoring the original methods.
+    """
+    global _recorder # pylint:disable=global-statement
+    while _originals:
+        owner, attr, original = _originals.pop()
+        setattr(owner, attr, original)
+    _recorder = None
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(disable)
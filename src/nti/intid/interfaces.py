@@ -11,6 +11,8 @@ from __future__ import absolute_import
 from zc.intid.interfaces import IIntIdsSubclass
 from zc.intid.interfaces import IIntIds as IZCIIntIds
 
+from zope.interface import Interface
+
 from zope.location.interfaces import IContained
 
 import zope.deferredimport
@@ -46,6 +48,47 @@ class IIntIds(IZCIIntIds, IIntIdsSubclass, IContained):
         Do not use this method.
         """
 
+    def register_many(objects):
+        """
+        Register each of the *objects*, returning a list of their ids
+        in the same order.
+
+        New ids are allocated as a contiguous block. Events
+        are sent only after all objects have been registered, one per
+        entry in *objects*, in the order given.
+        """
+
+    def contains_many(ids):
+        """
+        Return the set of those *ids* that are registered, without
+        loading the registered objects.
+        """
+
+    def iter_range(min_id=None, max_id=None, excludemin=False, excludemax=False):
+        """
+        Lazily iterate, in ascending order, the registered ids in the
+        given range. A bound of ``None`` leaves that end open.
+        """
+
+    def items_range(min_id=None, max_id=None, excludemin=False, excludemax=False):
+        """
+        Lazily iterate, in ascending order of id, the ``(id, object)``
+        pairs whose id is in the given range.
+        """
+
+    def enable_reverse_index():
+        """
+        Start keeping a map from the key reference of each registered
+        object to its id, so that objects that cannot store the id
+        attribute can be registered and found.
+        """
+
+    def enable_changelog(max_records=None):
+        """
+        Start keeping a log of the ids registered and unregistered.
+        See :mod:`nti.intid.changelog`.
+        """
+
     def force_register(uid, ob, check=True):
         """
         Register an object.
@@ -68,3 +111,79 @@ class IIntIds(IZCIIntIds, IIntIdsSubclass, IContained):
         :param notify: Flag to trigger an ``IIdRemovedEvent``
         :param notremove_attribute: Flag to remove intid attribute
         """
+
+
+class IIntIdRefs(Interface):
+    """
+    The map from ids to objects kept by an :class:`IIntIds` in its
+    ``refs`` attribute.
+
+    This is the subset of the API of a 64-bit ``LOBTree`` that the
+    utility uses; an ``LOBTree`` is the default.
+    """
+
+    def __getitem__(uid):
+        """Return the object stored for *uid*, or raise :exc:`KeyError`."""
+
+    def get(uid, default=None):
+        """Return the object stored for *uid*, or *default*."""
+
+    def __contains__(uid):
+        """Is anything stored for *uid*?"""
+
+    def __setitem__(uid, ob):
+        """Store *ob* for *uid*."""
+
+    def __delitem__(uid):
+        """Remove *uid*, or raise :exc:`KeyError`."""
+
+    def __len__():
+        """The number of ids stored."""
+
+    def iterkeys(min=None, max=None, excludemin=False, excludemax=False):
+        """Lazily iterate the ids in the range, in ascending order."""
+
+    def iteritems(min=None, max=None, excludemin=False, excludemax=False):
+        """Lazily iterate the ``(id, object)`` pairs in the range, in ascending order."""
+
+    def items(min=None, max=None, excludemin=False, excludemax=False):
+        """Return the ``(id, object)`` pairs in the range, in ascending order."""
+
+    def minKey(min=None):
+        """
+        Return the smallest id that is at least *min*, or raise
+        :exc:`ValueError`.
+        """
+
+    def maxKey(max=None):
+        """
+        Return the largest id that is at most *max*, or raise
+        :exc:`ValueError`.
+        """
+
+
+class IDeferredEventQueue(Interface):
+    """
+    A persistent queue of intid events whose handling has been
+    deferred; see :mod:`nti.intid.deferred`.
+
+    Register one as a utility in a site to have the deferred
+    subscribers of that site queue their events.
+    """
+
+    def put(uid, event_type, handler, attempts=0, delay=0, now=None):
+        """
+        Queue the event *event_type* (the dotted name of an interface)
+        for the object with id *uid*, to be handled by *handler* (the
+        name of a deferred subscriber) no sooner than *delay* seconds
+        from *now*.
+        """
+
+    def take(limit=None, now=None):
+        """
+        Remove and return up to *limit* of the entries that are due,
+        oldest first.
+        """
+
+    def __len__():
+        """The number of entries waiting."""
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Leases on shards of the id space, for many concurrent writers.
+
+When several processes (for example, ZEO or RelStorage clients)
+register objects at the same time, they conflict whenever their
+transactions modify the same BTree bucket or split the same node.
+Random allocation makes overlapping writes unlikely but leaves them
+to chance, and each writer wanders to a new random part of the tree
+whenever it loses its place.
+
+An :class:`IdLeaseTable` divides the 64-bit id space into shards by
+the high bits of the id, and hands each writer (each connection
+using the utility) a lease on a shard of its own. The writer then
+allocates ids sequentially inside its shard.
+
+That only keeps writers apart if the shards are stored apart: with
+the default ``refs``, a single BTree, every writer still changes the
+same internal nodes, and the harness in :mod:`nti.intid.testing`
+measures as many conflicts as with random allocation (60%). With
+:class:`nti.intid.storage.ShardedRefs`, whose shards the lease table
+uses, each writer has a BTree of its own. Even then, leases only
+beat random allocation when the shards are coarse: with the default
+16 shard bits, random allocation also measures no conflicts, but
+with 4 shard bits and a dozen writers it conflicts in about a
+quarter of the transactions, and leased allocation in about 2%.
+
+Leases are not free. Each new connection writes to the lease table
+to acquire one, and a lease that is not released (see
+:meth:`nti.intid.utility.IntIds.release_id_lease`) keeps its shard
+from other writers until it expires.
+
+The table itself is a small BTree keyed by shard prefix. Acquiring
+a lease inserts a new key; concurrent acquisitions of different
+shards are merged by the BTree's own conflict resolution, and if
+two writers happen to pick the same shard at the same time, one of
+them gets an ordinary :class:`~ZODB.POSException.ConflictError`
+and picks another shard when the transaction is retried.
+
+Leases are an optimization only: a writer allocates above the
+highest id already registered in its shard, and checks the ids
+against the catalog, as this connection sees it, before using them.
+Two writers that both believe they hold a shard (because a lease was
+lost, expired or stolen) may therefore choose the same ids; the
+transactions then conflict on the shard's BTree and one of them is
+retried, so the catalog never ends up with duplicate ids.
+
+This is used by :data:`nti.intid.utility.ALLOCATE_LEASED`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import random
+import socket
+import itertools
+
+import BTrees
+
+from persistent import Persistent
+
+__all__ = [
+    'IdLeaseTable',
+    'new_holder',
+]
+
+_holder_counter = itertools.count()
+
+
+def new_holder():
+    """
+    Return a new string that identifies a lease holder uniquely
+    across processes and machines.
+    """
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), next(_holder_counter))
+
+
+class IdLeaseTable(Persistent):
+    """
+    A table of leases on shards of the id space.
+
+    Shard *prefix* holds every id whose top :attr:`prefix_bits` bits
+    (of the 63 available to non-negative ids) equal *prefix*.
+    """
+
+    family = BTrees.family64
+
+    #: How many of the high bits of an id name its shard.
+    prefix_bits = 16
+
+    #: How long, in seconds, a lease lasts without being renewed.
+    #: Expired leases may be given to new holders.
+    lease_duration = 24 * 60 * 60
+
+    _randrange = random.randrange
+
+    def __init__(self, prefix_bits=None, lease_duration=None):
+        if prefix_bits is not None:
+            if not 1 <= prefix_bits <= 32:
+                raise ValueError("Prefix bits must be between 1 and 32", prefix_bits)
+            self.prefix_bits = prefix_bits
+        if lease_duration is not None:
+            self.lease_duration = lease_duration
+        # prefix -> (holder, time acquired or renewed)
+        self.leases = self.family.IO.BTree()
+
+    @property
+    def shard_count(self):
+        return 1 << self.prefix_bits
+
+    def shard_range(self, prefix):
+        """
+        Return the first and last ids (inclusive) in the shard
+        *prefix*.
+        """
+        shift = 63 - self.prefix_bits
+        first = prefix << shift
+        return first, first + (1 << shift) - 1
+
+    def holder_of(self, prefix, now=None):
+        """
+        Return the holder of an unexpired lease on *prefix*, or
+        ``None``.
+        """
+        lease = self.leases.get(prefix)
+        if lease is None or self._expired(lease, now):
+            return None
+        return lease[0]
+
+    def _expired(self, lease, now=None):
+        now = time.time() if now is None else now
+        return lease[1] + self.lease_duration < now
+
+    def acquire(self, holder, now=None):
+        """
+        Give *holder* a lease on a shard that has no unexpired lease,
+        and return the prefix of that shard.
+
+        :raises ValueError: If every shard is leased.
+        """
+        now = time.time() if now is None else now
+        leases = self.leases
+        shard_count = self.shard_count
+        if len(leases) >= shard_count:
+            # Maybe something has expired
+            for prefix, lease in leases.items():
+                if self._expired(lease, now):
+                    break
+            else:
+                raise ValueError("All shards are leased")
+        else:
+            while True:
+                prefix = self._randrange(0, shard_count)
+                lease = leases.get(prefix)
+                if lease is None or self._expired(lease, now):
+                    break
+        leases[prefix] = (holder, now)
+        return prefix
+
+    def renew(self, prefix, holder, now=None):
+        """
+        Extend the lease *holder* has on *prefix*.
+
+        Return whether *holder* still held it.
+        """
+        if self.holder_of(prefix, now) != holder:
+            return False
+        self.leases[prefix] = (holder, time.time() if now is None else now)
+        return True
+
+    def needs_renewal(self, prefix, now=None):
+        """
+        Has more than half of the lease on *prefix* been used up?
+        """
+        lease = self.leases.get(prefix)
+        now = time.time() if now is None else now
+        return lease is None or lease[1] + self.lease_duration / 2 < now
+
+    def release(self, prefix, holder):
+        """
+        Give up the lease *holder* has on *prefix*, if it still has it.
+        """
+        lease = self.leases.get(prefix)
+        if lease is not None and lease[0] == holder:
+            del self.leases[prefix]
+
+    def __len__(self):
+        return len(self.leases)
+
+    def __repr__(self):
+        return "<%s.%s %d/%d leased>" % (self.__class__.__module__,
+                                         self.__class__.__name__,
+                                         len(self), self.shard_count)
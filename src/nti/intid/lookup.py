@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cached lookups of the intid utility.
+
+Finding the :class:`zc.intid.IIntIds` utility means asking the
+current site manager, which walks the chain of local and global
+registries. The functions here remember the answer on the site
+manager itself, so repeated lookups in the same site are cheap.
+
+A remembered answer is discarded when:
+
+- a different site becomes current (each site manager has its own
+  answer);
+- the site manager is persistent and gets invalidated or ghosted (the
+  answer is kept in a volatile attribute);
+- the site manager's utility registry changes. Registries count their
+  changes (as :mod:`zope.interface` does to keep its own lookup caches
+  valid), including changes to the registries they are based on, and
+  the persistent registries of local sites get the changes committed
+  by other processes as ZODB invalidations;
+- any component is registered or unregistered in this process. This
+  requires :func:`registrationChanged` to be subscribed, as is done by
+  this package's ``configure.zcml``. Code that modifies registries
+  without sending events can call :func:`clear_cache`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from zope.interface.interfaces import IRegistrationEvent
+from zope.interface.interfaces import ComponentLookupError
+
+__all__ = [
+    'get_intids',
+    'query_intids',
+    'clear_cache',
+    'registrationChanged',
+]
+
+#: Incremented each time a cached answer may have become stale.
+#: Answers computed under a different generation are ignored.
+_generation = 0
+
+_CACHE_ATTR = '_v_nti_intid_utility'
+
+
+def _cache_key(registry):
+    """
+    Return a key that changes whenever the answers found in the
+    adapter *registry* may have changed.
+    """
+    # A registry that is reinitialized starts counting again, so the
+    # registry itself is part of the key.
+    return (_generation, registry, registry._generation)
+
+
+def query_intids(default=None):
+    """
+    Return the :class:`zc.intid.IIntIds` utility for the current
+    site, or *default* if there is none.
+    """
+    sm = component.getSiteManager()
+    try:
+        key, utility = getattr(sm, _CACHE_ATTR)
+    except AttributeError:
+        key = utility = None
+
+    current = _cache_key(sm.utilities)
+    if key != current:
+        utility = sm.queryUtility(IIntIds)
+        try:
+            setattr(sm, _CACHE_ATTR, (current, utility))
+        except (AttributeError, TypeError): # pragma: no cover
+            # Can't store arbitrary attributes, no caching.
+            pass
+
+    return utility if utility is not None else default
+
+
+def get_intids():
+    """
+    Return the :class:`zc.intid.IIntIds` utility for the current
+    site.
+
+    :raises zope.interface.interfaces.ComponentLookupError: If there
+        is no such utility.
+    """
+    utility = query_intids()
+    if utility is None:
+        raise ComponentLookupError(IIntIds, '')
+    return utility
+
+
+def clear_cache():
+    """
+    Forget all remembered utilities.
+    """
+    global _generation # pylint:disable=global-statement
+    _generation += 1
+
+
+@component.adapter(IRegistrationEvent)
+def registrationChanged(unused_event=None):
+    """
+    Event subscriber that calls :func:`clear_cache` whenever a
+    component is registered or unregistered.
+    """
+    clear_cache()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_cache)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scanning every registered object with several processes.
+
+Jobs that visit every object in the catalog (reindexing, exports,
+migrations, :mod:`integrity checks <nti.intid.check>`) can be spread
+over several processes by giving each a range of ids.
+:func:`split_ranges` chooses ranges holding about the same number of
+ids, and :func:`scan_parallel` runs a function on each object of each
+range in a pool of worker processes and combines the results.
+
+Each worker opens its own connection to the database described by a
+ZConfig file, so the storage must be one that several processes can
+open at once, such as ZEO or RelStorage (or a read-only FileStorage).
+Each range is walked with :func:`nti.intid.scan.iter_objects_chunked`.
+With a checkpoint directory, each range records its progress in its
+own :class:`~nti.intid.scan.FileCheckpoint`, so a range that fails is
+retried, alone, from where it stopped, and so is a whole scan that is
+run again.
+
+This module requires :mod:`ZODB`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+import BTrees
+
+import transaction
+
+import ZODB.config
+
+from zc.intid.interfaces import IIntIds
+
+from nti.intid.scan import ABORT
+from nti.intid.scan import FileCheckpoint
+from nti.intid.scan import iter_objects_chunked
+
+__all__ = [
+    'ScanResult',
+    'find_intids',
+    'open_database',
+    'split_ranges',
+    'scan_parallel',
+    'traverse',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+#: How many sample keys are collected per range wanted.
+SAMPLES_PER_RANGE = 8
+
+
+def open_database(zconfig):
+    """
+    Open the database described by the ZConfig file (or URL) *zconfig*.
+    """
+    return ZODB.config.databaseFromURL(zconfig)
+
+
+def traverse(root, path=''):
+    """
+    Return the object found by following the ``/``-separated *path*
+    from *root*, by item or else by attribute.
+    """
+    ob = root
+    for name in (n for n in path.split('/') if n):
+        try:
+            ob = ob[name]
+        except (KeyError, TypeError):
+            ob = getattr(ob, name)
+    return ob
+
+
+def find_intids(root, path=''):
+    """
+    Find the intid utility starting from the database *root* and
+    following the ``/``-separated *path* (see :func:`traverse`),
+    which ends either at the utility itself or at a site whose site
+    manager has one.
+    """
+    ob = traverse(root, path)
+    if IIntIds.providedBy(ob):
+        return ob
+    return ob.getSiteManager().getUtility(IIntIds)
+
+
+def _node_keys(node, family):
+    """
+    Return the separator keys and the children of the BTree *node*,
+    or its keys and no children if it is a bucket.
+    """
+    state = node.__getstate__()
+    if state is None:
+        return [], []
+    if isinstance(node, family.IO.Bucket):
+        return list(state[0][::2]), []
+    if len(state) == 1:
+        # A BTree with a single bucket stores its state inline.
+        return list(state[0][0][0][::2]), []
+    data = state[0]
+    return list(data[1::2]), list(data[::2])
+
+
+def _sample_tree(tree, wanted, family):
+    # The separator keys at each level of a BTree divide it into
+    # nodes of about the same size. Go down until there are
+    # enough of them. Only the (small) interior nodes are loaded,
+    # until we reach the buckets.
+    samples = set()
+    level = [tree]
+    while level:
+        children = []
+        for node in level:
+            keys, node_children = _node_keys(node, family)
+            samples.update(keys)
+            children.extend(node_children)
+        if len(samples) >= wanted:
+            break
+        level = children
+    return sorted(samples)
+
+
+def _sample_probes(refs, wanted):
+    # Not a BTree we can look inside. Probe evenly through the id
+    # space; this balances the width, not the population, of the
+    # ranges.
+    try:
+        lo, hi = refs.minKey(), refs.maxKey()
+    except ValueError:
+        return []
+    step = max(1, (hi - lo) // wanted)
+    samples = set()
+    for point in range(lo, hi + 1, step):
+        samples.add(refs.minKey(point))
+    return sorted(samples)
+
+
+def split_ranges(refs, count, family=BTrees.family64):
+    """
+    Split the ids in *refs* into at most *count* ranges holding about
+    the same number of ids, and return a list of ``(min_id, max_id)``
+    pairs (inclusive) in ascending order. The first range has no
+    lower bound and the last no upper bound (``None``), so together
+    they cover every possible id.
+
+    If *refs* is a BTree of *family*, the ranges are balanced using
+    the separator keys of its interior nodes, so only a few nodes are
+    loaded. Otherwise the ranges are found by probing with
+    ``minKey`` and are only balanced by width.
+    """
+    wanted = count * SAMPLES_PER_RANGE
+    if isinstance(refs, family.IO.BTree):
+        samples = _sample_tree(refs, wanted, family)
+    else:
+        samples = _sample_probes(refs, wanted)
+
+    starts = []
+    for i in range(1, count):
+        if not samples:
+            break
+        index = i * len(samples) // count
+        if not index:
+            # Nothing would come before the first sample key
+            # if the samples are all the keys.
+            continue
+        start = samples[index]
+        if not starts or start > starts[-1]:
+            starts.append(start)
+    ranges = []
+    lo = None
+    for start in starts:
+        ranges.append((lo, start - 1))
+        lo = start
+    ranges.append((lo, None))
+    return ranges
+
+
+class ScanResult(object):
+    """
+    The combined result of :func:`scan_parallel`.
+
+    .. attribute:: value
+
+        The combination of the values from each range.
+
+    .. attribute:: count
+
+        How many objects were visited.
+
+    .. attribute:: failed
+
+        A list of ``(range, exception)`` pairs for the ranges that
+        failed every attempt.
+    """
+
+    def __init__(self, value, count=0, failed=()):
+        self.value = value
+        self.count = count
+        self.failed = list(failed)
+
+    def __repr__(self):
+        return "<%s.%s count=%d failed=%d>" % (self.__class__.__module__,
+                                               self.__class__.__name__,
+                                               self.count, len(self.failed))
+
+
+def _scan_range(zconfig, path, func, reducer, initial, id_range,
+                chunk_size, transaction_mode, checkpoint_path):
+    """
+    Visit each object in *id_range* and return ``(count, value)``.
+    This runs in a worker process.
+    """
+    # pylint:disable=too-many-arguments,too-many-locals
+    value = [] if reducer is None else initial
+    count = 0
+    checkpoint = FileCheckpoint(checkpoint_path) if checkpoint_path else None
+    db = open_database(zconfig)
+    try:
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        try:
+            intids = find_intids(conn.root(), path)
+            items = iter_objects_chunked(intids, chunk_size=chunk_size,
+                                         checkpoint=checkpoint,
+                                         transaction_mode=transaction_mode,
+                                         min_id=id_range[0], max_id=id_range[1])
+            for uid, ob in items:
+                count += 1
+                result = func(intids, uid, ob)
+                if reducer is None:
+                    if result is not None:
+                        value.append(result)
+                else:
+                    value = reducer(value, result)
+        finally:
+            txm.abort()
+            conn.close()
+    finally:
+        db.close()
+    return count, value
+
+
+def _load_ranges(zconfig, path, workers, checkpoint_dir):
+    saved = os.path.join(checkpoint_dir, 'ranges.json') if checkpoint_dir else None
+    if saved and os.path.exists(saved):
+        # Resuming; the ranges must be the same as last time.
+        with open(saved) as f:
+            return [tuple(r) for r in json.load(f)]
+
+    db = open_database(zconfig)
+    try:
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        try:
+            intids = find_intids(conn.root(), path)
+            ranges = split_ranges(intids.refs, workers, intids.family)
+        finally:
+            txm.abort()
+            conn.close()
+    finally:
+        db.close()
+
+    if saved:
+        with open(saved, 'w') as f:
+            json.dump(ranges, f)
+    return ranges
+
+
+def scan_parallel(zconfig, func, path='', workers=4, ranges_per_worker=1,
+                  reducer=None, initial=None, merge=None,
+                  chunk_size=1000, transaction_mode=ABORT,
+                  checkpoint_dir=None, retries=1, progress=None, inline=False):
+    """
+    Call ``func(intids, uid, ob)`` for each object registered in the
+    intid utility found at *path* (see :func:`find_intids`) in the
+    database described by the ZConfig file *zconfig*, using
+    *workers* processes, and return a :class:`ScanResult`.
+
+    The ids are split into ``workers * ranges_per_worker`` ranges
+    with :func:`split_ranges`. More ranges than workers evens out
+    ranges that are slower than others, and makes retries cheaper.
+
+    *func*, *reducer* and *merge* must be picklable (for example,
+    module-level functions).
+
+    :keyword reducer: How each range's results are combined. By
+        default, each range produces a list of the results of *func*
+        that are not ``None``. Otherwise, it produces
+        ``reducer(... reducer(initial, result1), result2) ...)``.
+    :keyword merge: How the values of the ranges are combined, in
+        order of id, into :attr:`ScanResult.value`. By default, lists
+        are concatenated if *reducer* is not given; otherwise *merge*
+        defaults to *reducer*.
+    :keyword transaction_mode: Passed to
+        :func:`~nti.intid.scan.iter_objects_chunked`. Use
+        :data:`~nti.intid.scan.COMMIT` if *func* makes changes.
+    :keyword checkpoint_dir: If given, a directory where the ranges,
+        and the progress of each range, are recorded. Running the
+        same scan again with the same directory skips what was
+        already done. Note that the values of the chunks done before
+        a failure are not recovered; checkpoints are meant for scans
+        whose work is their side effects.
+    :keyword int retries: How many more times to try a range that
+        raises an exception.
+    :keyword progress: If given, called with ``(ranges done, total
+        ranges, objects visited)`` as each range finishes.
+    :keyword bool inline: If true, run the ranges one after the
+        other in this process instead of in a pool. This is meant for
+        tests and debugging.
+    """
+    # pylint:disable=too-many-arguments,too-many-locals
+    if merge is None and reducer is not None:
+        merge = reducer
+    ranges = _load_ranges(zconfig, path, workers * ranges_per_worker, checkpoint_dir)
+
+    def args_for(index):
+        checkpoint_path = None
+        if checkpoint_dir:
+            checkpoint_path = os.path.join(checkpoint_dir, 'range-%d.checkpoint' % index)
+        return (zconfig, path, func, reducer, initial, ranges[index],
+                chunk_size, transaction_mode, checkpoint_path)
+
+    results = {}
+    failed = []
+    attempts = dict.fromkeys(range(len(ranges)), 0)
+
+    def finished(index, outcome):
+        results[index] = outcome
+        if progress is not None:
+            progress(len(results), len(ranges), sum(c for c, _ in results.values()))
+
+    if inline:
+        for index in range(len(ranges)):
+            while True:
+                attempts[index] += 1
+                try:
+                    outcome = _scan_range(*args_for(index))
+                except Exception as e: # pylint:disable=broad-except
+                    logger.exception("Range %s failed", ranges[index])
+                    if attempts[index] > retries:
+                        failed.append((ranges[index], e))
+                        break
+                else:
+                    finished(index, outcome)
+                    break
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            pending = {}
+            for index in range(len(ranges)):
+                attempts[index] += 1
+                pending[executor.submit(_scan_range, *args_for(index))] = index
+            while pending:
+                future = next(as_completed(pending))
+                index = pending.pop(future)
+                try:
+                    outcome = future.result()
+                except Exception as e: # pylint:disable=broad-except
+                    logger.warning("Range %s failed: %r", ranges[index], e)
+                    if attempts[index] > retries:
+                        failed.append((ranges[index], e))
+                    else:
+                        attempts[index] += 1
+                        pending[executor.submit(_scan_range, *args_for(index))] = index
+                else:
+                    finished(index, outcome)
+
+    value = None
+    count = 0
+    for index in sorted(results):
+        range_count, range_value = results[index]
+        count += range_count
+        if value is None:
+            value = range_value
+        elif merge is None:
+            value.extend(range_value)
+        else:
+            value = merge(value, range_value)
+    if value is None:
+        value = [] if reducer is None else initial
+    return ScanResult(value, count, failed)
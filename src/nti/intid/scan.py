@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Walking every object registered in an intid catalog.
+
+Iterating ``IntIds.refs`` directly loads every object into the
+connection's pickle cache, which, for a large catalog, grows without
+bound. The functions here walk the catalog in chunks of ids, keeping
+the cache (and so memory) bounded, optionally ending a transaction
+after each chunk and recording how far they got so that an
+interrupted walk can pick up where it stopped.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from itertools import islice
+
+import transaction
+
+__all__ = [
+    'Checkpoint',
+    'FileCheckpoint',
+    'iter_objects_chunked',
+    'COMMIT',
+    'ABORT',
+]
+
+#: Commit the transaction after each chunk.
+COMMIT = 'commit'
+#: Abort the transaction after each chunk.
+ABORT = 'abort'
+
+
+class Checkpoint(object):
+    """
+    Remembers, in memory, the last id processed by a walk.
+
+    Subclasses can store it somewhere more durable by overriding
+    :meth:`load`, :meth:`save` and :meth:`clear`.
+    """
+
+    def __init__(self, last_id=None):
+        self.last_id = last_id
+
+    def load(self):
+        """
+        Return the last id saved, or ``None`` to start from the
+        beginning.
+        """
+        return self.last_id
+
+    def save(self, last_id):
+        self.last_id = last_id
+
+    def clear(self):
+        self.last_id = None
+
+
+class FileCheckpoint(Checkpoint):
+    """
+    Remembers the last id processed in a file, so that a walk can
+    be resumed by a new process.
+
+    The file is replaced atomically each time it is saved.
+    """
+
+    def __init__(self, path):
+        Checkpoint.__init__(self)
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return int(data) if data else None
+
+    def save(self, last_id):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(last_id))
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return "<%s.%s %r>" % (self.__class__.__module__,
+                               self.__class__.__name__,
+                               self.path)
+
+
+def iter_objects_chunked(intids, chunk_size=1000, on_chunk=None,
+                         checkpoint=None, transaction_mode=None,
+                         min_id=None, max_id=None, minimize_cache=True):
+    """
+    Iterate the ``(id, object)`` pairs registered in *intids*, in
+    ascending order of id, *chunk_size* ids at a time.
+
+    After all the pairs in a chunk have been produced, in this
+    order:
+
+    1. *on_chunk*, if given, is called with the list of ids in the
+       chunk;
+    2. if *transaction_mode* is :data:`COMMIT` or :data:`ABORT`, the
+       transaction is committed or aborted;
+    3. the last id of the chunk is saved to *checkpoint*, if given;
+    4. the pickle cache of the connection *intids* belongs to is
+       reduced, with ``cacheMinimize()`` if *minimize_cache* is true
+       (the default) or ``cacheGC()`` otherwise.
+
+    Each chunk is found with a fresh range search, so the walk is not
+    disturbed by ending transactions between chunks.
+
+    :keyword checkpoint: A :class:`Checkpoint`. If it has a saved id,
+        the walk resumes with the id after it. When the walk is
+        complete, the checkpoint holds the last id in the catalog;
+        clear it to start again from the beginning.
+    :keyword min_id: If given, the walk starts at this id (inclusive).
+        A saved checkpoint takes priority.
+    :keyword max_id: If given, the walk stops at this id (inclusive).
+    """
+    # pylint:disable=too-many-arguments
+    excludemin = False
+    if checkpoint is not None:
+        last_id = checkpoint.load()
+        if last_id is not None:
+            min_id = last_id
+            excludemin = True
+
+    jar = getattr(intids, '_p_jar', None)
+    txm = jar.transaction_manager if jar is not None else transaction.manager
+
+    while True:
+        chunk = list(islice(intids.items_range(min_id, max_id, excludemin),
+                            chunk_size))
+        if not chunk:
+            break
+        for item in chunk:
+            yield item
+
+        chunk_ids = [uid for uid, _ in chunk]
+        del chunk
+
+        if on_chunk is not None:
+            on_chunk(chunk_ids)
+
+        if transaction_mode == COMMIT:
+            txm.commit()
+        elif transaction_mode == ABORT:
+            txm.abort()
+        if transaction_mode and txm.explicit:
+            txm.begin()
+
+        min_id = chunk_ids[-1]
+        excludemin = True
+        if checkpoint is not None:
+            checkpoint.save(min_id)
+
+        if jar is not None:
+            if minimize_cache:
+                jar.cacheMinimize()
+            else:
+                jar.cacheGC()
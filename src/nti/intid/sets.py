@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Set operations on collections of intids.
+
+Code that finds objects by combining ids from several sources (catalog
+indexes, membership lists, and the like) should keep the ids in
+:mod:`BTrees` of :data:`BTrees.family64` and combine them with the
+functions here, which run in the C implementations of those BTrees,
+and only turn ids into objects at the end, with :func:`resolve`.
+
+The arguments may be any of:
+
+- sets and mappings from ``family64.II`` (``LLSet``, ``LLTreeSet``,
+  ``LLBucket``, ``LLBTree``), for which the keys are the ids;
+- the same from ``family64.IF`` (``LFSet``, ``LFBucket``, and so on),
+  typically scores from a catalog query;
+- a :class:`nti.intid.wref.WeakRefTreeSet`;
+- any other iterable of ids.
+
+If all the arguments come from the same module, so does the result.
+Otherwise everything is converted to ``family64.II`` sets first.
+:func:`union` and :func:`intersection` always produce sets, and only
+:func:`difference` keeps the values of a mapping; use the weighted
+variants to combine scores. As in :mod:`BTrees`, an argument of ``None``
+stands for "no constraint": it is ignored, and if every argument is
+``None``, so is the result.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BTrees
+
+from nti.intid.lookup import get_intids
+
+__all__ = [
+    'union',
+    'intersection',
+    'difference',
+    'weighted_union',
+    'weighted_intersection',
+    'resolve',
+]
+
+family = BTrees.family64
+
+
+def _module_of(ob):
+    for module in (family.II, family.IF):
+        if isinstance(ob, (module.Set, module.TreeSet, module.Bucket, module.BTree)):
+            return module
+    return None
+
+
+def _coerce(obs):
+    """
+    Return the BTrees module to use and *obs* made acceptable to it.
+    """
+    modules = set()
+    for ob in obs:
+        modules.add(_module_of(ob))
+    if len(modules) == 1:
+        module = modules.pop()
+        if module is not None:
+            return module, obs
+    module = family.II
+    return module, [ob if _module_of(ob) is module else _as_set(ob, module)
+                    for ob in obs]
+
+
+def _as_set(ob, module):
+    intids = getattr(ob, 'intids', None)
+    if intids is not None:
+        # WeakRefTreeSet
+        ob = intids()
+        if isinstance(ob, module.TreeSet):
+            return ob
+    elif _module_of(ob) is not None:
+        ob = ob.keys()
+    return module.Set(ob)
+
+
+def _present(obs):
+    return [ob for ob in obs if ob is not None]
+
+
+def _new_set(module, ob):
+    # A union with an empty set makes a new set, even of the keys of
+    # a mapping.
+    return module.union(module.Set(), ob)
+
+
+def union(*sets):
+    """
+    Return the set of ids in any of *sets*.
+
+    Three or more sets are combined in a single pass with
+    ``multiunion``.
+    """
+    sets = _present(sets)
+    if not sets:
+        return None
+    module, sets = _coerce(sets)
+    if len(sets) == 1:
+        return _new_set(module, sets[0])
+    if len(sets) == 2:
+        return module.union(sets[0], sets[1])
+    return module.multiunion(sets)
+
+
+def intersection(*sets):
+    """
+    Return the set of ids in all of *sets*.
+
+    The sets are intersected smallest first, and as soon as the
+    result is empty, the rest are not looked at.
+    """
+    sets = _present(sets)
+    if not sets:
+        return None
+    module, sets = _coerce(sets)
+    if len(sets) == 1:
+        return _new_set(module, sets[0])
+    sets = sorted(sets, key=len)
+    result = module.intersection(sets[0], sets[1])
+    for other in sets[2:]:
+        if not result:
+            break
+        result = module.intersection(result, other)
+    return result
+
+
+def difference(ids, *others):
+    """
+    Return the ids in *ids* that are in none of *others*. If *ids* is
+    a mapping, the result is a mapping with the same values.
+    """
+    if ids is None:
+        return None
+    others = _present(others)
+    module, sets = _coerce([ids] + others)
+    result = sets[0]
+    if not others:
+        # A copy, of the same kind.
+        return module.difference(result, module.Set())
+    for other in sets[1:]:
+        if not result:
+            break
+        result = module.difference(result, other)
+    return result
+
+
+def _weighted(func, pairs):
+    pairs = [(ob, weight) for ob, weight in pairs if ob is not None]
+    if not pairs:
+        return 0, None
+    module = family.IF
+    pairs = [(ob if _module_of(ob) is module else _as_set(ob, module), weight)
+             for ob, weight in pairs]
+    func = getattr(module, func)
+    result, weight = pairs[0]
+    if len(pairs) == 1:
+        return func(None, result, 1, weight)
+    for ob, other_weight in pairs[1:]:
+        # The returned weight applies to the returned result.
+        weight, result = func(result, ob, weight, other_weight)
+    return weight, result
+
+
+def weighted_union(*pairs):
+    """
+    Combine ``(ids, weight)`` *pairs* with :mod:`BTrees`'
+    ``weightedUnion``, using ``family64.IF``: the score of each id is
+    the sum, over the arguments containing it, of its value (1 for
+    sets) times the weight.
+
+    Returns ``(weight, result)`` as ``weightedUnion`` does; the
+    result is a mapping unless every argument was a set.
+    """
+    return _weighted('weightedUnion', pairs)
+
+
+def weighted_intersection(*pairs):
+    """
+    Like :func:`weighted_union`, but with ``weightedIntersection``:
+    only ids in every argument are kept.
+    """
+    return _weighted('weightedIntersection', pairs)
+
+
+def resolve(ids, intids=None, skip_missing=True):
+    """
+    Lazily iterate the objects registered with *ids*, in the order of
+    *ids* (ascending, for the results of the functions here). This is
+    cheapest if *ids* is sorted, because the lookups then walk the
+    ``refs`` BTree in order.
+
+    :keyword intids: The utility to use. By default, the current one
+        is found when iteration starts.
+    :keyword bool skip_missing: If false, ``None`` is produced for ids
+        with no registered object, instead of skipping them.
+    """
+    if intids is None:
+        intids = get_intids()
+    query = intids.queryObject
+    for uid in ids:
+        ob = query(uid)
+        if ob is not None or not skip_missing:
+            yield ob
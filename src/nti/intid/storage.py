@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Alternative storage for the id to object map of an
+:class:`nti.intid.utility.IntIds`.
+
+By default, ``IntIds.refs`` is a single 64-bit ``LOBTree``. Any
+object providing :class:`nti.intid.interfaces.IIntIdRefs` can be used
+instead by passing a factory for it as the *refs_factory* argument of
+:class:`~nti.intid.utility.IntIds`. This module provides two:
+
+- :class:`LargeBucketLOBTree`, an ``LOBTree`` with larger buckets and
+  internal nodes, meaning fewer persistent objects, and so fewer OIDs
+  and pickles to load, for very large catalogs.
+- :class:`ShardedRefs`, which keeps a separate BTree for each shard of
+  the id space (identified by the high bits of the id). Shards can be
+  loaded independently, and writers allocating ids in different
+  shards never modify the same BTree nodes. With the default number
+  of shards, random allocation already keeps concurrent writers
+  apart; with fewer, larger shards,
+  :data:`nti.intid.utility.ALLOCATE_LEASED` does.
+
+The storage used for an existing utility cannot be changed without
+copying every entry.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BTrees
+
+from BTrees.Length import Length
+
+from persistent import Persistent
+
+from zope import interface
+
+from nti.intid.interfaces import IIntIdRefs
+
+__all__ = [
+    'LargeBucketLOBTree',
+    'ShardedRefs',
+]
+
+_LOBTree = BTrees.family64.IO.BTree
+
+
+@interface.implementer(IIntIdRefs)
+class LargeBucketLOBTree(_LOBTree):
+    """
+    An ``LOBTree`` whose buckets hold up to 500 entries (rather than
+    60) and whose internal nodes hold up to 1000 children (rather
+    than 500).
+    """
+    max_leaf_size = 500
+    max_internal_size = 1000
+
+
+@interface.implementer(IIntIdRefs)
+class ShardedRefs(Persistent):
+    """
+    A map from 64-bit ids to objects that keeps a separate BTree for
+    each shard of the id space. Shard *prefix* holds every id whose
+    top :attr:`shard_bits` bits (of the 63 available to non-negative
+    ids) equal *prefix*.
+
+    Shards are created when their first id is stored. Empty shards
+    are kept. The length is kept in a
+    :class:`BTrees.Length.Length`, so it does not require loading
+    every shard.
+
+    Negative ids are not supported.
+    """
+
+    family = BTrees.family64
+
+    #: How many of the high bits of an id pick its shard. The lease
+    #: table of a utility using these refs leases the same shards
+    #: (see :attr:`nti.intid.leases.IdLeaseTable.prefix_bits`).
+    shard_bits = 16
+
+    #: The callable used to create each shard.
+    shard_factory = _LOBTree
+
+    def __init__(self, shard_bits=None, shard_factory=None):
+        if shard_bits is not None:
+            if not 1 <= shard_bits <= 32:
+                raise ValueError("Shard bits must be between 1 and 32", shard_bits)
+            self.shard_bits = shard_bits
+        if shard_factory is not None:
+            self.shard_factory = shard_factory
+        # prefix -> BTree
+        self._shards = self.family.IO.BTree()
+        self._length = Length()
+
+    def _prefix(self, uid):
+        if uid < 0:
+            raise KeyError(uid)
+        return uid >> (63 - self.shard_bits)
+
+    def _shard(self, uid):
+        return self._shards.get(self._prefix(uid))
+
+    def _shards_between(self, min_id, max_id):
+        """
+        Iterate the shards that may contain ids between *min_id* and
+        *max_id*, either of which may be ``None``, in ascending order.
+        """
+        shift = 63 - self.shard_bits
+        min_prefix = max(min_id, 0) >> shift if min_id is not None else None
+        max_prefix = max(max_id, 0) >> shift if max_id is not None else None
+        return self._shards.itervalues(min_prefix, max_prefix)
+
+    # Reading
+
+    def __getitem__(self, uid):
+        shard = self._shard(uid)
+        if shard is None:
+            raise KeyError(uid)
+        return shard[uid]
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def __contains__(self, uid):
+        try:
+            shard = self._shard(uid)
+        except KeyError:
+            return False
+        return shard is not None and uid in shard
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._length()
+
+    def __bool__(self):
+        return bool(len(self))
+
+    def iteritems(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        for shard in self._shards_between(min, max):
+            for item in shard.iteritems(min, max,
+                                        excludemin=excludemin, excludemax=excludemax):
+                yield item
+
+    def iterkeys(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        for uid, _ in self.iteritems(min, max, excludemin, excludemax):
+            yield uid
+
+    def itervalues(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        for _, value in self.iteritems(min, max, excludemin, excludemax):
+            yield value
+
+    __iter__ = iterkeys
+
+    def items(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        return list(self.iteritems(min, max, excludemin, excludemax))
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        return list(self.iterkeys(min, max, excludemin, excludemax))
+
+    def values(self, min=None, max=None, excludemin=False, excludemax=False):
+        # pylint:disable=redefined-builtin
+        return list(self.itervalues(min, max, excludemin, excludemax))
+
+    def minKey(self, min=None):
+        """
+        Return the smallest id that is at least *min*.
+
+        :raises ValueError: If there is none.
+        """
+        # pylint:disable=redefined-builtin
+        for shard in self._shards_between(min, None):
+            try:
+                return shard.minKey(min)
+            except ValueError:
+                continue
+        raise ValueError("no key satisfies the conditions")
+
+    def maxKey(self, max=None):
+        """
+        Return the largest id that is at most *max*.
+
+        :raises ValueError: If there is none.
+        """
+        # pylint:disable=redefined-builtin
+        if max is not None and max < 0:
+            raise ValueError("no key satisfies the conditions")
+        shards = self._shards.values(None, max >> (63 - self.shard_bits)
+                                     if max is not None else None)
+        for i in range(len(shards) - 1, -1, -1):
+            try:
+                return shards[i].maxKey(max)
+            except ValueError:
+                continue
+        raise ValueError("no key satisfies the conditions")
+
+    # Writing
+
+    def __setitem__(self, uid, ob):
+        prefix = self._prefix(uid)
+        shard = self._shards.get(prefix)
+        if shard is None:
+            shard = self._shards[prefix] = self.shard_factory()
+        if shard.insert(uid, ob):
+            self._length.change(1)
+        else:
+            shard[uid] = ob
+
+    def __delitem__(self, uid):
+        shard = self._shard(uid)
+        if shard is None:
+            raise KeyError(uid)
+        del shard[uid]
+        self._length.change(-1)
+
+    def shard_count(self):
+        """
+        Return how many shards have been created.
+        """
+        return len(self._shards)
+
+    def __repr__(self):
+        return "<%s.%s %d ids in %d shards>" % (self.__class__.__module__,
+                                                self.__class__.__name__,
+                                                len(self), self.shard_count())
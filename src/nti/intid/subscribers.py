@@ -4,18 +4,196 @@
 Subscribers for events.
 
 These are configured by loading this packages's ``configure.zcml``.
+
+:func:`subscriberEventNotify` finds the subscribers for each event's
+object and the event itself in the current site manager. The answer
+is remembered on the site manager for each pair of the interfaces
+provided by the object and the event, and forgotten when the site
+manager's adapter registry changes (in this process or, for
+persistent sites, in another; see :mod:`nti.intid.lookup`), so
+sending many events for objects of the same kinds costs a single
+lookup. The time
+taken by each subscriber can be measured with
+:mod:`nti.intid.instrumentation`.
+
+Batched events
+==============
+
+Bulk operations send a :class:`zc.intid.interfaces.ISubscriberEvent`
+for each of thousands of objects, and handlers such as catalog
+indexers do much of their work again for each one. After
+:func:`batch_events` is called, the handlers of the current
+transaction's events that are declared with :func:`batch_handler`
+are not called at once; the events are queued and each such handler
+is called once with all of its events when the transaction is about
+to commit (or when :func:`flush_events` is called). Other handlers
+are still called at once. If the transaction is aborted, the queued
+events are discarded.
 """
 
 from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import functools
+
+from weakref import WeakKeyDictionary
+
+import transaction
+
+from transaction.interfaces import NoTransaction
+
 from zope import component
 
-from zope.component import handle
+from zope.interface import providedBy
 
 from zc.intid.interfaces import ISubscriberEvent
 
+from nti.intid import lookup as _lookup
+
+__all__ = [
+    'subscriberEventNotify',
+    'batch_handler',
+    'batch_events',
+    'flush_events',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+# transaction -> _EventQueue, for the transactions batching events.
+# When this is empty, as it usually is, events are dispatched without
+# looking up the transaction.
+_queues = WeakKeyDictionary()
+
+_HANDLERS_ATTR = '_v_nti_intid_handlers'
+
+
+class _BatchHandler(object):
+    """
+    A subscriber that can be given many events at once.
+    """
+
+    def __init__(self, func):
+        self.batch = func
+        functools.update_wrapper(self, func)
+
+    def __call__(self, ob, event):
+        self.batch([(ob, event)])
+
+
+def batch_handler(func):
+    """
+    Decorate the function *func*, which takes a list of ``(object,
+    event)`` pairs, so that it can be registered as a subscriber for
+    ``(object, event)`` like any other. It is called with a single
+    pair for each event, unless :func:`batch_events` was called for
+    the transaction, in which case it is called with all of them
+    together when they are flushed.
+    """
+    return _BatchHandler(func)
+
+
+def _handlers_for(ob, event):
+    """
+    Return the subscribers for *ob* and *event* in the current site.
+    """
+    sm = component.getSiteManager()
+    try:
+        key, cache = getattr(sm, _HANDLERS_ATTR)
+    except AttributeError:
+        key = cache = None
+    current = _lookup._cache_key(sm.adapters) # pylint:disable=protected-access
+    if key != current:
+        cache = {}
+        try:
+            setattr(sm, _HANDLERS_ATTR, (current, cache))
+        except AttributeError: # pragma: no cover
+            pass
+    key = (providedBy(ob), providedBy(event))
+    try:
+        return cache[key]
+    except KeyError:
+        handlers = cache[key] = tuple(sm.adapters.subscriptions(key, None))
+        return handlers
+
+
+class _EventQueue(object):
+
+    def __init__(self):
+        # handler -> [(object, event), ...], in order of first event.
+        self.pending = {}
+
+    def add(self, handler, ob, event):
+        self.pending.setdefault(handler, []).append((ob, event))
+
+    def flush(self):
+        # Handlers may send more events.
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            for handler, items in pending.items():
+                _run_batch(handler, items)
+
+
+def _run_batch(handler, items):
+    handler.batch(items)
+
+
+def batch_events(txn=None):
+    """
+    Queue the events for batch handlers in the transaction *txn*
+    (by default, the current transaction), until it commits or
+    :func:`flush_events` is called. Calling this again for the same
+    transaction does nothing.
+    """
+    if txn is None:
+        txn = transaction.get()
+    if txn not in _queues:
+        queue = _queues[txn] = _EventQueue()
+        txn.addBeforeCommitHook(_before_commit, (txn, queue))
+        # The hooks refer to txn, so it would otherwise stay in
+        # _queues until the cycle is collected.
+        txn.addAfterCommitHook(_after_commit, (txn,))
+        txn.addAfterAbortHook(_discard_queue, (txn,))
+
+
+def _before_commit(txn, queue):
+    queue.flush()
+    # Events sent by later hooks are dispatched at once.
+    _discard_queue(txn)
+
+
+def _after_commit(_status, txn):
+    # Even if a before-commit hook failed before ours ran.
+    _discard_queue(txn)
+
+
+def _discard_queue(txn):
+    _queues.pop(txn, None)
+
+
+def flush_events(txn=None):
+    """
+    Call the batch handlers with the events queued so far in *txn*
+    (by default, the current transaction). Events sent after this
+    are still queued.
+    """
+    if txn is None:
+        txn = transaction.get()
+    queue = _queues.get(txn)
+    if queue is not None:
+        queue.flush()
+
+
+def _dispatch(handlers, ob, event, queue):
+    """
+    Call, or queue, each of *handlers*.
+    """
+    for handler in handlers:
+        if queue is not None and isinstance(handler, _BatchHandler):
+            queue.add(handler, ob, event)
+        else:
+            handler(ob, event)
+
 
 @component.adapter(ISubscriberEvent)
 def subscriberEventNotify(event):
@@ -26,4 +204,14 @@ def subscriberEventNotify(event):
 
     The adapters are registered on ``event.object, event``.
     """
-    handle(event.object, event)
+    ob = event.object
+    handlers = _handlers_for(ob, event)
+    if not handlers:
+        return
+    queue = None
+    if _queues:
+        try:
+            queue = _queues.get(transaction.get())
+        except NoTransaction:
+            pass
+    _dispatch(handlers, ob, event, queue)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Support for testing code that uses intids.
+
+This module requires :mod:`ZODB` and :mod:`transaction`, which are
+only installed with the ``test`` extra.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BTrees
+
+import transaction
+
+from persistent import Persistent
+
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.POSException import ConflictError
+
+from nti.intid.utility import IntIds
+from nti.intid.utility import ALLOCATIONS
+from nti.intid.utility import ALLOCATE_RANDOM
+
+__all__ = [
+    'ConflictReport',
+    'simulate_concurrent_registrations',
+    'compare_conflict_rates',
+]
+
+
+class Registered(Persistent):
+    """
+    A trivial object to register.
+    """
+
+
+class ConflictReport(object):
+    """
+    The outcome of :func:`simulate_concurrent_registrations`.
+    """
+
+    def __init__(self, id_allocation, commits=0, conflicts=0, refs_factory=None):
+        self.id_allocation = id_allocation
+        self.refs_factory = refs_factory
+        self.commits = commits
+        self.conflicts = conflicts
+
+    @property
+    def attempts(self):
+        return self.commits + self.conflicts
+
+    @property
+    def conflict_rate(self):
+        return self.conflicts / self.attempts if self.attempts else 0.0
+
+    def __repr__(self):
+        return "<%s.%s %s%s: %d/%d conflicted (%.1f%%)>" % (
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.id_allocation,
+            ' ' + getattr(self.refs_factory, '__name__', repr(self.refs_factory))
+            if self.refs_factory is not None else '',
+            self.conflicts, self.attempts,
+            self.conflict_rate * 100
+        )
+
+
+def simulate_concurrent_registrations(writers=4, rounds=20, objects_per_transaction=20,
+                                      id_allocation=ALLOCATE_RANDOM,
+                                      storage_factory=DemoStorage,
+                                      refs_factory=None):
+    """
+    Simulate *writers* connections, each with its own transaction
+    manager, registering objects at the same time, and report how
+    often their transactions conflict.
+
+    In each of *rounds*, every writer begins a transaction and
+    registers *objects_per_transaction* new objects; then the
+    writers commit one after the other. A writer whose commit
+    conflicts aborts and does not retry. Because every writer's
+    transaction overlaps every other's, this is a worst case.
+
+    The storage returned by *storage_factory* must support conflict
+    resolution. The default, a :class:`~ZODB.DemoStorage.DemoStorage`
+    over a :class:`~ZODB.MappingStorage.MappingStorage`, does; so
+    does :class:`~ZODB.FileStorage.FileStorage`.
+
+    *refs_factory* is passed to the :class:`~nti.intid.utility.IntIds`;
+    see :mod:`nti.intid.storage`.
+
+    :return: A :class:`ConflictReport`.
+    """
+    # pylint:disable=too-many-arguments,too-many-locals
+    report = ConflictReport(id_allocation, refs_factory=refs_factory)
+    db = DB(storage_factory())
+    try:
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        conn.root()['intids'] = IntIds('_ds_intid', family=BTrees.family64,
+                                       id_allocation=id_allocation,
+                                       refs_factory=refs_factory)
+        txm.commit()
+        conn.close()
+
+        managers = [transaction.TransactionManager() for _ in range(writers)]
+        connections = [db.open(txm) for txm in managers]
+        for _ in range(rounds):
+            for txm, conn in zip(managers, connections):
+                txm.begin()
+                intids = conn.root()['intids']
+                for _ in range(objects_per_transaction):
+                    ob = Registered()
+                    conn.add(ob)
+                    intids.register(ob)
+            for txm in managers:
+                try:
+                    txm.commit()
+                except ConflictError:
+                    txm.abort()
+                    report.conflicts += 1
+                else:
+                    report.commits += 1
+        for conn in connections:
+            conn.close()
+    finally:
+        db.close()
+    return report
+
+
+def compare_conflict_rates(allocations=ALLOCATIONS, **kwargs):
+    """
+    Run :func:`simulate_concurrent_registrations` for each id
+    allocation strategy in *allocations*, and return a list of the
+    reports.
+
+    Keyword arguments are passed through.
+    """
+    return [simulate_concurrent_registrations(id_allocation=allocation, **kwargs)
+            for allocation in allocations]
+
+
+if __name__ == '__main__': # pragma: no cover
+    from nti.intid.storage import ShardedRefs
+    for r in compare_conflict_rates() + compare_conflict_rates(refs_factory=ShardedRefs):
+        print(r)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import asyncio
+import operator
+import threading
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import assert_that
+
+from nti.intid.aio import AsyncIntIds
+
+from nti.intid.benchmark import Fixture
+
+from nti.intid.wref import WeakRef
+
+_oid = operator.attrgetter('_p_oid')
+
+
+class TestAsyncIntIds(unittest.TestCase):
+
+    def setUp(self):
+        self.fixture = Fixture(30, sample=30)
+        self.lookups = AsyncIntIds(self.fixture.db, 'intids', max_workers=2,
+                                   max_concurrency=1, batch_size=7)
+
+    def tearDown(self):
+        self.lookups.close()
+        self.fixture.close()
+
+    def _oids(self, obs):
+        return [getattr(ob, '_p_oid', None) for ob in obs]
+
+    def test_get_objects(self):
+        ids = list(reversed(self.fixture.ids)) + [-1]
+        oids = asyncio.run(self.lookups.get_objects(ids, _oid))
+        expected = list(reversed(self.fixture.objects)) + [None]
+        assert_that(oids, is_(self._oids(expected)))
+
+    def test_activated(self):
+        def state(ob):
+            # Loaded from another connection, and not a ghost.
+            return ob._p_jar is not self.fixture.connection, ob._p_changed
+        states = asyncio.run(self.lookups.get_objects(self.fixture.ids, state))
+        assert_that(states, is_([(True, False)] * 30))
+
+    def test_func(self):
+        threads = asyncio.run(self.lookups.get_objects(self.fixture.ids[:10] + [-1],
+                                                       lambda ob: threading.get_ident()))
+        assert_that(threads[-1], is_(none()))
+        assert_that(threading.get_ident() in threads, is_(False))
+        assert_that(len(self.lookups._connections) <= 2, is_(True))
+
+    def test_resolve(self):
+        refs = list(self.fixture.refs)
+        dead = WeakRef.__new__(WeakRef)
+        dead.__setstate__((self.fixture.ids[0], b'\xff' * 8))
+        refs.append(dead)
+        oids = asyncio.run(self.lookups.resolve(refs, _oid))
+        assert_that(oids, is_(self._oids(self.fixture.objects) + [None]))
+        # The caches were left alone.
+        assert_that(dead._v_entity_cache, is_(none()))
+
+    def test_concurrent_calls(self):
+        async def both():
+            return await asyncio.gather(self.lookups.get_objects(self.fixture.ids, _oid),
+                                        self.lookups.resolve(self.fixture.refs, _oid))
+        by_id, by_ref = asyncio.run(both())
+        assert_that(by_id, is_(by_ref))
+
+    def test_batch_size(self):
+        assert_that(calling(AsyncIntIds).with_args(None, batch_size=0),
+                    raises(ValueError))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import io
+import os
+import sys
+import shutil
+import argparse
+import contextlib
+import subprocess
+import tempfile
+import unittest
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import less_than
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import greater_than_or_equal_to
+
+import pyperf
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from nti.intid import benchmark
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_benchmarks_run(self):
+        fixture = benchmark.Fixture(50, sample=10)
+        try:
+            assert_that(fixture.intids, has_length(50))
+            assert_that(fixture.refs, has_length(10))
+            for _, func, kwargs in benchmark.BENCHMARKS:
+                elapsed = func(3, fixture, **kwargs)
+                assert_that(elapsed, is_(greater_than_or_equal_to(0)))
+            # register and unregister left nothing behind
+            assert_that(fixture.intids, has_length(50))
+        finally:
+            fixture.close()
+        assert_that(component.queryUtility(IIntIds), is_(None))
+
+    def test_file_storage_reused(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            fixtures = benchmark._LazyFixtures(os.path.join(tmp, 'bench'), 5)
+            fixture = fixtures.get(20)
+            assert_that(fixtures.get(20), is_(fixture))
+            first = sorted(fixture.intids.refs.keys())
+            fixtures.close()
+
+            fixtures = benchmark._LazyFixtures(os.path.join(tmp, 'bench'), 5)
+            fixture = fixtures.get(20)
+            assert_that(sorted(fixture.intids.refs.keys()), is_(first))
+            fixtures.close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestMain(unittest.TestCase):
+
+    def _main(self, *argv):
+        # pyperf allows one runner per process.
+        self.addCleanup(pyperf.Runner._created.clear)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            benchmark.main(list(argv))
+        return out.getvalue()
+
+    def test_worker(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        results = os.path.join(tmp, 'results.json')
+        out = self._main('--worker', '--loops', '1', '--values', '1', '--warmups', '0',
+                         '--sizes', '20', '--sample', '5', '-o', results)
+        assert_that(out, contains_string('getObject_20: '))
+        suite = pyperf.BenchmarkSuite.load(results)
+        assert_that(suite.get_benchmark_names(), has_length(len(benchmark.BENCHMARKS)))
+
+    def test_import_time(self):
+        modules = benchmark.IMPORT_TIME_MODULES
+        benchmark.IMPORT_TIME_MODULES = ('nti.intid.interfaces',)
+        try:
+            out = self._main('--import-time')
+        finally:
+            benchmark.IMPORT_TIME_MODULES = modules
+        assert_that(out, contains_string('nti.intid.interfaces'))
+        assert_that(out, contains_string(' ms\n'))
+
+    def test_worker_arguments(self):
+        args = argparse.Namespace(sizes='20', sample=5, storage=None)
+        cmd = []
+        benchmark._add_cmdline_args(cmd, args)
+        assert_that(cmd, is_(['--sizes', '20', '--sample', '5']))
+        args.storage = 'bench'
+        benchmark._add_cmdline_args(cmd, args)
+        assert_that(cmd[-2:], is_(['--storage', 'bench']))
+
+
+class TestImportTime(unittest.TestCase):
+
+    #: Modules that are only imported when needed.
+    lazy = ('Acquisition', 'nti.externalization', 'nti.ntiids', 'nti.intid.leases')
+
+    def test_lazy_imports(self):
+        code = ('import sys, nti.intid.utility, nti.intid.wref; '
+                'print(" ".join(m for m in %r if m in sys.modules))' % (self.lazy,))
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      universal_newlines=True)
+        assert_that(out.strip(), is_(''))
+
+    def test_parse(self):
+        output = ('import time: self [us] | cumulative | imported package\n'
+                  'Some warning\n'
+                  'import time:       120 |        350 | nti.intid\n')
+        assert_that(benchmark._parse_import_times(output), is_({'nti.intid': 0.00035}))
+
+    def test_budget(self):
+        # What importing the package costs beyond zc.intid, which it
+        # can't do without, must be small. Comparing the two keeps
+        # this independent of the speed of the machine.
+        def overhead():
+            times = benchmark.import_times('nti.intid.wref')
+            return times['nti.intid.wref'] - times['zc.intid'], times['zc.intid']
+        ours, required = min(overhead() for _ in range(3))
+        assert_that(ours, is_(less_than(required / 2)))
+        assert_that(benchmark.import_time('nti.intid', runs=1),
+                    is_(greater_than_or_equal_to(0)))
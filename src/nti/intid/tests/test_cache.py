@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_entry
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_string
+
+import BTrees
+
+import transaction
+
+from ZODB import DB
+
+from zope.intid.interfaces import ObjectMissingError
+
+from nti.intid import cache
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+from nti.intid.utility import ALLOCATE_MONOTONIC
+
+
+class TestObjectIdCache(unittest.TestCase):
+
+    def test_lru(self):
+        c = cache.ObjectIdCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        assert_that(c.get('a'), is_(1))
+        c.set('c', 3)
+        # b was least recently used
+        assert_that(c.get('b'), is_(none()))
+        assert_that(c.get('c'), is_(3))
+        # Lookups are counted by the caller.
+        assert_that(c.hits + c.misses, is_(0))
+        c.record(True)
+        c.record(True)
+        c.record(False)
+        c.invalidate('c')
+        c.invalidate('c')
+        assert_that(c, has_length(1))
+
+        stats = c.stats()
+        assert_that(stats, has_entry('hits', 2))
+        assert_that(stats, has_entry('misses', 1))
+        assert_that(stats, has_entry('evictions', 1))
+        assert_that(stats, has_entry('invalidations', 1))
+        assert_that(c.hit_rate, is_(2 / 3))
+        assert_that(repr(c), contains_string('1/2'))
+
+        c.clear()
+        assert_that(c, has_length(0))
+        assert_that(cache.ObjectIdCache(1).hit_rate, is_(0.0))
+        assert_that(calling(cache.ObjectIdCache).with_args(0), raises(ValueError))
+
+    def test_enable_disable(self):
+        c = cache.enable(5)
+        try:
+            assert_that(cache.get_cache(), is_(c))
+            assert_that(c.maxsize, is_(5))
+        finally:
+            cache.disable()
+        assert_that(cache.get_cache(), is_(none()))
+
+
+class TestCachedLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.enable(100)
+        self.db = DB(None)
+        self.txm = transaction.TransactionManager()
+        self.conn = self.db.open(self.txm)
+        self.intids = IntIds('_ds_id', family=BTrees.family64)
+        self.conn.root()['intids'] = self.intids
+        self.ob = Registered()
+        self.conn.add(self.ob)
+        self.uid = self.intids.register(self.ob)
+        self.txm.commit()
+
+    def tearDown(self):
+        cache.disable()
+        self.txm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_hit(self):
+        assert_that(self.intids.getObject(self.uid), is_(self.ob))
+        assert_that(self.cache.misses, is_(1))
+        assert_that(self.intids.getObject(self.uid), is_(self.ob))
+        assert_that(self.intids.queryObject(self.uid), is_(self.ob))
+        assert_that(self.cache.hits, is_(2))
+        # Shared once the transaction commits.
+        assert_that(self.cache, has_length(0))
+        self.txm.commit()
+        assert_that(self.cache, has_length(1))
+
+        # Still found in a new connection, as that connection's object
+        txm = transaction.TransactionManager()
+        conn = self.db.open(txm)
+        try:
+            intids = conn.root()['intids']
+            ob = intids.getObject(self.uid)
+            assert_that(ob._p_jar, is_(conn))
+            assert_that(ob._p_oid, is_(self.ob._p_oid))
+            assert_that(self.cache.hits, is_(3))
+        finally:
+            txm.abort()
+            conn.close()
+
+    def test_query_missing(self):
+        assert_that(self.intids.queryObject(self.uid + 1), is_(none()))
+        assert_that(self.intids.queryObject(self.uid + 1, 42), is_(42))
+        assert_that(self.intids.queryObject(self.uid), is_(self.ob))
+        self.txm.commit()
+        assert_that(self.cache, has_length(1))
+
+    def test_aborted_not_cached(self):
+        self.intids.getObject(self.uid)
+        self.txm.abort()
+        assert_that(self.cache, has_length(0))
+
+    def test_unregister_invalidates(self):
+        self.intids.getObject(self.uid)
+        self.txm.commit()
+        self.intids.unregister(self.ob)
+        assert_that(self.cache, has_length(0))
+        assert_that(calling(self.intids.getObject).with_args(self.uid),
+                    raises(ObjectMissingError))
+
+    def test_force_unregister_invalidates(self):
+        self.intids.getObject(self.uid)
+        self.txm.commit()
+        self.intids.force_unregister(self.uid, self.ob, remove_attribute=False)
+        assert_that(self.cache, has_length(0))
+        assert_that(self.intids.queryObject(self.uid), is_(none()))
+
+        other = Registered()
+        self.intids.force_register(self.uid, other)
+        assert_that(self.intids.queryObject(self.uid), is_(other))
+        self.intids.force_register(self.uid, self.ob, check=False)
+        assert_that(self.intids.queryObject(self.uid), is_(self.ob))
+
+    def test_changes_elsewhere_are_noticed(self):
+        self.intids.getObject(self.uid)
+        self.txm.commit()
+
+        # Another process, which does not share our cache.
+        cache.object_cache = None
+        txm = transaction.TransactionManager()
+        conn = self.db.open(txm)
+        try:
+            intids = conn.root()['intids']
+            # As check._repair does: the old object keeps its id
+            # attribute.
+            intids.force_unregister(self.uid)
+            other = Registered()
+            conn.add(other)
+            intids.force_register(self.uid, other)
+            txm.commit()
+            other_oid = other._p_oid
+        finally:
+            conn.close()
+            cache.object_cache = self.cache
+
+        # Our entry is still valid in our old view...
+        assert_that(self.intids.getObject(self.uid), is_(self.ob))
+        assert_that((self.cache.hits, self.cache.misses), is_((1, 1)))
+        self.txm.begin()
+        # ...but not once we see the change.
+        ob = self.intids.getObject(self.uid)
+        assert_that(ob._p_oid, is_(other_oid))
+        assert_that(self.cache.invalidations, is_(1))
+        assert_that((self.cache.hits, self.cache.misses), is_((1, 2)))
+        assert_that(self.intids.getObject(self.uid), is_(ob))
+
+    def test_missing_object(self):
+        key = self.intids._object_cache_key(self.uid)
+        self.cache.set(key, (self.db.database_name, b'\xff' * 8, 0, 1))
+        assert_that(self.intids.getObject(self.uid), is_(self.ob))
+        assert_that(self.cache.invalidations, is_(1))
+        assert_that((self.cache.hits, self.cache.misses), is_((0, 1)))
+
+    def _add(self, ob):
+        self.conn.add(ob)
+        return ob
+
+    def test_registered_then_aborted(self):
+        intids = self.conn.root()['monotonic'] = IntIds('_ds_id',
+                                                        id_allocation=ALLOCATE_MONOTONIC)
+        p = self._add(Registered())
+        self.txm.commit()
+        uid = intids.register(p)
+        intids.getObject(uid)
+        self.txm.abort()
+
+        q = self._add(Registered())
+        assert_that(intids.register(q), is_(uid))
+        assert_that(intids.getObject(uid), is_(q))
+        self.txm.commit()
+        assert_that(intids.getObject(uid), is_(q))
+        self.txm.commit()
+        txm = transaction.TransactionManager()
+        conn = self.db.open(txm)
+        try:
+            ob = conn.root()['monotonic'].getObject(uid)
+            assert_that(ob._p_oid, is_(q._p_oid))
+        finally:
+            txm.abort()
+            conn.close()
+
+    def test_force_registered_then_aborted(self):
+        p = self._add(Registered())
+        self.txm.commit()
+        self.intids.force_register(42, p)
+        self.intids.getObject(42)
+        self.txm.abort()
+        q = self._add(Registered())
+        self.intids.force_register(42, q)
+        assert_that(self.intids.getObject(42), is_(q))
+        self.txm.commit()
+        assert_that(self.cache, has_length(0))
+
+    def test_changing_transaction_not_cached(self):
+        # Looked up before, and after, registering.
+        self.intids.getObject(self.uid)
+        self.intids.register(self._add(Registered()))
+        self.intids.getObject(self.uid)
+        self.txm.commit()
+        assert_that(self.cache, has_length(0))
+
+    def test_older_view(self):
+        ob = self._add(Registered())
+        self.txm.commit()
+        # A connection whose view is from before the registration...
+        txm = transaction.TransactionManager()
+        conn = self.db.open(txm)
+        try:
+            old = conn.root()['intids']
+            uid = self.intids.register(ob)
+            self.txm.commit()
+            # ...while another one caches it.
+            self.intids.getObject(uid)
+            self.txm.commit()
+            assert_that(self.cache, has_length(1))
+
+            assert_that(old.queryObject(uid), is_(none()))
+            # The entry is still good for newer views.
+            assert_that(self.cache, has_length(1))
+            assert_that(self.cache.hits, is_(0))
+            txm.begin()
+            assert_that(old.queryObject(uid)._p_oid, is_(ob._p_oid))
+            assert_that(self.cache.hits, is_(1))
+        finally:
+            txm.abort()
+            conn.close()
+
+    def test_unsaved_not_cached(self):
+        intids = IntIds('_ds_id')
+        ob = Registered()
+        uid = intids.register(ob)
+        assert_that(intids.getObject(uid), is_(ob))
+        intids.unregister(ob)
+        assert_that(self.cache, has_length(0))
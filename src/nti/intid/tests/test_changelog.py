@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_string
+
+import transaction
+
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from nti.intid.changelog import ADDED
+from nti.intid.changelog import REMOVED
+from nti.intid.changelog import ChangeLog
+from nti.intid.changelog import ChangesCompacted
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(MappingStorage())
+        self.txm = transaction.TransactionManager()
+        self.conn = self.db.open(self.txm)
+        self.intids = IntIds('_ds_id', changelog=True)
+        self.conn.root()['intids'] = self.intids
+        self.txm.commit()
+
+    def tearDown(self):
+        self.txm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def _changes(self, cursor=0):
+        return [(number, op, uid)
+                for number, _, op, uid in self.intids.changelog.changes_since(cursor)]
+
+    def test_disabled(self):
+        intids = IntIds('_ds_id')
+        assert_that(intids.changelog, is_(none()))
+        intids.register(Registered())
+        intids.enable_changelog(10)
+        changelog = intids.changelog
+        assert_that(changelog.max_records, is_(10))
+        intids.enable_changelog()
+        assert_that(intids.changelog, is_(changelog))
+
+    def test_committed(self):
+        first, second = Registered(), Registered()
+        uid = self.intids.register(first)
+        # Registering again is not a change.
+        self.intids.register(first)
+        uids = self.intids.register_many([first, second])
+        self.intids.unregister(first)
+        assert_that(self._changes(), is_([]))
+        self.txm.commit()
+
+        changelog = self.intids.changelog
+        assert_that(self._changes(), is_([(1, ADDED, uid),
+                                          (2, ADDED, uids[1]),
+                                          (3, REMOVED, uid)]))
+        tids = set(tid for _, tid, _, _ in changelog.changes_since())
+        assert_that(tids, is_({changelog._batches[1]._p_serial}))
+        assert_that(tids, is_({self.db.lastTransaction()}))
+        assert_that(changelog, has_length(3))
+        assert_that(repr(changelog), contains_string('records=1-3'))
+
+    def test_aborted(self):
+        self.intids.register(Registered())
+        self.txm.abort()
+        assert_that(self._changes(), is_([]))
+        # Nothing is left to be written by a later transaction.
+        self.intids.register(Registered())
+        self.txm.commit()
+        assert_that(self._changes(), has_length(1))
+
+    def test_savepoints(self):
+        # A savepoint from before the first change.
+        savepoint = self.txm.savepoint()
+        self.intids.register(Registered())
+        savepoint.rollback()
+        uid = self.intids.register(Registered())
+        savepoint = self.txm.savepoint()
+        self.intids.register(Registered())
+        savepoint.rollback()
+        self.txm.commit()
+        assert_that(self._changes(), is_([(1, ADDED, uid)]))
+
+    def test_later_hooks(self):
+        first = self.intids.register(Registered())
+        uids = []
+        self.txm.get().addBeforeCommitHook(
+            lambda: uids.append(self.intids.register(Registered())))
+        self.txm.commit()
+        assert_that(self._changes(), is_([(1, ADDED, first),
+                                          (2, ADDED, uids[0])]))
+        assert_that(list(self.intids.changelog._batches), is_([1, 2]))
+
+    def test_after_hooks(self):
+        test = self
+
+        class Synchronizer(object):
+
+            def beforeCompletion(self, txn):
+                test.intids.register(Registered())
+
+            def afterCompletion(self, txn):
+                pass
+
+            newTransaction = afterCompletion
+
+        synchronizer = Synchronizer()
+        self.txm.registerSynch(synchronizer)
+        try:
+            self.intids.register(Registered())
+            assert_that(calling(self.txm.commit), raises(ValueError, 'after'))
+            assert_that(calling(self.intids.changelog.record).with_args(ADDED, 1),
+                        raises(ValueError, 'committing'))
+        finally:
+            self.txm.unregisterSynch(synchronizer)
+        self.txm.abort()
+        assert_that(self._changes(), is_([]))
+
+    def test_cursor(self):
+        obs = [Registered() for _ in range(4)]
+        uids = []
+        for ob in obs:
+            uids.append(self.intids.register(ob))
+            self.txm.commit()
+        tids = [tid for _, tid, _, _ in self.intids.changelog.changes_since()]
+        assert_that(len(set(tids)), is_(4))
+        assert_that(tids, is_(sorted(tids)))
+        assert_that(self._changes(2), is_([(3, ADDED, uids[2]),
+                                           (4, ADDED, uids[3])]))
+        assert_that(self._changes(4), is_([]))
+
+        self.intids.force_unregister(uids[0])
+        self.intids.force_register(uids[0], obs[0])
+        self.txm.commit()
+        assert_that(self._changes(4), is_([(5, REMOVED, uids[0]),
+                                           (6, ADDED, uids[0])]))
+
+    def test_compact(self):
+        self.intids.changelog.max_records = 3
+        for _ in range(3):
+            self.intids.register_many([Registered(), Registered()])
+            self.txm.commit()
+        changelog = self.intids.changelog
+        # The last batch alone would leave too few.
+        assert_that(changelog.first_record, is_(3))
+        assert_that(changelog, has_length(4))
+        assert_that([number for number, _, _ in self._changes(2)], is_([3, 4, 5, 6]))
+        assert_that([number for number, _, _ in self._changes(3)], is_([4, 5, 6]))
+        assert_that(calling(list).with_args(changelog.changes_since(1)),
+                    raises(ChangesCompacted))
+
+    def test_without_database(self):
+        changelog = ChangeLog()
+        changelog.record(ADDED, 1)
+        transaction.commit()
+        assert_that([change[2:] for change in changelog.changes_since()],
+                    is_([(ADDED, 1)]))
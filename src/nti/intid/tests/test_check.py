@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_string
+
+import transaction
+
+from ZODB import DB
+from ZODB.POSException import POSKeyError
+
+from zc.intid.utility import IntIds as ZCIntIds
+
+from nti.intid import check
+
+from nti.intid.parallel import open_database
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+
+
+ZCONFIG = """
+<zodb>
+  <filestorage>
+    path %s
+  </filestorage>
+</zodb>
+"""
+
+
+class Broken(Registered):
+
+    def __getattr__(self, name):
+        raise POSKeyError(name)
+
+
+class TestDiagnose(unittest.TestCase):
+
+    def test_diagnose(self):
+        intids = IntIds('_ds_id')
+        ob = Registered()
+        uid = intids.register(ob)
+        assert_that(check._diagnose(intids, uid, ob), is_(none()))
+        assert_that(check._diagnose(intids, uid, Broken()),
+                    is_(check.Problem(uid, check.BROKEN)))
+
+    def test_diagnose_zc_intids(self):
+        intids = ZCIntIds('_ds_id')
+        ob = Registered()
+        uid = intids.register(ob)
+        assert_that(check._diagnose(intids, uid, ob), is_(none()))
+        ob._ds_id = None
+        assert_that(check._diagnose(intids, uid, ob),
+                    is_(check.Problem(uid, check.MISSING)))
+
+
+class TestCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.zconfig = os.path.join(self.tmp, 'db.conf')
+        with open(self.zconfig, 'w') as f:
+            f.write(ZCONFIG % os.path.join(self.tmp, 'Data.fs'))
+        db = open_database(self.zconfig)
+        try:
+            txm = transaction.TransactionManager()
+            conn = db.open(txm)
+            intids = conn.root()['intids'] = IntIds('_ds_id')
+            obs = [Registered() for _ in range(10)]
+            for ob in obs:
+                conn.add(ob)
+            self.uids = uids = intids.register_many(obs)
+            # Four problems
+            obs[1]._ds_id = None
+            obs[2]._ds_id = uids[2] + 100000
+            intids.force_register(uids[3] + 100000, obs[3])
+            obs[4]._ds_id = uids[5]
+            txm.commit()
+            conn.close()
+        finally:
+            db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _expected(self, repaired=False):
+        uids = self.uids
+        return sorted([
+            check.Problem(uids[1], check.MISSING, None, repaired),
+            check.Problem(uids[2], check.MISMATCH, uids[2] + 100000, repaired),
+            check.Problem(uids[3] + 100000, check.DUPLICATE, uids[3], repaired),
+            check.Problem(uids[4], check.MISMATCH, uids[5], repaired),
+        ], key=lambda p: p.uid)
+
+    def test_check_and_repair(self):
+        report = check.check_intids_parallel(self.zconfig, 'intids', workers=1)
+        assert_that(report.checked, is_(11))
+        assert_that(report.problems, is_(self._expected()))
+        assert_that(repr(report), contains_string('problems=4 repaired=0'))
+
+        report = check.check_intids_parallel(self.zconfig, 'intids', workers=1,
+                                             repair=True, chunk_size=3)
+        assert_that(report.problems, is_(self._expected(True)))
+        assert_that(report.repaired, is_(4))
+
+        report = check.check_intids_parallel(self.zconfig, 'intids', workers=1)
+        assert_that(report.checked, is_(10))
+        assert_that(report.problems, has_length(0))
+
+    def test_check_intids(self):
+        db = open_database(self.zconfig)
+        try:
+            txm = transaction.TransactionManager()
+            conn = db.open(txm)
+            intids = conn.root()['intids']
+            report = check.check_intids(intids, chunk_size=3)
+            assert_that(report.checked, is_(11))
+            assert_that(report.problems, is_(self._expected()))
+
+            report = check.check_intids(intids, min_id=self.uids[2], max_id=self.uids[4])
+            assert_that(report.checked, is_(3))
+            assert_that(report.problems, is_([self._expected()[1], self._expected()[2]]))
+
+            report = check.check_intids(intids, repair=True)
+            assert_that(report.repaired, is_(4))
+            report = check.check_intids(intids)
+            assert_that(report.checked, is_(10))
+            assert_that(report.problems, has_length(0))
+            conn.close()
+        finally:
+            db.close()
+
+    def test_main(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            assert_that(calling(check.main).with_args([self.zconfig, '--site', 'intids',
+                                                       '--json']),
+                        raises(SystemExit))
+        data = json.loads(out.getvalue())
+        assert_that(data['problems'], has_length(4))
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            check.main([self.zconfig, '--repair', '--site', '/intids/'])
+        assert_that(out.getvalue(), contains_string('repaired=4'))
+
+    def test_parallel(self):
+        # A read-only FileStorage can be opened by several processes.
+        with open(self.zconfig) as f:
+            config = f.read()
+        with open(self.zconfig, 'w') as f:
+            f.write(config.replace('</filestorage>', '  read-only true\n  </filestorage>'))
+        report = check.check_intids_parallel(self.zconfig, 'intids', workers=3)
+        assert_that(report.checked, is_(11))
+        assert_that(report.problems, is_(self._expected()))
+
+    def test_find_intids(self):
+        class Site(object):
+            def __init__(self, intids):
+                self.intids = intids
+
+            def getSiteManager(self):
+                return self
+
+            def getUtility(self, _):
+                return self.intids
+
+        intids = IntIds('_ds_id')
+        root = {'a': Site(intids)}
+        assert_that(check.find_intids(root, 'a/intids'), is_(intids))
+        assert_that(check.find_intids(root, 'a'), is_(intids))
+
+
+class TestEmpty(unittest.TestCase):
+
+    def test_empty(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            zconfig = os.path.join(tmp, 'db.conf')
+            with open(zconfig, 'w') as f:
+                f.write(ZCONFIG % os.path.join(tmp, 'Data.fs'))
+            db = DB(open_database(zconfig).storage)
+            txm = transaction.TransactionManager()
+            conn = db.open(txm)
+            conn.root()['intids'] = IntIds('_ds_id')
+            txm.commit()
+            conn.close()
+            db.close()
+            report = check.check_intids_parallel(zconfig, 'intids')
+            assert_that(report.checked, is_(0))
+        finally:
+            shutil.rmtree(tmp)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from hamcrest import is_
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_string
+
+import transaction
+
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from ZODB.POSException import ConflictError
+
+from zc.intid import IIntIds
+
+from zc.intid.interfaces import AfterIdAddedEvent
+from zc.intid.interfaces import IAfterIdAddedEvent
+from zc.intid.interfaces import BeforeIdRemovedEvent
+from zc.intid.interfaces import IBeforeIdRemovedEvent
+
+from zope import component
+
+from zope.event import notify
+
+from zope.interface import Interface
+
+from nti.intid import deferred
+
+from nti.intid.interfaces import IDeferredEventQueue
+
+from nti.intid.testing import Registered
+
+from nti.intid.tests import IntIdTestCase
+
+from nti.intid.utility import IntIds
+
+calls = []
+
+failures = []
+
+stop = threading.Event()
+
+# Called by the next subscriber, after it has changed its object.
+concurrently = []
+
+
+@deferred.deferred_handler
+def added(ob, event):
+    ob.handled = getattr(ob, 'handled', 0) + 1
+    while concurrently:
+        concurrently.pop()()
+    if failures:
+        raise ValueError(failures.pop())
+    calls.append(('added', ob, event))
+    stop.set()
+
+
+@deferred.deferred_handler
+def removed(ob, event):
+    calls.append(('removed', ob, event))
+
+
+class TestDeferred(IntIdTestCase):
+
+    def setUp(self):
+        del calls[:]
+        del failures[:]
+        del concurrently[:]
+        stop.clear()
+        self.intids = IntIds('_ds_id')
+        self.queue = deferred.DeferredEventQueue()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.intids, IIntIds)
+        gsm.registerUtility(self.queue, IDeferredEventQueue)
+        gsm.registerHandler(added, (Interface, IAfterIdAddedEvent))
+        gsm.registerHandler(removed, (Interface, IBeforeIdRemovedEvent))
+
+    def tearDown(self):
+        gsm = component.getGlobalSiteManager()
+        gsm.unregisterUtility(self.intids, IIntIds)
+        gsm.unregisterUtility(self.queue, IDeferredEventQueue)
+        gsm.unregisterHandler(added, (Interface, IAfterIdAddedEvent))
+        gsm.unregisterHandler(removed, (Interface, IBeforeIdRemovedEvent))
+        transaction.abort()
+
+    def _use_database(self):
+        """
+        Replace the utilities by persistent ones, in a database.
+        """
+        db = DB(MappingStorage())
+        self.addCleanup(db.close)
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        self.addCleanup(conn.close)
+        self.addCleanup(txm.abort)
+        root = conn.root()
+        root['intids'] = IntIds('_ds_id')
+        root['queue'] = deferred.DeferredEventQueue()
+        root['ob'] = Registered()
+        gsm = component.getGlobalSiteManager()
+        gsm.unregisterUtility(self.intids, IIntIds)
+        gsm.unregisterUtility(self.queue, IDeferredEventQueue)
+        self.intids = root['intids']
+        self.queue = root['queue']
+        gsm.registerUtility(self.intids, IIntIds)
+        gsm.registerUtility(self.queue, IDeferredEventQueue)
+        self.intids.register(root['ob'])
+        notify(AfterIdAddedEvent(root['ob'], None))
+        txm.commit()
+        return db, conn
+
+    def _committed(self, db):
+        conn = db.open(transaction.TransactionManager())
+        try:
+            root = conn.root()
+            ob = root['ob']
+            return getattr(ob, 'handled', None), list(root['queue']._entries.values())
+        finally:
+            conn.close()
+
+    def _process(self, now=None):
+        return deferred.process_queue(self.queue, self.intids, now=now)
+
+    def test_queued_and_processed(self):
+        ob = Registered()
+        uid = self.intids.register(ob)
+        notify(AfterIdAddedEvent(ob, None))
+        assert_that(calls, is_([]))
+        assert_that(self.queue, has_length(1))
+        assert_that(self.queue.take(now=0), is_([]))
+
+        assert_that(self._process(), is_((1, 0, 0)))
+        assert_that(self.queue, has_length(0))
+        assert_that(calls, has_length(1))
+        kind, found, event = calls[0]
+        assert_that(kind, is_('added'))
+        assert_that(found, is_(ob))
+        assert_that(IAfterIdAddedEvent.providedBy(event), is_(True))
+        assert_that(event.id, is_(uid))
+        assert_that(event.object, is_(ob))
+
+    def test_removed(self):
+        ob = Registered()
+        uid = self.intids.register(ob)
+        notify(BeforeIdRemovedEvent(ob, None))
+        notify(AfterIdAddedEvent(ob, None))
+        self.intids.unregister(ob)
+        # The added event is dropped.
+        assert_that(self._process(), is_((2, 0, 0)))
+        assert_that(calls, has_length(1))
+        kind, found, event = calls[0]
+        assert_that(kind, is_('removed'))
+        assert_that(found, is_(none()))
+        assert_that(event.id, is_(uid))
+
+    def test_not_queued(self):
+        # Objects without ids are handled at once.
+        ob = Registered()
+        notify(AfterIdAddedEvent(ob, None))
+        assert_that(calls, has_length(1))
+        assert_that(self.queue, has_length(0))
+
+    def test_retries(self):
+        ob = Registered()
+        self.intids.register(ob)
+        notify(AfterIdAddedEvent(ob, None))
+        failures.extend(['third', 'second', 'first'])
+        now = 2e9
+        assert_that(self._process(now), is_((0, 1, 0)))
+        # Not due again yet.
+        assert_that(self._process(now), is_((0, 0, 0)))
+        assert_that(self._process(now + 1), is_((0, 1, 0)))
+        assert_that(self._process(now + 3), is_((0, 0, 1)))
+        assert_that(self.queue, has_length(0))
+        assert_that(self.queue.failed, has_length(1))
+        entry = list(self.queue.failed.values())[0]
+        assert_that(entry[3], is_(2))
+        assert_that(entry[4], contains_string('third'))
+        assert_that(repr(self.queue), contains_string('len=0 failed=1'))
+
+    def test_rolled_back_in_database(self):
+        db, conn = self._use_database()
+        uid = self.intids.getId(conn.root()['ob'])
+        handler = deferred._name_of(added)
+        event_type = deferred._name_of(IAfterIdAddedEvent)
+        # The queue was committed with the registration.
+        assert_that(self._committed(db),
+                    is_((None, [(uid, event_type, handler, 0)])))
+
+        failures.append('first')
+        assert_that(deferred._process_site(conn, '', 100, 3, 0), is_(1))
+        # The change made by the failed subscriber was not committed.
+        assert_that(self._committed(db),
+                    is_((None, [(uid, event_type, handler, 1)])))
+        assert_that(calls, is_([]))
+
+        assert_that(deferred._process_site(conn, '', 100, 3, 0), is_(1))
+        assert_that(self._committed(db), is_((1, [])))
+        assert_that(calls, has_length(1))
+
+    def test_conflict(self):
+        db, conn = self._use_database()
+
+        def change():
+            other = db.open(transaction.TransactionManager())
+            try:
+                other.root()['ob'].handled = 42
+                other.transaction_manager.commit()
+            finally:
+                other.close()
+        concurrently.append(change)
+
+        assert_that(deferred._process_site(conn, '', 100, 3, 0), is_(0))
+        # Aborted, so it is still queued.
+        handled, entries = self._committed(db)
+        assert_that(handled, is_(42))
+        assert_that(entries, has_length(1))
+
+        assert_that(deferred._process_site(conn, '', 100, 3, 0), is_(1))
+        assert_that(self._committed(db), is_((43, [])))
+
+    def test_subscriber_conflict(self):
+        ob = Registered()
+        self.intids.register(ob)
+        notify(AfterIdAddedEvent(ob, None))
+
+        def conflict():
+            raise ConflictError()
+        concurrently.append(conflict)
+        assert_that(calling(self._process), raises(ConflictError))
+        # Not retried here; the caller aborts.
+        assert_that(self.queue.failed, has_length(0))
+
+    def test_same_key(self):
+        self.addCleanup(random.setstate, random.getstate())
+        tree = self.queue.family.IO.BTree()
+        random.seed(42)
+        key = self.queue._key(1.0) | random.getrandbits(deferred._RANDOM_BITS)
+        tree[key] = 'first'
+        random.seed(42)
+        self.queue._insert(tree, 1.0, 'second')
+        assert_that(dict(tree), is_({key: 'first', key + 1: 'second'}))
+
+    def test_run_worker_waits(self):
+        db = DB(MappingStorage())
+        timer = threading.Timer(0.05, stop.set)
+        timer.start()
+        try:
+            deferred.run_worker(db, poll_interval=0.01, stop=stop)
+        finally:
+            timer.cancel()
+            db.close()
+        assert_that(calls, is_([]))
+
+    def test_run_worker(self):
+        ob = Registered()
+        self.intids.register(ob)
+        notify(AfterIdAddedEvent(ob, None))
+        db = DB(MappingStorage())
+        try:
+            deferred.run_worker(db, poll_interval=0.01, stop=stop)
+        finally:
+            db.close()
+        assert_that(calls, has_length(1))
+        assert_that(self.queue, has_length(0))
+
+
+class TestMain(unittest.TestCase):
+
+    def test_main(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        zconfig = os.path.join(tmp, 'db.conf')
+        with open(zconfig, 'w') as f:
+            f.write('<zodb>\n<filestorage>\npath %s\n</filestorage>\n</zodb>\n'
+                    % os.path.join(tmp, 'Data.fs'))
+        zcml = os.path.join(tmp, 'subscribers.zcml')
+        with open(zcml, 'w') as f:
+            f.write('<configure xmlns="http://namespaces.zope.org/zope" />\n')
+
+        runs = []
+        def run_worker(db, path, limit, poll_interval):
+            runs.append((db, path, limit, poll_interval))
+            # As from Ctrl-C, which stops the worker quietly.
+            raise KeyboardInterrupt
+
+        original = deferred.run_worker
+        deferred.run_worker = run_worker
+        try:
+            deferred.main([zconfig, '--zcml', zcml, '--site', 'sites/a',
+                           '--batch-size', '10', '--poll-interval', '0.5'])
+        finally:
+            deferred.run_worker = original
+        assert_that(runs, has_length(1))
+        _, path, limit, poll_interval = runs[0]
+        assert_that((path, limit, poll_interval), is_(('sites/a', 10, 0.5)))
+        # Closed when the worker stops, so it can be opened again.
+        deferred.open_database(zconfig).close()
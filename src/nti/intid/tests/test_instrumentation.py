@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_property
+from hamcrest import has_entry
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import same_instance
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from nti.intid import cache
+from nti.intid import instrumentation
+from nti.intid import wref
+
+from nti.intid.testing import Registered
+
+from nti.intid.tests import IntIdTestCase
+
+from nti.intid.utility import IntIds
+
+
+class TestHistogram(IntIdTestCase):
+
+    def test_cumulative(self):
+        h = instrumentation.Histogram((1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            h.observe(value)
+        assert_that(h.cumulative(), is_([(1, 2), (2, 3), (float('inf'), 4)]))
+        assert_that(h.sum, is_(6.0))
+
+
+class TestInstrumentation(IntIdTestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+        super().tearDown()
+
+    def test_enable_disable(self):
+        original = IntIds.__dict__['getObject']
+        recorder = instrumentation.enable(instrumentation.MetricsRecorder())
+        assert_that(instrumentation.get_recorder(), is_(same_instance(recorder)))
+        assert_that(IntIds.__dict__['getObject'], is_not(same_instance(original)))
+        assert_that(IntIds.__dict__['get_id'], is_(same_instance(IntIds.__dict__['getId'])))
+
+        # Enabling again replaces, rather than double-wraps
+        instrumentation.enable(recorder)
+        assert_that(IntIds.__dict__['getObject'].__wrapped__,
+                    is_(same_instance(original)))
+
+        instrumentation.disable()
+        assert_that(instrumentation.get_recorder(), is_(none()))
+        assert_that(IntIds.__dict__['getObject'], is_(same_instance(original)))
+        assert_that(IntIds.__dict__['get_id'], is_(same_instance(IntIds.__dict__['getId'])))
+        assert_that(IntIds.__dict__['getId'], is_not(has_property('__wrapped__')))
+
+    def test_records(self):
+        recorder = instrumentation.enable(instrumentation.MetricsRecorder())
+        intids = IntIds('_ds_id')
+        ob = Registered()
+        uid = intids.register(ob)
+        intids.getObject(uid)
+        intids.get_id(ob)
+        intids.register_many([Registered()])
+
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            ref = wref.WeakRef(ob)
+            ref(allow_cached=False)
+            wref.resolve_many([ref])
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+        assert_that(recorder.calls('intids.register'), is_(1))
+        assert_that(recorder.calls('intids.register_many'), is_(1))
+        assert_that(recorder.calls('intids.getObject'), is_(1))
+        # Including the one made by the WeakRef constructor
+        assert_that(recorder.calls('intids.getId'), is_(2))
+        # Nested calls are counted as part of the outer call
+        assert_that(recorder.calls('intids.queryId'), is_(0))
+        assert_that(recorder.calls('intids.unregister'), is_(0))
+        # resolve_many's own dereference is part of resolve_many
+        assert_that(recorder.calls('wref.dereference'), is_(1))
+        assert_that(recorder.calls('wref.resolve_many'), is_(1))
+        assert_that(recorder.counters, has_entry('intids.allocation_probe', 2))
+
+        snapshot = recorder.snapshot()
+        assert_that(snapshot['operations']['intids.register'], has_entry('count', 1))
+
+        text = instrumentation.format_prometheus(recorder)
+        assert_that(text, contains_string(
+            'nti_intid_operation_seconds_count{operation="intids.register"} 1\n'))
+        assert_that(text, contains_string(
+            'nti_intid_operation_seconds_bucket{operation="intids.register",le="+Inf"} 1\n'))
+        assert_that(text, contains_string(
+            'nti_intid_events_total{name="intids.allocation_probe"} 2\n'))
+
+        recorder.reset()
+        assert_that(recorder.snapshot(), is_({'counters': {}, 'operations': {}}))
+
+    def test_object_cache_counts(self):
+        from ZODB import DB
+        import transaction
+        recorder = instrumentation.enable(instrumentation.MetricsRecorder())
+        cache.enable()
+        db = DB(None)
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        try:
+            intids = conn.root()['intids'] = IntIds('_ds_id')
+            ob = Registered()
+            conn.add(ob)
+            uid = intids.register(ob)
+            txm.commit()
+            intids.getObject(uid)
+            intids.getObject(uid)
+        finally:
+            cache.disable()
+            txm.abort()
+            conn.close()
+            db.close()
+        assert_that(recorder.counters, has_entry('intids.object_cache.hit', 1))
+        assert_that(recorder.counters, has_entry('intids.object_cache.miss', 1))
+
+    def test_statsd(self):
+        class Client(object):
+            def __init__(self):
+                self.sent = []
+
+            def timing(self, name, value):
+                self.sent.append(('timing', name, value))
+
+            def incr(self, name, value):
+                self.sent.append(('incr', name, value))
+
+        client = Client()
+        instrumentation.enable(instrumentation.StatsdRecorder(client))
+        IntIds('_ds_id').register(Registered())
+        assert_that([x[:2] for x in client.sent],
+                    is_([('incr', 'nti.intid.intids.allocation_probe'),
+                         ('timing', 'nti.intid.intids.register')]))
+
+        recorder = instrumentation.StatsdRecorder(client, prefix=None)
+        recorder.count('foo')
+        assert_that(client.sent[-1], is_(('incr', 'foo', 1)))
+
+    def test_base_recorder_discards(self):
+        recorder = instrumentation.Recorder()
+        recorder.observe('foo', 1)
+        recorder.count('foo')
@@ -11,6 +11,9 @@ import pickle
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import contains_string
 from hamcrest import not_none
 from hamcrest import assert_that
 from hamcrest import has_property
@@ -201,3 +204,245 @@ class TestIntidWref(IntIdTestCase):
                 self.assertFalse(hasattr(ref, '__dict__'))
                 with self.assertRaises(AttributeError):
                     setattr(ref, 'arbitrary_attribute', None)
+
+    @WithMockDS
+    def test_resolve_many(self):
+        with mock_db_trans() as conn:
+            user_1 = self._create_user('sjohnson@nextthought.com', conn)
+            user_2 = self._create_user('sjohnson2@nextthought.com', conn)
+
+            cached = wref.WeakRef(user_1)
+            uncached = pickle.loads(pickle.dumps(wref.WeakRef(user_2)))
+            missing = pickle.loads(pickle.dumps(wref.WeakRef(user_1)))
+            missing._entity_id = -1
+            bad_oid = pickle.loads(pickle.dumps(wref.WeakRef(user_2)))
+            bad_oid._entity_oid = b'bad'
+            no_caching = wref.NoCachingArbitraryOrderableWeakRef(user_1)
+            no_caching._v_entity_cache = None
+
+            refs = [uncached, missing, cached, bad_oid, no_caching, uncached]
+            assert_that(wref.resolve_many(refs),
+                        is_([user_2, None, user_1, None, user_1, user_2]))
+            assert_that(uncached, has_property('_v_entity_cache', user_2))
+            assert_that(missing, has_property('_v_entity_cache', False))
+            assert_that(bad_oid, has_property('_v_entity_cache', False))
+            assert_that(no_caching, has_property('_v_entity_cache', none()))
+
+            # Cached failures are returned as None
+            assert_that(wref.resolve_many([missing]), is_([None]))
+            assert_that(wref.resolve_many(()), is_([]))
+
+    @WithMockDS
+    def test_resolve_many_prefetches_ghosts(self):
+        import transaction
+        with mock_db_trans() as conn:
+            user = self._create_user('sjohnson@nextthought.com', conn)
+            ref = pickle.loads(pickle.dumps(wref.WeakRef(user)))
+            transaction.savepoint()
+            conn.cacheMinimize()
+            assert_that(user, has_property('_p_changed', none()))
+
+            prefetched = []
+            conn.prefetch = prefetched.append
+            assert_that(wref.resolve_many([ref]), is_([user]))
+            assert_that(prefetched, is_([[user]]))
+
+    @WithMockDS
+    def test_is_alive_does_not_activate(self):
+        import transaction
+        from nti.intid.lookup import get_intids
+        with mock_db_trans() as conn:
+            user = self._create_user('sjohnson@nextthought.com', conn)
+            other = self._create_user('sjohnson2@nextthought.com', conn)
+            ref = wref.WeakRef(user)
+            reused = wref.WeakRef(user)
+            reused._entity_oid = other._p_oid
+            no_oid = wref.WeakRef(user)
+            no_oid._entity_oid = None
+            missing = wref.WeakRef(other)
+            missing._entity_id = -1
+            transaction.savepoint()
+            conn.cacheMinimize()
+
+            assert_that(ref.is_alive(), is_(True))
+            assert_that(reused.is_alive(), is_(False))
+            assert_that(reused.is_alive(check_oid=False), is_(True))
+            assert_that(no_oid.is_alive(), is_(True))
+            assert_that(missing.is_alive(), is_(False))
+            assert_that(wref.find_dead([ref, reused, no_oid, missing]),
+                        is_([reused, missing]))
+            assert_that(wref.find_dead([reused, missing], check_oid=False),
+                        is_([missing]))
+            assert_that(user, has_property('_p_changed', none()))
+            assert_that(ref, has_property('_v_entity_cache', user))
+
+            get_intids().unregister(user)
+            assert_that(ref.is_alive(), is_(False))
+
+
+class TestCompactWeakRefs(IntIdTestCase):
+
+    def _create_users(self, conn, count):
+        folder = conn.root()[root_name]
+        users = []
+        for i in range(count):
+            user = User('user%d' % i)
+            folder[user.__name__] = user
+            users.append(user)
+        return users
+
+    @WithMockDS
+    def test_list(self):
+        with mock_db_trans() as conn:
+            users = self._create_users(conn, 3)
+            refs = wref.WeakRefList([users[2], wref.WeakRef(users[0])])
+            refs.append(users[2])
+            refs.extend([users[1]])
+            assert_that(refs, has_length(4))
+            assert_that(refs[0], is_(wref.WeakRef(users[2])))
+            assert_that(refs[-1](), is_(users[1]))
+            assert_that(refs[1:3], is_([wref.WeakRef(users[0]), wref.WeakRef(users[2])]))
+            assert_that(list(refs.intids()), is_([r._entity_id for r in refs]))
+            assert_that(refs.resolve(), is_([users[2], users[0], users[2], users[1]]))
+
+            assert_that(wref.WeakRef(users[0]) in refs, is_(True))
+            assert_that(users[1] in refs, is_(True))
+            refs.remove(users[2])
+            assert_that(refs.resolve(), is_([users[0], users[2], users[1]]))
+            del refs[-1]
+            assert_that(users[1] in refs, is_(False))
+            assert_that(calling(refs.__getitem__).with_args(2), raises(IndexError))
+            assert_that(calling(refs.__delitem__).with_args(-3), raises(IndexError))
+            assert_that(calling(refs.remove).with_args(users[1]), raises(ValueError))
+
+            # A reference to a reused intid doesn't match
+            other = wref.WeakRef(users[0])
+            other._entity_oid = b'\x00' * 8
+            assert_that(other in refs, is_(False))
+            # And one without an OID can't be stored
+            other._entity_oid = b'bad'
+            assert_that(calling(refs.append).with_args(other), raises(ValueError))
+
+            copy = pickle.loads(pickle.dumps(refs))
+            assert_that(list(copy), is_(list(refs)))
+            assert_that(repr(copy), contains_string('len=2'))
+            copy.clear()
+            assert_that(copy, has_length(0))
+
+    @WithMockDS
+    def test_set(self):
+        with mock_db_trans() as conn:
+            users = self._create_users(conn, 3)
+            refs = wref.WeakRefSet(users + [users[0]])
+            assert_that(refs, has_length(3))
+            assert_that(list(refs.intids()), is_(sorted(refs.intids())))
+            for user in users:
+                assert_that(user in refs, is_(True))
+
+            no_oid = wref.WeakRef(users[1])
+            no_oid._entity_oid = None
+            refs.add(no_oid)
+            assert_that(refs, has_length(3))
+            # Anything with the same id matches a stored OID of None
+            assert_that(users[1] in refs, is_(True))
+            refs.add(users[1])
+
+            refs.discard(users[0])
+            refs.discard(users[0])
+            assert_that(users[0] in refs, is_(False))
+            assert_that(calling(refs.remove).with_args(users[0]), raises(KeyError))
+            refs.remove(users[1])
+            assert_that(refs.resolve(), is_([users[2]]))
+
+            refs.update(users)
+            copy = pickle.loads(pickle.dumps(refs))
+            assert_that(copy.resolve(), is_(refs.resolve()))
+
+            conn.root()['refs'] = refs
+
+        with mock_db_trans() as conn:
+            refs = conn.root()['refs']
+            assert_that(refs, has_length(3))
+            assert_that(refs.resolve(), has_length(3))
+
+    @WithMockDS
+    def test_other_attributes_kept(self):
+        with mock_db_trans() as conn:
+            users = self._create_users(conn, 2)
+            refs = wref.WeakRefList(users)
+            refs.__name__ = 'friends'
+            state = refs.__getstate__()
+            assert_that(sorted(state), is_(['__name__', 'ids', 'oids']))
+
+            copy = pickle.loads(pickle.dumps(refs))
+            assert_that(copy.__name__, is_('friends'))
+            assert_that(copy.resolve(), is_(users))
+            conn.root()['refs'] = refs
+
+        with mock_db_trans() as conn:
+            refs = conn.root()['refs']
+            assert_that(refs.__name__, is_('friends'))
+            assert_that(refs.resolve(), has_length(2))
+
+    @WithMockDS
+    def test_tree_set(self):
+        with mock_db_trans() as conn:
+            users = self._create_users(conn, 4)
+            a = wref.WeakRefTreeSet(users[:3])
+            b = wref.WeakRefTreeSet(users[1:])
+            assert_that(a, has_length(3))
+            assert_that(users[0] in a, is_(True))
+            assert_that(users[3] in a, is_(False))
+            assert_that(sorted(a.resolve(), key=id), is_(sorted(users[:3], key=id)))
+            assert_that(list(a.intids()), is_(sorted(r._entity_id for r in a)))
+            assert_that(repr(a), contains_string('len=3'))
+
+            assert_that(set((a | b).resolve()), is_(set(users)))
+            assert_that(set((a & b).resolve()), is_(set(users[1:3])))
+            assert_that(set((a - b).resolve()), is_({users[0]}))
+            assert_that(set(a.intersection(users[2:]).resolve()), is_({users[2]}))
+
+            # A reused intid is a different object
+            reused = wref.WeakRef(users[1])
+            reused._entity_oid = b'\x00' * 8
+            c = wref.WeakRefTreeSet([reused])
+            assert_that(reused in a, is_(False))
+            assert_that(a & c, has_length(0))
+            assert_that(a - c, has_length(3))
+            # Unless an OID is unknown
+            unknown = wref.WeakRef(users[1])
+            unknown._entity_oid = None
+            d = wref.WeakRefTreeSet([unknown])
+            assert_that(list((d & a).resolve()), is_([users[1]]))
+            assert_that(a - d, has_length(2))
+
+            a.discard(reused)
+            assert_that(a, has_length(3))
+            a.remove(users[0])
+            assert_that(calling(a.remove).with_args(users[0]), raises(KeyError))
+            a.discard(users[1])
+            assert_that(list(a), is_([wref.WeakRef(users[2])]))
+
+            conn.root()['refs'] = b
+
+        with mock_db_trans() as conn:
+            refs = conn.root()['refs']
+            assert_that(refs.resolve(), has_length(3))
+
+    @WithMockDS
+    def test_unregistered(self):
+        with mock_db_trans() as conn:
+            users = self._create_users(conn, 2)
+            unregistered = User('nobody')
+            for refs in (wref.WeakRefList(users),
+                         wref.WeakRefSet(users),
+                         wref.WeakRefTreeSet(users)):
+                assert_that(unregistered in refs, is_(False))
+                if isinstance(refs, wref.WeakRefList):
+                    assert_that(calling(refs.remove).with_args(unregistered),
+                                raises(ValueError))
+                else:
+                    refs.discard(unregistered)
+                    assert_that(calling(refs.remove).with_args(unregistered),
+                                raises(KeyError))
+                assert_that(refs, has_length(2))
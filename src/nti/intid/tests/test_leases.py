@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import time
+import random
+import unittest
+
+from functools import partial
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import less_than
+from hamcrest import contains_string
+from hamcrest import greater_than_or_equal_to
+
+import BTrees
+
+import transaction
+
+from ZODB import DB
+
+from nti.intid.leases import IdLeaseTable
+
+from nti.intid.storage import ShardedRefs
+
+from nti.intid.testing import Registered
+from nti.intid.testing import compare_conflict_rates
+from nti.intid.testing import simulate_concurrent_registrations
+
+from nti.intid.utility import IntIds
+from nti.intid.utility import ALLOCATIONS
+from nti.intid.utility import ALLOCATE_RANDOM
+from nti.intid.utility import ALLOCATE_LEASED
+
+
+class TestIdLeaseTable(unittest.TestCase):
+
+    def test_shard_range(self):
+        table = IdLeaseTable(prefix_bits=3)
+        assert_that(table.shard_count, is_(8))
+        assert_that(table.shard_range(0), is_((0, 2 ** 60 - 1)))
+        assert_that(table.shard_range(7), is_((7 * 2 ** 60, 2 ** 63 - 1)))
+        assert_that(calling(IdLeaseTable).with_args(prefix_bits=0),
+                    raises(ValueError))
+
+    def test_acquire_renew_release(self):
+        table = IdLeaseTable(prefix_bits=1, lease_duration=10)
+        choices = iter([1, 1, 0])
+        table._randrange = lambda *args: next(choices)
+
+        assert_that(table.acquire('a', now=0), is_(1))
+        assert_that(table.acquire('b', now=0), is_(0))
+        assert_that(table.holder_of(1, now=5), is_('a'))
+        assert_that(repr(table), contains_string('2/2 leased'))
+
+        assert_that(calling(table.acquire).with_args('c', now=5),
+                    raises(ValueError))
+
+        assert_that(table.needs_renewal(1, now=6), is_(True))
+        assert_that(table.renew(1, 'a', now=6), is_(True))
+        assert_that(table.needs_renewal(1, now=6), is_(False))
+        assert_that(table.renew(1, 'b', now=6), is_(False))
+
+        # b's lease expires and is taken over
+        assert_that(table.holder_of(0, now=11), is_(none()))
+        assert_that(table.acquire('c', now=11), is_(0))
+        table.release(0, 'b')
+        assert_that(table.holder_of(0, now=11), is_('c'))
+        table.release(0, 'c')
+        assert_that(table, has_length(1))
+
+
+class TestLeasedAllocation(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.txm = transaction.TransactionManager()
+        self.conn = self.db.open(self.txm)
+        self.intids = IntIds('_ds_id', family=BTrees.family64,
+                             id_allocation=ALLOCATE_LEASED)
+        self.intids.id_leases.prefix_bits = 4
+        self.conn.root()['intids'] = self.intids
+        self.txm.commit()
+
+    def tearDown(self):
+        self.txm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def _register(self, count):
+        result = []
+        for _ in range(count):
+            ob = Registered()
+            self.conn.add(ob)
+            result.append(self.intids.register(ob))
+        return result
+
+    def test_sequential_in_shard(self):
+        uids = self._register(3)
+        holder, prefix, first, last = self.intids._v_lease
+        assert_that(self.intids.id_leases.holder_of(prefix), is_(holder))
+        assert_that(uids, is_([first, first + 1, first + 2]))
+        self.txm.commit()
+
+        # Ghosting the utility doesn't lose the lease
+        self.conn.cacheMinimize()
+        assert_that(self.intids._v_lease, is_(none()))
+        assert_that(self._register(1), is_([first + 3]))
+
+        # Nor does losing our place
+        self.intids._v_nextid = None
+        assert_that(self._register(1), is_([first + 4]))
+
+        # If the shard fills up, we move to a new one
+        self.intids.force_register(last, Registered())
+        self.intids._v_nextid = None
+        uid = self._register(1)[0]
+        _, new_prefix, new_first, _ = self.intids._v_lease
+        assert_that(new_prefix, is_not(prefix))
+        assert_that(uid, is_(new_first))
+        assert_that(self.intids.id_leases, has_length(2))
+
+        self.intids.release_id_lease()
+        assert_that(self.intids.id_leases, has_length(1))
+        assert_that(self.intids._v_lease, is_(none()))
+
+    def test_reacquired_shard_partly_filled(self):
+        intids = IntIds('_ds_id', id_allocation=ALLOCATE_LEASED,
+                        refs_factory=partial(ShardedRefs, shard_bits=4))
+        self.conn.add(intids)
+        leases = intids.id_leases
+        prefixes = iter([1, 2])
+        leases._randrange = lambda start, stop: next(prefixes)
+        _, old_last = leases.shard_range(1)
+        new_first, _ = leases.shard_range(2)
+
+        x = Registered()
+        self.conn.add(x)
+        intids.register(x)
+        intids.force_register(old_last, Registered())
+        intids._v_nextid = None
+        # Left in the next shard by an earlier holder of its lease.
+        existing = Registered()
+        intids.force_register(new_first, existing)
+
+        y = Registered()
+        self.conn.add(y)
+        assert_that(intids.register_many([y]), is_([new_first + 1]))
+        assert_that(intids._v_lease[1], is_(2))
+        assert_that(intids.getObject(new_first), is_(existing))
+
+    def test_lost_lease(self):
+        self._register(1)
+        holder, prefix, _, _ = self.intids._v_lease
+        self.intids.id_leases.release(prefix, holder)
+        self._register(1)
+        assert_that(self.intids._v_lease[0], is_not(holder))
+
+    def test_renewal(self):
+        self._register(1)
+        holder, prefix, _, _ = self.intids._v_lease
+        self.intids.id_leases.leases[prefix] = (holder, 0)
+        # More than half used, but not expired
+        self.intids.id_leases.lease_duration = time.time() * 1.5
+        self._register(1)
+        assert_that(self.intids.id_leases.leases[prefix][1], is_(greater_than_or_equal_to(1)))
+        assert_that(self.intids._v_lease[0], is_(holder))
+
+    def test_lazily_created_table(self):
+        intids = IntIds('_ds_id')
+        intids.id_allocation = ALLOCATE_LEASED
+        ob = Registered()
+        self.conn.add(ob)
+        uid = intids.register(ob)
+        assert_that(intids.id_leases, has_length(1))
+        assert_that(uid, is_(intids._v_lease[2]))
+
+
+class TestConflictHarness(unittest.TestCase):
+
+    def test_reports(self):
+        reports = compare_conflict_rates(writers=2, rounds=2, objects_per_transaction=2)
+        assert_that(reports, has_length(len(ALLOCATIONS)))
+        for report in reports:
+            assert_that(report.attempts, is_(4))
+            assert_that(report.conflict_rate, is_(report.conflicts / 4))
+            assert_that(repr(report), contains_string(report.id_allocation))
+
+    def test_leased_with_coarse_shards(self):
+        # With fewer shards than it takes to keep a dozen random
+        # starting points apart, randomly allocating writers share
+        # shards; leasing writers each have their own, and conflict
+        # only when two acquire the same one at once. (With the
+        # default 16 shard bits, neither conflicts.)
+        # Where the writers start, and so how often they meet, is
+        # random; fix it, so the result is the same every run.
+        self.addCleanup(random.setstate, random.getstate())
+        refs_factory = partial(ShardedRefs, shard_bits=4)
+        reports = []
+        for allocation in (ALLOCATE_RANDOM, ALLOCATE_LEASED):
+            random.seed(0)
+            reports.append(simulate_concurrent_registrations(writers=12,
+                                                             id_allocation=allocation,
+                                                             refs_factory=refs_factory))
+        randomly, leased = reports
+        assert_that(leased.conflicts * 2, is_(less_than(randomly.conflicts)))
+
+    def test_lease_table_follows_shards(self):
+        intids = IntIds('_ds_id', id_allocation=ALLOCATE_LEASED,
+                        refs_factory=partial(ShardedRefs, shard_bits=4))
+        assert_that(intids.id_leases.prefix_bits, is_(4))
+        assert_that(IntIds('_ds_id', id_allocation=ALLOCATE_LEASED).id_leases.prefix_bits,
+                    is_(16))
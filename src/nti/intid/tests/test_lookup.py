@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+import transaction
+
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from zope.component.globalregistry import BaseGlobalComponents
+
+from zope.component.persistentregistry import PersistentComponents
+
+from zope.component.hooks import site
+
+from zope.interface.interfaces import ComponentLookupError
+
+from nti.intid import lookup
+
+from nti.intid.tests import IntIdTestCase
+
+from nti.intid.utility import IntIds
+
+
+class _Site(object):
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def getSiteManager(self):
+        return self.sm
+
+
+class TestLookup(IntIdTestCase):
+
+    def test_missing(self):
+        assert_that(lookup.query_intids(), is_(none()))
+        assert_that(lookup.query_intids(42), is_(42))
+        assert_that(calling(lookup.get_intids),
+                    raises(ComponentLookupError))
+
+    def test_cached_and_invalidated_by_registration(self):
+        gsm = component.getGlobalSiteManager()
+        first = IntIds('_ds_id')
+        gsm.registerUtility(first, IIntIds)
+        try:
+            assert_that(lookup.get_intids(), is_(same_instance(first)))
+
+            # The answer is remembered...
+            gsm._v_nti_intid_utility = (lookup._cache_key(gsm.utilities), 42)
+            assert_that(lookup.get_intids(), is_(42))
+            del gsm._v_nti_intid_utility
+
+            # ...until registrations change
+            second = IntIds('_ds_id')
+            gsm.registerUtility(second, IIntIds)
+            assert_that(lookup.get_intids(), is_(same_instance(second)))
+
+            gsm.unregisterUtility(second, IIntIds)
+            assert_that(lookup.query_intids(), is_(none()))
+        finally:
+            gsm.unregisterUtility(first, IIntIds)
+
+    def test_per_site(self):
+        gsm = component.getGlobalSiteManager()
+        local = BaseGlobalComponents('local', bases=(gsm,))
+        local_intids = IntIds('_ds_id')
+        local.registerUtility(local_intids, IIntIds)
+
+        assert_that(lookup.query_intids(), is_(none()))
+        with site(_Site(local)):
+            assert_that(lookup.get_intids(), is_(same_instance(local_intids)))
+        assert_that(lookup.query_intids(), is_(none()))
+
+    def test_persistent_site_changed_elsewhere(self):
+        db = DB(MappingStorage())
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        try:
+            gsm = component.getGlobalSiteManager()
+            local = conn.root()['sm'] = PersistentComponents('local', bases=(gsm,))
+            txm.commit()
+            with site(_Site(local)):
+                assert_that(lookup.query_intids(), is_(none()))
+
+            # As another process would: no events are sent here.
+            other_txm = transaction.TransactionManager()
+            other = db.open(other_txm)
+            other.root()['sm'].registerUtility(IntIds('_ds_id'), IIntIds, event=False)
+            other_txm.commit()
+            other.close()
+
+            txm.begin()
+            with site(_Site(local)):
+                assert_that(lookup.query_intids(), is_(IntIds))
+        finally:
+            txm.abort()
+            conn.close()
+            db.close()
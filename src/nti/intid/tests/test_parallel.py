@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import os
+import shutil
+import operator
+import tempfile
+import unittest
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import less_than
+from hamcrest import greater_than
+
+import BTrees
+
+import transaction
+
+from nti.intid import parallel
+
+from nti.intid.storage import ShardedRefs
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+
+from nti.intid.tests.test_check import ZCONFIG
+
+family = BTrees.family64
+
+
+def _counts(tree, ranges):
+    return [len(tree.keys(lo, hi)) for lo, hi in ranges]
+
+
+def _uid(intids, uid, ob): # pylint:disable=unused-argument
+    return uid
+
+
+def _one(intids, uid, ob): # pylint:disable=unused-argument
+    return 1
+
+
+_failures = []
+
+
+def _fail_once(intids, uid, ob): # pylint:disable=unused-argument
+    if not _failures:
+        _failures.append(uid)
+        raise ValueError(uid)
+    return uid
+
+
+def _fail(intids, uid, ob): # pylint:disable=unused-argument
+    # Only called in the worker processes.
+    raise ValueError(uid) # pragma: no cover
+
+
+class TestSplitRanges(unittest.TestCase):
+
+    def test_balanced(self):
+        tree = family.IO.BTree()
+        for i in range(100000):
+            tree[i * 7919 + 3] = None
+        ranges = parallel.split_ranges(tree, 4)
+        assert_that(ranges, has_length(4))
+        assert_that(ranges[0][0], is_(None))
+        assert_that(ranges[-1][1], is_(None))
+        for (_, hi), (lo, _) in zip(ranges, ranges[1:]):
+            assert_that(lo, is_(hi + 1))
+        counts = _counts(tree, ranges)
+        assert_that(sum(counts), is_(100000))
+        for count in counts:
+            assert_that(count, greater_than(20000))
+            assert_that(count, less_than(30000))
+
+    def test_small(self):
+        tree = family.IO.BTree()
+        for i in (5, 10, 15):
+            tree[i] = None
+        ranges = parallel.split_ranges(tree, 8)
+        assert_that(sum(_counts(tree, ranges)), is_(3))
+        assert_that(len(ranges) <= 3, is_(True))
+
+    def test_empty(self):
+        assert_that(parallel.split_ranges(family.IO.BTree(), 4),
+                    is_([(None, None)]))
+        assert_that(parallel.split_ranges(ShardedRefs(), 4),
+                    is_([(None, None)]))
+
+    def test_probes(self):
+        refs = ShardedRefs()
+        for i in range(1000):
+            refs[i * 13] = None
+        ranges = parallel.split_ranges(refs, 4)
+        assert_that(ranges, has_length(4))
+        tree = family.IO.BTree(dict.fromkeys(refs.keys()))
+        assert_that(sum(_counts(tree, ranges)), is_(1000))
+
+
+class TestScanParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.zconfig = os.path.join(self.tmp, 'db.conf')
+        with open(self.zconfig, 'w') as f:
+            f.write(ZCONFIG % os.path.join(self.tmp, 'Data.fs'))
+        db = parallel.open_database(self.zconfig)
+        try:
+            txm = transaction.TransactionManager()
+            conn = db.open(txm)
+            intids = conn.root()['intids'] = IntIds('_ds_id')
+            obs = [Registered() for _ in range(500)]
+            for ob in obs:
+                conn.add(ob)
+            self.uids = sorted(intids.register_many(obs))
+            txm.commit()
+            conn.close()
+        finally:
+            db.close()
+        del _failures[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_inline(self):
+        progress = []
+        result = parallel.scan_parallel(self.zconfig, _uid, 'intids', workers=2,
+                                        ranges_per_worker=2, chunk_size=50,
+                                        progress=lambda *args: progress.append(args),
+                                        inline=True)
+        assert_that(result.count, is_(500))
+        assert_that(result.value, is_(self.uids))
+        assert_that(result.failed, is_([]))
+        assert_that(progress[-1], is_((len(progress), len(progress), 500)))
+
+    def test_reducer(self):
+        result = parallel.scan_parallel(self.zconfig, _one, 'intids', workers=3,
+                                        reducer=operator.add, initial=0,
+                                        inline=True)
+        assert_that(result.value, is_(500))
+
+    def test_checkpoint_and_retry(self):
+        checkpoints = os.path.join(self.tmp, 'checkpoints')
+        os.mkdir(checkpoints)
+        result = parallel.scan_parallel(self.zconfig, _fail_once, 'intids', workers=2,
+                                        chunk_size=10, checkpoint_dir=checkpoints,
+                                        inline=True)
+        assert_that(result.failed, is_([]))
+        assert_that(result.value, is_(self.uids))
+        assert_that(os.path.exists(os.path.join(checkpoints, 'ranges.json')),
+                    is_(True))
+
+        # Everything was done already.
+        result = parallel.scan_parallel(self.zconfig, _uid, 'intids', workers=2,
+                                        checkpoint_dir=checkpoints, inline=True)
+        assert_that(result.count, is_(0))
+
+    def test_failed(self):
+        del _failures[:]
+        result = parallel.scan_parallel(self.zconfig, _fail_once, 'intids',
+                                        workers=1, retries=0, inline=True)
+        assert_that(result.failed, has_length(1))
+        assert_that(result.failed[0][0], is_((None, None)))
+        assert_that(repr(result), is_('<nti.intid.parallel.ScanResult count=0 failed=1>'))
+
+    def test_failed_processes(self):
+        result = parallel.scan_parallel(self.zconfig, _fail, 'intids', workers=2,
+                                        ranges_per_worker=1, retries=1)
+        assert_that(result.count, is_(0))
+        assert_that(result.failed, has_length(2))
+
+    def test_processes(self):
+        with open(self.zconfig) as f:
+            config = f.read()
+        with open(self.zconfig, 'w') as f:
+            f.write(config.replace('</filestorage>', '  read-only true\n  </filestorage>'))
+        result = parallel.scan_parallel(self.zconfig, _uid, 'intids', workers=3)
+        assert_that(result.count, is_(500))
+        assert_that(result.value, is_(self.uids))
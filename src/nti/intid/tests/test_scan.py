@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+
+import BTrees
+
+import transaction
+
+from persistent import Persistent
+
+from ZODB import DB
+
+from nti.intid.scan import ABORT
+from nti.intid.scan import COMMIT
+from nti.intid.scan import Checkpoint
+from nti.intid.scan import FileCheckpoint
+from nti.intid.scan import iter_objects_chunked
+
+from nti.intid.utility import IntIds
+
+
+class P(Persistent):
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+class TestIterObjectsChunked(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.txm = transaction.TransactionManager()
+        self.conn = self.db.open(self.txm)
+        self.intids = IntIds('_ds_id', family=BTrees.family64)
+        self.conn.root()['intids'] = self.intids
+        for uid in range(10):
+            ob = P(uid)
+            self.conn.add(ob)
+            self.intids.force_register(uid, ob)
+        self.txm.commit()
+
+    def tearDown(self):
+        self.txm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_all_in_chunks(self):
+        chunks = []
+        result = [(uid, ob.value) for uid, ob
+                  in iter_objects_chunked(self.intids, 3, on_chunk=chunks.append)]
+        assert_that(result, is_([(i, i) for i in range(10)]))
+        assert_that(chunks, is_([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]))
+
+    def test_range(self):
+        result = [uid for uid, _ in iter_objects_chunked(self.intids, 2,
+                                                         min_id=3, max_id=6,
+                                                         minimize_cache=False)]
+        assert_that(result, is_([3, 4, 5, 6]))
+
+    def test_commit_and_resume(self):
+        checkpoint = Checkpoint()
+        seen = []
+        for uid, ob in iter_objects_chunked(self.intids, 4, checkpoint=checkpoint,
+                                            transaction_mode=COMMIT):
+            ob.value = -uid
+            seen.append(uid)
+            if uid == 5:
+                # Simulate dying in the middle of a chunk
+                break
+        assert_that(checkpoint.load(), is_(3))
+        self.txm.abort()
+
+        for uid, ob in iter_objects_chunked(self.intids, 4, checkpoint=checkpoint,
+                                            transaction_mode=COMMIT):
+            ob.value = -uid
+            seen.append(uid)
+        assert_that(seen, is_([0, 1, 2, 3, 4, 5] + list(range(4, 10))))
+        assert_that(checkpoint.load(), is_(9))
+
+        values = [self.intids.getObject(uid).value for uid in range(10)]
+        assert_that(values, is_([-i for i in range(10)]))
+
+        # Nothing left
+        assert_that(list(iter_objects_chunked(self.intids, checkpoint=checkpoint)),
+                    is_([]))
+        # Until it starts again
+        checkpoint.clear()
+        assert_that(checkpoint.load(), is_(none()))
+
+    def test_abort(self):
+        for _, ob in iter_objects_chunked(self.intids, 5, transaction_mode=ABORT):
+            ob.value = 'changed'
+        values = [self.intids.getObject(uid).value for uid in range(10)]
+        assert_that(values, is_(list(range(10))))
+
+    def test_explicit_transaction_manager(self):
+        self.txm.explicit = True
+        self.txm.begin()
+        result = [uid for uid, _ in iter_objects_chunked(self.intids, 5,
+                                                         transaction_mode=COMMIT)]
+        assert_that(result, is_(list(range(10))))
+        # A transaction is still open
+        self.txm.get()
+
+
+class TestFileCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_load_clear(self):
+        path = os.path.join(self.tmpdir, 'checkpoint')
+        checkpoint = FileCheckpoint(path)
+        assert_that(checkpoint.load(), is_(none()))
+        checkpoint.save(2 ** 62)
+        assert_that(FileCheckpoint(path).load(), is_(2 ** 62))
+        checkpoint.clear()
+        assert_that(checkpoint.load(), is_(none()))
+        checkpoint.clear()
+        assert_that(repr(checkpoint), is_("<nti.intid.scan.FileCheckpoint %r>" % path))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import not_
+from hamcrest import assert_that
+from hamcrest import instance_of
+from hamcrest import same_instance
+
+import BTrees
+
+from zc.intid import IIntIds
+
+from zope import component
+
+from nti.intid import sets
+
+from nti.intid.testing import Registered
+
+from nti.intid.utility import IntIds
+
+from nti.intid.wref import WeakRefTreeSet
+
+II = BTrees.family64.II
+IF = BTrees.family64.IF
+
+
+class TestSets(unittest.TestCase):
+
+    def test_union(self):
+        assert_that(list(sets.union(II.Set([1, 3]), II.TreeSet([2, 3]))), is_([1, 2, 3]))
+        result = sets.union(II.Set([1]), [5, 4], None, IF.Bucket({2: 1.0}))
+        assert_that(result, is_(instance_of(II.Set)))
+        assert_that(list(result), is_([1, 2, 4, 5]))
+        one = II.Set([1])
+        assert_that(sets.union(one), is_(not_(same_instance(one))))
+        assert_that(list(sets.union(one)), is_([1]))
+        result = sets.union(IF.Bucket({2: 1.0}))
+        assert_that(result, is_(instance_of(IF.Set)))
+        assert_that(list(result), is_([2]))
+        assert_that(sets.union(None, None), is_(none()))
+
+    def test_intersection(self):
+        result = sets.intersection(II.Set(range(100)), II.TreeSet([5, 50, 500]), None)
+        assert_that(list(result), is_([5, 50]))
+        scores = IF.Bucket({1: 0.5, 2: 0.25, 3: 1.0})
+        result = sets.intersection(scores, IF.Set([1, 3]))
+        assert_that(result, is_(instance_of(IF.Set)))
+        assert_that(list(result), is_([1, 3]))
+        # Stops early when empty
+        assert_that(list(sets.intersection(II.Set([1]), II.Set([2]), II.Set([1]))),
+                    is_([]))
+        assert_that(sets.intersection(), is_(none()))
+        one = II.TreeSet([1])
+        assert_that(sets.intersection(one), is_(not_(same_instance(one))))
+        assert_that(list(sets.intersection(one)), is_([1]))
+        result = sets.intersection(scores)
+        assert_that(result, is_(instance_of(IF.Set)))
+        assert_that(list(result), is_([1, 2, 3]))
+        result = sets.intersection(II.Set([1, 2, 3]), II.Set([2, 3]), II.Set([3, 4]))
+        assert_that(list(result), is_([3]))
+
+    def test_difference(self):
+        counts = II.Bucket({1: 10, 2: 20, 3: 30})
+        result = sets.difference(counts, II.Set([1]), None, [3])
+        assert_that(list(result), is_([2]))
+        assert_that(list(sets.difference(counts, II.Set([2])).items()),
+                    is_([(1, 10), (3, 30)]))
+        result = sets.difference(counts)
+        assert_that(result, is_(not_(same_instance(counts))))
+        assert_that(dict(result.items()), is_({1: 10, 2: 20, 3: 30}))
+        result = sets.difference([3, 1])
+        assert_that(result, is_(instance_of(II.Set)))
+        assert_that(list(result), is_([1, 3]))
+        assert_that(sets.difference(None, counts), is_(none()))
+        assert_that(list(sets.difference(II.Set([1]), [1], [2])), is_([]))
+
+    def test_weak_refs(self):
+        refs = WeakRefTreeSet()
+        refs._refs.update({1: 0, 5: 0})
+        result = sets.union(refs, [3])
+        assert_that(result, is_(instance_of(II.Set)))
+        assert_that(list(result), is_([1, 3, 5]))
+        assert_that(list(sets.difference([1, 2], refs)), is_([2]))
+
+    def test_weighted(self):
+        weight, result = sets.weighted_union((IF.Bucket({1: 1.0, 2: 2.0}), 2),
+                                             (II.Set([2, 3]), 3),
+                                             (None, 100),
+                                             ([3], 1))
+        assert_that(weight, is_(1.0))
+        assert_that(dict(result.items()), is_({1: 2.0, 2: 7.0, 3: 4.0}))
+
+        weight, result = sets.weighted_intersection((IF.Set([1, 2]), 2),
+                                                    (IF.Set([2, 3]), 3))
+        assert_that((weight, list(result)), is_((5.0, [2])))
+
+        weight, result = sets.weighted_union((IF.Set([1]), 4))
+        assert_that((weight, list(result)), is_((4.0, [1])))
+        assert_that(sets.weighted_union(), is_((0, None)))
+
+    def test_resolve(self):
+        intids = IntIds('_ds_id')
+        obs = [Registered() for _ in range(3)]
+        uids = intids.register_many(obs)
+        ids = sets.union(uids, [uids[0] + 1000])
+        assert_that(list(sets.resolve(ids, intids)), is_(obs))
+        assert_that(list(sets.resolve(ids, intids, skip_missing=False)),
+                    is_(obs + [None]))
+
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            assert_that(list(sets.resolve(ids)), is_(obs))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import instance_of
+from hamcrest import assert_that
+from hamcrest import contains_string
+
+from nti.testing.matchers import verifiably_provides
+
+from nti.intid.interfaces import IIntIdRefs
+
+from nti.intid.storage import ShardedRefs
+from nti.intid.storage import LargeBucketLOBTree
+
+from nti.intid.testing import Registered
+from nti.intid.testing import simulate_concurrent_registrations
+
+from nti.intid.utility import IntIds
+from nti.intid.utility import ALLOCATE_LEASED
+from nti.intid.utility import ALLOCATE_MONOTONIC
+
+SHARD = 2 ** 61 # With 2 shard bits
+
+
+class TestShardedRefs(unittest.TestCase):
+
+    def _makeOne(self):
+        refs = ShardedRefs(shard_bits=2)
+        for uid in (1, 2, SHARD + 1, 3 * SHARD + 5):
+            refs[uid] = str(uid)
+        return refs
+
+    def test_provides(self):
+        assert_that(ShardedRefs(), verifiably_provides(IIntIdRefs))
+        assert_that(LargeBucketLOBTree(), verifiably_provides(IIntIdRefs))
+        assert_that(calling(ShardedRefs).with_args(shard_bits=33),
+                    raises(ValueError))
+
+    def test_mapping(self):
+        refs = self._makeOne()
+        assert_that(refs, has_length(4))
+        assert_that(refs.shard_count(), is_(3))
+        assert_that(repr(refs), contains_string('4 ids in 3 shards'))
+        assert_that(refs[SHARD + 1], is_(str(SHARD + 1)))
+        assert_that(refs.get(SHARD + 2), is_(none()))
+        assert_that(refs.get(2 * SHARD), is_(none()))
+        assert_that(refs.get(-1, 42), is_(42))
+        assert_that(SHARD + 1 in refs, is_(True))
+        assert_that(2 * SHARD in refs, is_(False))
+        assert_that(-1 in refs, is_(False))
+
+        # Replacing doesn't change the length
+        refs[1] = 'one'
+        assert_that(refs, has_length(4))
+        assert_that(refs[1], is_('one'))
+
+        del refs[1]
+        assert_that(refs, has_length(3))
+        assert_that(calling(refs.__delitem__).with_args(1), raises(KeyError))
+        assert_that(calling(refs.__delitem__).with_args(2 * SHARD), raises(KeyError))
+        assert_that(calling(refs.__getitem__).with_args(2 * SHARD), raises(KeyError))
+        assert_that(bool(refs), is_(True))
+        assert_that(bool(ShardedRefs()), is_(False))
+
+    def test_shard_factory(self):
+        refs = ShardedRefs(shard_bits=2, shard_factory=LargeBucketLOBTree)
+        refs[1] = 'one'
+        assert_that(refs._shards[0], is_(instance_of(LargeBucketLOBTree)))
+
+    def test_ranges(self):
+        refs = self._makeOne()
+        assert_that(list(refs), is_([1, 2, SHARD + 1, 3 * SHARD + 5]))
+        assert_that(refs.keys(2, SHARD + 1), is_([2, SHARD + 1]))
+        assert_that(refs.keys(2, SHARD + 1, excludemin=True, excludemax=True),
+                    is_([]))
+        assert_that(refs.values(SHARD), is_([str(SHARD + 1), str(3 * SHARD + 5)]))
+        assert_that(refs.items(max=1), is_([(1, '1')]))
+        assert_that(list(refs.iterkeys(-5, 1)), is_([1]))
+
+    def test_min_max_key(self):
+        refs = self._makeOne()
+        del refs[SHARD + 1] # leave an empty shard
+        assert_that(refs.minKey(), is_(1))
+        assert_that(refs.minKey(3), is_(3 * SHARD + 5))
+        assert_that(calling(refs.minKey).with_args(3 * SHARD + 6), raises(ValueError))
+        assert_that(refs.maxKey(), is_(3 * SHARD + 5))
+        assert_that(refs.maxKey(3 * SHARD), is_(2))
+        assert_that(calling(refs.maxKey).with_args(0), raises(ValueError))
+        assert_that(calling(refs.maxKey).with_args(-1), raises(ValueError))
+
+
+class TestIntIdsWithStorage(unittest.TestCase):
+
+    def _check(self, intids):
+        obs = [Registered() for _ in range(3)]
+        uids = [intids.register(ob) for ob in obs]
+        uids.extend(intids.register_many([Registered(), Registered()]))
+        assert_that(intids, has_length(5))
+        for ob, uid in zip(obs, uids):
+            assert_that(intids.getObject(uid), is_(ob))
+            assert_that(intids.queryId(ob), is_(uid))
+        assert_that(list(intids.iter_range()), is_(sorted(uids)))
+        assert_that(list(intids.contains_many([uids[1], -1, uids[0]])),
+                    is_(sorted(uids[:2])))
+        intids.unregister(obs[0])
+        assert_that(intids, has_length(4))
+        assert_that(intids.queryObject(uids[0]), is_(none()))
+        return uids
+
+    def test_sharded(self):
+        intids = IntIds('_ds_id', refs_factory=ShardedRefs)
+        self._check(intids)
+
+    def test_sharded_monotonic(self):
+        intids = IntIds('_ds_id', refs_factory=ShardedRefs,
+                        id_allocation=ALLOCATE_MONOTONIC)
+        assert_that(self._check(intids), is_([1, 2, 3, 4, 5]))
+
+    def test_large_buckets(self):
+        intids = IntIds('_ds_id', refs_factory=LargeBucketLOBTree)
+        assert_that(intids.refs, is_(LargeBucketLOBTree))
+        self._check(intids)
+
+
+class TestConflicts(unittest.TestCase):
+
+    def test_leased_sharded_writers_do_not_conflict(self):
+        kwargs = dict(writers=4, rounds=4, objects_per_transaction=40)
+        report = simulate_concurrent_registrations(id_allocation=ALLOCATE_LEASED,
+                                                   refs_factory=ShardedRefs,
+                                                   **kwargs)
+        assert_that(report.conflicts, is_(0))
+
+        report = simulate_concurrent_registrations(id_allocation=ALLOCATE_LEASED,
+                                                   **kwargs)
+        assert_that(report.conflicts > 0, is_(True))
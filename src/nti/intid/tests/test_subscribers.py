@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import transaction
+
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from zc.intid.interfaces import AfterIdAddedEvent
+from zc.intid.interfaces import ISubscriberEvent
+from zc.intid.interfaces import IAfterIdAddedEvent
+
+from zope import component
+
+from zope.component.hooks import site
+
+from zope.component.persistentregistry import PersistentComponents
+
+from zope.event import notify
+
+from zope.interface import Interface
+from zope.interface import classImplementsOnly
+from zope.interface import providedBy
+
+from nti.intid import instrumentation
+from nti.intid import subscribers
+
+from nti.intid.testing import Registered
+
+from nti.intid.tests import IntIdTestCase
+
+
+class _Site(object):
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def getSiteManager(self):
+        return self.sm
+
+
+def _late(ob, event):
+    ob.late = True
+
+
+class TestBatchedEvents(IntIdTestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        @subscribers.batch_handler
+        def batched(items):
+            self.calls.append(('batch', [ob for ob, _ in items]))
+
+        def immediate(ob, unused_event):
+            self.calls.append(('immediate', ob))
+
+        self.handlers = (batched, immediate)
+        gsm = component.getGlobalSiteManager()
+        for handler in self.handlers:
+            gsm.registerHandler(handler, (Interface, IAfterIdAddedEvent))
+        transaction.begin()
+
+    def tearDown(self):
+        instrumentation.disable()
+        transaction.abort()
+        gsm = component.getGlobalSiteManager()
+        for handler in self.handlers:
+            gsm.unregisterHandler(handler, (Interface, IAfterIdAddedEvent))
+
+    def _send(self, count):
+        obs = [Registered() for _ in range(count)]
+        for ob in obs:
+            notify(AfterIdAddedEvent(ob, None))
+        return obs
+
+    def test_unbatched(self):
+        obs = self._send(2)
+        assert_that(self.calls, is_([('batch', [obs[0]]), ('immediate', obs[0]),
+                                     ('batch', [obs[1]]), ('immediate', obs[1])]))
+
+    def test_batched_until_commit(self):
+        subscribers.batch_events()
+        subscribers.batch_events()
+        obs = self._send(3)
+        assert_that(self.calls, is_([('immediate', ob) for ob in obs]))
+        del self.calls[:]
+        transaction.commit()
+        assert_that(self.calls, is_([('batch', obs)]))
+
+    def test_flush_and_abort(self):
+        subscribers.batch_events()
+        obs = self._send(2)
+        subscribers.flush_events()
+        assert_that(self.calls[-1], is_(('batch', obs)))
+        del self.calls[:]
+        self._send(2)
+        txn = transaction.get()
+        transaction.abort()
+        assert_that([kind for kind, _ in self.calls], is_(['immediate', 'immediate']))
+        assert_that(txn in subscribers._queues, is_(False))
+
+    def test_handlers_cached(self):
+        ob = Registered()
+        event = AfterIdAddedEvent(ob, None)
+        handlers = subscribers._handlers_for(ob, event)
+        assert_that(handlers, is_(self.handlers))
+        assert_that(subscribers._handlers_for(ob, event), is_(handlers))
+        gsm = component.getGlobalSiteManager()
+        cache = gsm._v_nti_intid_handlers[1]
+        assert_that(list(cache.values()), is_([handlers]))
+        # Registering something forgets them.
+        gsm.unregisterHandler(self.handlers[1], (Interface, IAfterIdAddedEvent))
+        self.handlers = self.handlers[:1]
+        assert_that(subscribers._handlers_for(ob, event), is_(self.handlers))
+
+    def test_persistent_site_changed_elsewhere(self):
+        db = DB(MappingStorage())
+        txm = transaction.TransactionManager()
+        conn = db.open(txm)
+        try:
+            gsm = component.getGlobalSiteManager()
+            local = conn.root()['sm'] = PersistentComponents('local', bases=(gsm,))
+            txm.commit()
+            ob = Registered()
+            with site(_Site(local)):
+                notify(AfterIdAddedEvent(ob, None))
+
+            # As another process would: no events are sent here.
+            other_txm = transaction.TransactionManager()
+            other = db.open(other_txm)
+            other.root()['sm'].registerHandler(_late, (Interface, IAfterIdAddedEvent),
+                                               event=False)
+            other_txm.commit()
+            other.close()
+
+            txm.begin()
+            with site(_Site(local)):
+                notify(AfterIdAddedEvent(ob, None))
+            assert_that(ob.late, is_(True))
+        finally:
+            txm.abort()
+            conn.close()
+            db.close()
+
+    def test_no_transaction(self):
+        # Some transaction is batching...
+        txn = transaction.TransactionManager().get()
+        subscribers.batch_events(txn)
+        # ...but there is no current one.
+        transaction.abort()
+        transaction.manager.explicit = True
+        try:
+            obs = self._send(1)
+        finally:
+            transaction.manager.explicit = False
+            txn.abort()
+        assert_that(self.calls, is_([('batch', obs), ('immediate', obs[0])]))
+
+    def test_no_handlers(self):
+        class Event(AfterIdAddedEvent):
+            pass
+        classImplementsOnly(Event, ISubscriberEvent)
+        dispatched = []
+        original = subscribers._dispatch
+        subscribers._dispatch = lambda *args: dispatched.append(args)
+        try:
+            ob = Registered()
+            subscribers.subscriberEventNotify(Event(ob, None))
+            assert_that(dispatched, is_([]))
+            # Cached as having no handlers.
+            key = (providedBy(ob), providedBy(Event(ob, None)))
+            cache = component.getGlobalSiteManager()._v_nti_intid_handlers[1]
+            assert_that(cache[key], is_(()))
+        finally:
+            subscribers._dispatch = original
+
+    def test_timed(self):
+        recorder = instrumentation.enable(instrumentation.MetricsRecorder())
+        batched, immediate = [instrumentation.subscriber_operation(h)
+                              for h in self.handlers]
+        assert_that(immediate, is_('subscriber.nti.intid.tests.test_subscribers.'
+                                   'TestBatchedEvents.setUp.<locals>.immediate'))
+        self._send(2)
+        assert_that(recorder.calls(batched), is_(2))
+        assert_that(recorder.calls(immediate), is_(2))
+
+        subscribers.batch_events()
+        self._send(3)
+        assert_that(recorder.calls(batched), is_(2))
+        assert_that(recorder.calls(immediate), is_(5))
+        subscribers.flush_events()
+        assert_that(recorder.calls(batched), is_(3))
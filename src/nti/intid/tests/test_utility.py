@@ -16,6 +16,7 @@ from hamcrest import calling
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_property
+from hamcrest import same_instance
 does_not = is_not
 
 from nti.testing.matchers import validly_provides
@@ -23,6 +24,7 @@ from nti.testing.matchers import verifiably_provides
 
 from nti.testing.base import AbstractTestBase
 
+import sys
 import struct
 
 from zc.intid import IIdAddedEvent
@@ -30,17 +32,24 @@ from zc.intid import IIdRemovedEvent
 
 from zc.intid.interfaces import IntIdInUseError
 
+from zope import component
 from zope import interface
 
 from zope.component import eventtesting
 
+from zope.keyreference.persistent import KeyReferenceToPersistent
+
 from zope.location.interfaces import ILocation
 
 from persistent import Persistent
+from persistent.interfaces import IPersistent
 
 from nti.intid.interfaces import IIntIds
 
 from nti.intid.utility import IntIds
+from nti.intid.utility import aq_base
+from nti.intid.utility import ALLOCATE_BLOCK
+from nti.intid.utility import ALLOCATE_MONOTONIC
 
 
 @interface.implementer(ILocation)
@@ -48,6 +57,11 @@ class P(Persistent):
     pass
 
 
+class Slotted(Persistent):
+    # Cannot store the id attribute
+    __slots__ = ()
+
+
 class ConnectionStub(object):
     next = 1
 
@@ -77,6 +91,17 @@ class TestUtility(AbstractTestBase):
         assert_that(u, verifiably_provides(IIntIds))
         assert_that(repr(u), is_not(none()))
 
+    def test_aq_base(self):
+        from Acquisition import Implicit
+        ob = Implicit()
+        assert_that(aq_base(ob.__of__(Implicit())), is_(same_instance(ob)))
+        # Without Acquisition, nothing can be wrapped.
+        acquisition = sys.modules.pop('Acquisition')
+        try:
+            assert_that(aq_base(ob), is_(same_instance(ob)))
+        finally:
+            sys.modules['Acquisition'] = acquisition
+
     def test_non_keyreferences(self):
         u = IntIds("_ds_id")
         obj = object()
@@ -141,3 +166,270 @@ class TestUtility(AbstractTestBase):
                     raises(KeyError))
 
         u.force_unregister(100, obj, True)
+
+    def test_register_many(self):
+        u = IntIds("_ds_id")
+        stub = ConnectionStub()
+        existing = P()
+        stub.add(existing)
+        existing_id = u.register(existing)
+        eventtesting.clearEvents()
+
+        obs = [P() for _ in range(5)]
+        for ob in obs:
+            stub.add(ob)
+
+        uids = u.register_many([obs[0], existing, obs[1], obs[0]] + obs[2:])
+        assert_that(uids, has_length(7))
+        assert_that(uids[1], is_(existing_id))
+        assert_that(uids[3], is_(uids[0]))
+
+        new_ids = [uids[0], uids[2]] + uids[4:]
+        assert_that(new_ids, is_(list(range(new_ids[0], new_ids[0] + 5))))
+        for ob, uid in zip(obs, new_ids):
+            assert_that(u.getId(ob), is_(uid))
+            assert_that(u.getObject(uid), is_(ob))
+
+        events = eventtesting.getEvents(IIdAddedEvent)
+        assert_that([e.id for e in events], is_(uids))
+
+        assert_that(u.register_many([]), is_([]))
+
+    def test_register_many_skips_used_ids(self):
+        u = IntIds("_ds_id")
+        stub = ConnectionStub()
+        blocker = P()
+        stub.add(blocker)
+        u.force_register(12, blocker)
+
+        u._v_nextid = 10
+        u._randrange = lambda *args: 100
+        obs = [P() for _ in range(3)]
+        for ob in obs:
+            stub.add(ob)
+        assert_that(u.register_many(obs), is_([100, 101, 102]))
+        assert_that(u._v_nextid, is_(103))
+
+    def test_register_many_failure(self):
+        u = IntIds("_ds_id")
+
+        class Slotted(object):
+            __slots__ = ()
+
+        good = P()
+        ConnectionStub().add(good)
+        eventtesting.clearEvents()
+        assert_that(calling(u.register_many).with_args([good, Slotted()]),
+                    raises(AttributeError))
+        assert_that(u, has_length(0))
+        assert_that(good._ds_id, is_(none()))
+        assert_that(eventtesting.getEvents(IIdAddedEvent), has_length(0))
+
+    def test_ranges(self):
+        u = IntIds("_ds_id")
+        stub = ConnectionStub()
+        obs = {}
+        for uid in (5, 10, 15, 20):
+            ob = obs[uid] = P()
+            stub.add(ob)
+            u.force_register(uid, ob)
+
+        assert_that(list(u.iter_range()), is_([5, 10, 15, 20]))
+        assert_that(list(u.iter_range(10)), is_([10, 15, 20]))
+        assert_that(list(u.iter_range(10, 15)), is_([10, 15]))
+        assert_that(list(u.iter_range(10, 20, excludemin=True, excludemax=True)),
+                    is_([15]))
+        assert_that(list(u.iter_range(max_id=10, excludemax=True)), is_([5]))
+        assert_that(list(u.iter_range(21)), is_([]))
+
+        assert_that(list(u.items_range(6, 16)),
+                    is_([(10, obs[10]), (15, obs[15])]))
+        assert_that(list(u.items_range(15, excludemin=True)),
+                    is_([(20, obs[20])]))
+
+    def _register_new(self, u, count):
+        stub = ConnectionStub()
+        result = []
+        for _ in range(count):
+            ob = P()
+            stub.add(ob)
+            result.append(u.register(ob))
+        return result
+
+    def test_allocation_validation(self):
+        assert_that(calling(IntIds).with_args('_ds_id', id_allocation='nope'),
+                    raises(ValueError))
+        assert_that(calling(IntIds).with_args('_ds_id', id_block_size=0),
+                    raises(ValueError))
+
+    def test_allocation_monotonic(self):
+        u = IntIds("_ds_id", id_allocation=ALLOCATE_MONOTONIC)
+        assert_that(self._register_new(u, 3), is_([1, 2, 3]))
+
+        u.force_register(100, P())
+        assert_that(self._register_new(u, 1), is_([101]))
+
+        # Running off the end falls back to random
+        u.force_register(u.family.maxint, P())
+        u._randrange = lambda *args: 50
+        assert_that(self._register_new(u, 2), is_([50, 51]))
+
+    def test_allocation_block(self):
+        u = IntIds("_ds_id", id_allocation=ALLOCATE_BLOCK, id_block_size=4)
+        starts = iter([1000, 2000, 2100, 3000])
+        u._randrange = lambda *args: next(starts)
+
+        assert_that(self._register_new(u, 5), is_([1000, 1001, 1002, 1003, 2000]))
+        assert_that(u._v_block_end, is_(2003))
+
+        # Someone else took the next id in our block, so
+        # a new one is reserved; the first random choice collides.
+        u.force_register(2001, P())
+        u.force_register(2101, P())
+        assert_that(self._register_new(u, 1), is_([3000]))
+
+        # Bulk registration larger than a block reserves one big
+        # enough.
+        u._randrange = lambda *args: 5000
+        u.randomize()
+        assert_that(u._v_block_end, is_(none()))
+        stub = ConnectionStub()
+        obs = [P() for _ in range(6)]
+        for ob in obs:
+            stub.add(ob)
+        assert_that(u.register_many(obs), is_(list(range(5000, 5006))))
+        assert_that(u._v_block_end, is_(5005))
+
+
+class TestReverseIndex(AbstractTestBase):
+
+    def setUp(self):
+        super().setUp()
+        eventtesting.setUp()
+        component.provideAdapter(KeyReferenceToPersistent, (IPersistent,))
+        self.stub = ConnectionStub()
+
+    def _new(self, factory=Slotted):
+        ob = factory()
+        self.stub.add(ob)
+        return ob
+
+    def test_slotted(self):
+        u = IntIds("_ds_id", reverse_index=True)
+        ob = self._new()
+        uid = u.register(ob)
+        assert_that(u.getId(ob), is_(uid))
+        assert_that(u.queryId(ob), is_(uid))
+        assert_that(u.register(ob), is_(uid))
+        assert_that(u.ids, has_length(1))
+        assert_that(eventtesting.getEvents(IIdAddedEvent), has_length(2))
+
+        # Attribute-capable objects are indexed too
+        other = self._new(P)
+        other_uid = u.register(other)
+        assert_that(other._ds_id, is_(other_uid))
+        assert_that(u.ids, has_length(2))
+
+        u.unregister(ob)
+        assert_that(u.queryId(ob), is_(none()))
+        assert_that(u.ids, has_length(1))
+        assert_that(eventtesting.getEvents(IIdRemovedEvent), has_length(1))
+
+        # Things that can't be keyed are still errors
+        assert_that(calling(u.register).with_args(Slotted()),
+                    raises(AttributeError))
+        assert_that(u, has_length(1))
+
+    def test_without_index(self):
+        u = IntIds("_ds_id")
+        assert_that(calling(u.register).with_args(self._new()),
+                    raises(AttributeError))
+        assert_that(u, has_length(0))
+
+    def test_register_many(self):
+        u = IntIds("_ds_id", reverse_index=True)
+        obs = [self._new(), self._new(P), self._new()]
+        uids = u.register_many(obs)
+        assert_that([u.getId(ob) for ob in obs], is_(uids))
+        assert_that(u.register_many(obs), is_(uids))
+
+    def test_stale_entry_ignored(self):
+        u = IntIds("_ds_id", reverse_index=True)
+        ob = self._new()
+        uid = u.register(ob)
+        # Something else was forced into its place
+        u.force_unregister(uid)
+        assert_that(u.ids, has_length(0))
+        u.force_register(uid, self._new())
+        u.ids[KeyReferenceToPersistent(ob)] = uid
+        assert_that(u.queryId(ob), is_(none()))
+
+    def test_enable_existing(self):
+        u = IntIds("_ds_id")
+        ob = self._new(P)
+        uid = u.register(ob)
+        u.enable_reverse_index()
+        ids = u.ids
+        assert_that(dict(ids), is_({KeyReferenceToPersistent(ob): uid}))
+        u.enable_reverse_index()
+        assert_that(u.ids, is_(ids))
+
+        # Losing the attribute no longer loses the registration
+        ob._ds_id = None
+        assert_that(u.getId(ob), is_(uid))
+
+    def test_store_attribute_false(self):
+        u = IntIds("_ds_id", store_attribute=False)
+        assert_that(u.ids, is_not(none()))
+        ob = self._new(P)
+        ob._p_changed = False
+        uid = u.register(ob)
+        assert_that(ob, does_not(has_property('_ds_id')))
+        assert_that(ob._p_changed, is_(False))
+        assert_that(u.getId(ob), is_(uid))
+        # As used by nti.intid.check
+        assert_that(u._registered_id(ob), is_(uid))
+
+        u.unregister(ob)
+        assert_that(ob._p_changed, is_(False))
+        assert_that(u.queryId(ob), is_(none()))
+        assert_that(u.ids, has_length(0))
+
+        # Unkeyable objects fall back to the attribute
+        unkeyable = P()
+        uid = u.register(unkeyable)
+        assert_that(unkeyable._ds_id, is_(uid))
+        assert_that(u.getId(unkeyable), is_(uid))
+
+        # An attribute left from before the switch is cleared
+        legacy = self._new(P)
+        legacy._ds_id = u.force_register(42, legacy)
+        u.unregister(legacy)
+        assert_that(legacy._ds_id, is_(none()))
+
+    def test_reregister_does_not_write(self):
+        u = IntIds("_ds_id")
+        ob = self._new(P)
+        uid = u.register(ob)
+        ob._p_changed = False
+        assert_that(u.register(ob), is_(uid))
+        assert_that(ob._p_changed, is_(False))
+        assert_that(eventtesting.getEvents(IIdAddedEvent), has_length(2))
+
+    def test_generated_id_in_use(self):
+        u = IntIds("_ds_id")
+        uid = u.register(self._new(P))
+        u.generateId = lambda ob: uid
+        ob = self._new(P)
+        assert_that(calling(u.register).with_args(ob), raises(IntIdInUseError))
+        assert_that(u.queryId(ob), is_(none()))
+
+    def test_counts_created_when_needed(self):
+        u = IntIds("_ds_id")
+        # As if made before the counts were kept.
+        del u._removals
+        del u._registrations
+        ob = self._new(P)
+        u.register(ob)
+        u.unregister(ob)
+        assert_that((u._registrations(), u._removals()), is_((1, 1)))
@@ -10,10 +10,15 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-from Acquisition import aq_base
+import sys
+
+from weakref import WeakKeyDictionary
 
 import BTrees
 
+from BTrees.Length import Length
+
+from zc.intid.interfaces import AddedEvent
 from zc.intid.interfaces import RemovedEvent
 from zc.intid.interfaces import IntIdInUseError
 
@@ -23,8 +28,19 @@ from zope import interface
 
 from zope.event import notify as zope_notify
 
+from zope.intid.interfaces import IntIdMissingError
+
+from zope.keyreference.interfaces import NotYet
+from zope.keyreference.interfaces import IKeyReference
+
 from zope.security.proxy import removeSecurityProxy as unwrap
 
+from nti.intid import cache as _cache
+
+from nti.intid.changelog import ADDED
+from nti.intid.changelog import REMOVED
+from nti.intid.changelog import ChangeLog
+
 from nti.intid.interfaces import IIntIds
 
 
@@ -38,6 +54,71 @@ zope.deferredimport.deprecated(
 
 logger = __import__('logging').getLogger(__name__)
 
+
+def _count(length):
+    return length() if length is not None else 0
+
+
+def _publish_cache_entries(committed, cache, entries):
+    # After the commit of the transaction that looked them up.
+    if committed and cache is _cache.object_cache:
+        for key, location in entries.items():
+            cache.set(key, location)
+
+
+def aq_base(ob):
+    """
+    :func:`Acquisition.aq_base`, without importing :mod:`Acquisition`:
+    until it has been imported elsewhere, there can be no acquisition
+    wrappers to remove.
+    """
+    acquisition = sys.modules.get('Acquisition')
+    if acquisition is None:
+        return ob
+    return acquisition.aq_base(ob)
+
+#: Allocate new ids sequentially from a random starting point,
+#: moving to a new random point whenever an id is found to be in use.
+#: This is the behaviour of :mod:`zc.intid`. Concurrent writers rarely
+#: choose the same ids, but because each random jump lands in a
+#: different part of the BTree, inserts are spread over many buckets.
+ALLOCATE_RANDOM = 'random'
+
+#: Allocate each new id as one more than the largest id in use. This
+#: gives the best locality in the BTree (and in catalog indexes
+#: keyed by intid), but all writers compete for the last bucket, so
+#: concurrent writers frequently conflict.
+ALLOCATE_MONOTONIC = 'monotonic'
+
+#: Reserve a contiguous block of :attr:`IntIds.id_block_size`
+#: unused ids at a random point and allocate sequentially inside it.
+#: The block is held by this copy of the utility (that is, by the
+#: connection that loaded it, which is usually used by a single
+#: worker), so each transaction inserts into a few buckets rather
+#: than many. That alone does not make conflicts less likely: with
+#: the default ``refs`` BTree, concurrent writers still split nodes
+#: of the same tree, and the harness in :mod:`nti.intid.testing`
+#: measures about the same conflict rate as :data:`ALLOCATE_RANDOM`
+#: (59% against 60%). Combine it with
+#: :class:`nti.intid.storage.ShardedRefs` to avoid conflicts.
+ALLOCATE_BLOCK = 'block'
+
+#: Lease a shard of the id space from :attr:`IntIds.id_leases` and
+#: allocate sequentially inside it. As with :data:`ALLOCATE_BLOCK`,
+#: the lease is held by this copy of the utility, but unlike blocks,
+#: leases are recorded in the database, so no two writers are given
+#: the same shard. This only helps with
+#: :class:`nti.intid.storage.ShardedRefs` with coarse shards, and
+#: costs a write to the lease table for each new connection; see
+#: :mod:`nti.intid.leases`.
+ALLOCATE_LEASED = 'leased'
+
+ALLOCATIONS = (ALLOCATE_RANDOM, ALLOCATE_MONOTONIC, ALLOCATE_BLOCK, ALLOCATE_LEASED)
+
+# {connection: {utility oid: lease}}, so that a utility
+# that has been ghosted can find its lease again.
+_leases_by_connection = WeakKeyDictionary()
+
 @interface.implementer(IIntIds)
 class IntIds(_ZCIntIds):
     """
@@ -61,10 +142,99 @@ class IntIds(_ZCIntIds):
     # zope.container.contained.ContainedProxy is really what we want to register.
     # Fortunately, most proxies pass attributes on through to the underlying
     # object, in which case queryId will take either the proxy or the wrapped object;
-    # alternatively, they define __slots__ and forbid new attributes
+    # alternatively, they define __slots__ and forbid new attributes. Objects
+    # like that can still be registered if the reverse index (ids) is enabled.
+
+    #: If not ``None``, a BTree of :attr:`family` mapping the
+    #: :class:`zope.keyreference.interfaces.IKeyReference` of each
+    #: registered object to its id. This is used to find the id of
+    #: objects that do not have the id attribute, such as objects that
+    #: cannot store it. See :meth:`enable_reverse_index`.
+    ids = None
+
+    #: Whether registering an object sets the id attribute on it. If
+    #: false (which requires :attr:`ids`), objects that have a key
+    #: reference are only recorded in :attr:`ids` and :attr:`refs`, so
+    #: registering and unregistering them does not modify them (and so
+    #: does not rewrite their pickles). Objects without a key
+    #: reference still get the attribute.
+    store_attribute = True
+
+    #: How new ids are chosen: one of :data:`ALLOCATE_RANDOM` (the
+    #: default), :data:`ALLOCATE_MONOTONIC`, :data:`ALLOCATE_BLOCK` or
+    #: :data:`ALLOCATE_LEASED`.
+    id_allocation = ALLOCATE_RANDOM
+
+    #: How many ids are reserved at once by :data:`ALLOCATE_BLOCK`.
+    id_block_size = 4096
+
+    #: The :class:`nti.intid.leases.IdLeaseTable` used by
+    #: :data:`ALLOCATE_LEASED`. Created when first needed.
+    id_leases = None
+
+    #: If not ``None``, the :class:`nti.intid.changelog.ChangeLog`
+    #: recording each id registered and unregistered. See
+    #: :meth:`enable_changelog`.
+    changelog = None
+
+    # Lengths counting the ids unregistered or registered again,
+    # and the transactions that registered ids, so that the
+    # entries of the object cache can be checked against the view
+    # of the connection using them. Created when first needed by
+    # utilities made before they existed.
+    _removals = None
+    _registrations = None
+
+    # The last id (inclusive) of the block reserved by
+    # ALLOCATE_BLOCK.
+    _v_block_end = None
+
+    # (holder, prefix, first id, last id) of the lease held
+    # for ALLOCATE_LEASED.
+    _v_lease = None
+
+    def __init__(self, attribute, family=None, id_allocation=None, id_block_size=None,
+                 refs_factory=None, reverse_index=False, store_attribute=True,
+                 changelog=False):
+        """
+        :keyword str id_allocation: If given, sets :attr:`id_allocation`.
+        :keyword int id_block_size: If given, sets :attr:`id_block_size`.
+        :keyword refs_factory: If given, a callable of no arguments that returns
+            the object providing :class:`nti.intid.interfaces.IIntIdRefs` to use
+            as :attr:`refs`. See :mod:`nti.intid.storage`. Otherwise, an
+            ``IOBTree`` of :attr:`family` is used.
+        :keyword bool reverse_index: If true, keep the reverse index
+            :attr:`ids`.
+        :keyword bool store_attribute: Sets :attr:`store_attribute`. If
+            false, the reverse index is kept regardless of *reverse_index*.
+        :keyword bool changelog: If true, keep the :attr:`changelog`.
+        """
+        # pylint:disable=too-many-arguments
+        _ZCIntIds.__init__(self, attribute, family)
+        self._removals = Length()
+        self._registrations = Length()
+        if refs_factory is not None:
+            self.refs = refs_factory()
+        if reverse_index or not store_attribute:
+            self.ids = self.family.OI.BTree()
+        if not store_attribute:
+            self.store_attribute = False
+        if id_allocation is not None:
+            if id_allocation not in ALLOCATIONS:
+                raise ValueError("Unknown id allocation", id_allocation)
+            self.id_allocation = id_allocation
+            if id_allocation == ALLOCATE_LEASED:
+                self.id_leases = self._new_lease_table()
+        if id_block_size is not None:
+            if id_block_size < 1:
+                raise ValueError("Block size must be positive", id_block_size)
+            self.id_block_size = id_block_size
+        if changelog:
+            self.changelog = ChangeLog()
 
     def randomize(self):
         self._v_nextid = self._randrange(0, self.family.maxint)
+        self._v_block_end = None
 
     def queryId(self, ob, default=None):
         """
@@ -83,16 +253,497 @@ class IntIds(_ZCIntIds):
         """
         return _ZCIntIds.queryId(self, aq_base(ob), default)
 
+    def getObject(self, uid):
+        """
+        Return the object registered with *uid*.
+
+        If the process-wide object cache is enabled (see
+        :mod:`nti.intid.cache`), it is consulted first.
+        """
+        cache, pending = self._object_cache()
+        if cache is not None:
+            ob = self._cached_object(cache, pending, uid)
+            if ob is not None:
+                return ob
+        ob = _ZCIntIds.getObject(self, uid)
+        if cache is not None:
+            self._cache_object(pending, uid, ob)
+        return ob
+
+    def queryObject(self, uid, default=None):
+        """
+        Return the object registered with *uid*, or *default*.
+
+        If the process-wide object cache is enabled (see
+        :mod:`nti.intid.cache`), it is consulted first.
+        """
+        cache, pending = self._object_cache()
+        if cache is None:
+            return _ZCIntIds.queryObject(self, uid, default)
+
+        ob = self._cached_object(cache, pending, uid)
+        if ob is None:
+            ob = self.refs.get(uid)
+            if ob is None:
+                return default
+            self._cache_object(pending, uid, ob)
+        return ob
+
+    def _object_cache(self):
+        """
+        Return the object cache and the entries made in the current
+        transaction, to be added to it when the transaction commits;
+        or ``(None, None)`` if the cache is not in use, this utility
+        is not saved, or the transaction has changed the
+        registrations.
+        """
+        cache = _cache.object_cache
+        jar = self._p_jar
+        if cache is None or jar is None:
+            return None, None
+        txn = jar.transaction_manager.get()
+        try:
+            pending = txn.data(self)
+        except KeyError:
+            pending = {}
+            txn.set_data(self, pending)
+            txn.addAfterCommitHook(_publish_cache_entries, (cache, pending))
+        if pending is None:
+            return None, None
+        return cache, pending
+
+    def _registrations_changed(self):
+        # The lookups of this transaction no longer show committed
+        # state, so they must not be cached.
+        jar = self._p_jar
+        if jar is None:
+            return
+        txn = jar.transaction_manager.get()
+        try:
+            pending = txn.data(self)
+        except KeyError:
+            pass
+        else:
+            if pending:
+                pending.clear()
+        txn.set_data(self, None)
+
+    def _object_cache_key(self, uid):
+        jar = self._p_jar
+        if jar is None:
+            return None
+        return (jar.db().database_name, self._p_oid, uid)
+
+    def _cached_object(self, cache, pending, uid):
+        key = self._object_cache_key(uid)
+        location = pending.get(key)
+        if location is None:
+            location = cache.get(key)
+        ob = None
+        if location is not None:
+            ob, stale = self._load_cached(location)
+            if stale:
+                cache.invalidate(key)
+                pending.pop(key, None)
+        cache.record(ob is not None)
+        return ob
+
+    def _load_cached(self, location):
+        # Return the object at *location* if this connection can use
+        # it, and whether the entry is no longer valid.
+        database_name, oid, removals, registrations = location
+        if removals != _count(self._removals):
+            return None, True
+        if registrations > _count(self._registrations):
+            # Made from a newer view than ours, which may not have
+            # the id yet.
+            return None, False
+        try:
+            return self._p_jar.get_connection(database_name).get(oid), False
+        except KeyError:
+            # Including POSKeyError: not in this connection's view
+            # of the database.
+            return None, True
+
+    def _registered_id(self, ob):
+        # The id stored for *ob*, without checking it against refs.
+        uid = getattr(ob, self.attribute, None)
+        if uid is None and self.ids is not None:
+            key = self._key(ob)
+            uid = self.ids.get(key) if key is not None else None
+        return uid
+
+    def _cache_object(self, pending, uid, ob):
+        oid = getattr(ob, '_p_oid', None)
+        if oid is not None:
+            pending[self._object_cache_key(uid)] = (ob._p_jar.db().database_name, oid,
+                                                    _count(self._removals),
+                                                    _count(self._registrations))
+
+    def _registered(self):
+        # Called when ids have been registered. Counting that keeps
+        # connections with an older view from using cached entries for
+        # them.
+        if self._registrations is None:
+            self._registrations = Length()
+        self._registrations.change(1)
+        self._registrations_changed()
+
+    def _forget_object(self, uid):
+        # Called before *uid* is unregistered or registered again.
+        # Counting that makes every process's cached entries for this
+        # utility invalid once they see the change.
+        if self._removals is None:
+            self._removals = Length()
+        self._removals.change(1)
+        self._registrations_changed()
+        cache = _cache.object_cache
+        if cache is not None:
+            key = self._object_cache_key(uid)
+            if key is not None:
+                cache.invalidate(key)
+
     def register(self, ob, *unused_args, **unused_kwargs):
         """
         register(object) -> int
 
         Register the :func:`Acquisition.aq_base` of *object* and return the integer id.
         """
-        result = _ZCIntIds.register(self, aq_base(ob))
+        ob = unwrap(aq_base(ob))
+        uid = self.queryId(ob)
+        if uid is None:
+            uid = self.generateId(ob)
+            if uid in self.refs:
+                raise IntIdInUseError("id generator returned used id")
+            self.refs[uid] = ob
+            try:
+                self._store_id(ob, uid)
+            except: # pylint:disable=bare-except
+                # cleanup our mess
+                del self.refs[uid]
+                raise
+            self._registered()
+            self._log_change(ADDED, uid)
+        # Otherwise, everything is already recorded; writing it again
+        # would only dirty the object and the BTree.
+        zope_notify(AddedEvent(ob, self, uid))
         # 5 = ZODB.loglevels.TRACE
-        logger.log(5, '%s was registered with intid %s', type(ob), result)
-        return result
+        logger.log(5, '%s was registered with intid %s', type(ob), uid)
+        return uid
+
+    def register_many(self, obs):
+        """
+        register_many(objects) -> list
+
+        Register the :func:`Acquisition.aq_base` of each of *objects*
+        and return a list of their integer ids, in the same order.
+
+        This is equivalent to calling :meth:`register` for each
+        object, but the new ids are allocated as one contiguous block
+        and are inserted into :attr:`refs` in ascending order, which
+        keeps the writes to as few buckets as possible. Objects that
+        are already registered keep their id; an object that appears
+        more than once gets the same id each time.
+
+        No events are sent until every object has been registered.
+        Then one :class:`zc.intid.interfaces.IIdAddedEvent` is
+        notified for each entry of *objects*, in the order given (just
+        as if :meth:`register` had been called for each). If setting
+        the id attribute fails for any object, all of the new
+        registrations are undone, the exception is raised, and no
+        events are sent.
+        """
+        obs = [unwrap(aq_base(ob)) for ob in obs]
+        uids = [self.queryId(ob) for ob in obs]
+
+        # id(ob) -> offset into the new block
+        offsets = {}
+        new_obs = []
+        for ob, uid in zip(obs, uids):
+            if uid is None and id(ob) not in offsets:
+                offsets[id(ob)] = len(new_obs)
+                new_obs.append(ob)
+
+        if new_obs:
+            start = self._generate_block(len(new_obs))
+            self._register_block(start, new_obs)
+            uids = [start + offsets[id(ob)] if uid is None else uid
+                    for ob, uid in zip(obs, uids)]
+            # 5 = ZODB.loglevels.TRACE
+            logger.log(5, '%d objects were registered with intids %s to %s',
+                       len(new_obs), start, start + len(new_obs) - 1)
+
+        for ob, uid in zip(obs, uids):
+            zope_notify(AddedEvent(ob, self, uid))
+        return uids
+    registerMany = register_many
+
+    def generateId(self, ob):
+        """
+        Return an id that is not in use, chosen according to
+        :attr:`id_allocation`.
+        """
+        return self._generate_block(1)
+
+    def _generate_block(self, count):
+        """
+        Return the first of *count* contiguous ids, none of which are
+        in use, chosen according to :attr:`id_allocation`.
+        """
+        allocation = self.id_allocation
+        if allocation == ALLOCATE_BLOCK:
+            return self._generate_in_reserved_block(count)
+        if allocation == ALLOCATE_LEASED:
+            return self._generate_in_leased_shard(count)
+        if allocation == ALLOCATE_MONOTONIC:
+            start = self._generate_monotonic(count)
+            if start is not None:
+                return start
+            # We've run off the top of the id space. Use
+            # whatever is free.
+        return self._generate_random(count)
+
+    def _is_free(self, start, end):
+        """
+        Are all of the ids from *start* to *end*, inclusive, unused
+        and valid?
+        """
+        if end > self.family.maxint:
+            return False
+        try:
+            return self.refs.minKey(start) > end
+        except ValueError:
+            # Nothing at or above start
+            return True
+
+    def _generate_random(self, count):
+        # Like zc.intid, allocate sequentially from a random
+        # starting point, starting over at a new random point
+        # when we bump into ids in use.
+        while True:
+            if self._v_nextid is None:
+                self.randomize()
+            start = self._v_nextid
+            end = start + count - 1
+            if self._is_free(start, end):
+                self._v_nextid = end + 1
+                return start
+            self._v_nextid = None
+
+    def _generate_monotonic(self, count):
+        try:
+            start = self.refs.maxKey() + 1
+        except ValueError:
+            # Empty
+            start = 1
+        return start if self._is_free(start, start + count - 1) else None
+
+    def _generate_in_reserved_block(self, count):
+        start = self._v_nextid
+        block_end = self._v_block_end
+        if start is None or block_end is None \
+           or start + count - 1 > block_end \
+           or not self._is_free(start, start + count - 1):
+            # Reserve a new block. No one else is likely to
+            # be allocating in it.
+            size = max(count, self.id_block_size)
+            while True:
+                start = self._randrange(0, self.family.maxint)
+                if self._is_free(start, start + size - 1):
+                    break
+            self._v_block_end = start + size - 1
+        self._v_nextid = start + count
+        return start
+
+    def _generate_in_leased_shard(self, count):
+        _, _, first, last = self._current_lease()
+        start = self._v_nextid
+        if start is None or start < first \
+           or start + count - 1 > last \
+           or not self._is_free(start, start + count - 1):
+            start = self._next_in_shard(first, last)
+            while start is None or start + count - 1 > last:
+                # Full; move on to a new shard, which may have been
+                # partly filled by an earlier holder.
+                _, _, first, last = self._acquire_lease()
+                start = self._next_in_shard(first, last)
+        self._v_nextid = start + count
+        return start
+
+    def _next_in_shard(self, first, last):
+        try:
+            start = self.refs.maxKey(last) + 1
+        except ValueError:
+            # Nothing at or below last
+            return first
+        return max(start, first) if start <= last else None
+
+    def _current_lease(self):
+        lease = self._v_lease
+        jar = self._p_jar
+        if lease is None and jar is not None:
+            lease = _leases_by_connection.get(jar, {}).get(self._p_oid)
+
+        if lease is not None:
+            holder, prefix = lease[:2]
+            leases = self.id_leases
+            if leases is None or leases.holder_of(prefix) != holder:
+                # Expired and taken, or never committed.
+                lease = None
+            elif leases.needs_renewal(prefix):
+                leases.renew(prefix, holder)
+
+        if lease is None:
+            lease = self._acquire_lease()
+        self._v_lease = lease
+        return lease
+
+    def _new_lease_table(self):
+        from nti.intid.leases import IdLeaseTable # pylint:disable=import-outside-toplevel
+        # Lease the shards that refs keeps apart, if it does.
+        return IdLeaseTable(prefix_bits=getattr(self.refs, 'shard_bits', None))
+
+    def _acquire_lease(self):
+        from nti.intid.leases import new_holder # pylint:disable=import-outside-toplevel
+        if self.id_leases is None:
+            self.id_leases = self._new_lease_table()
+        holder = new_holder()
+        prefix = self.id_leases.acquire(holder)
+        lease = (holder, prefix) + self.id_leases.shard_range(prefix)
+        self._v_lease = lease
+        self._v_nextid = None
+        jar = self._p_jar
+        if jar is not None:
+            _leases_by_connection.setdefault(jar, {})[self._p_oid] = lease
+        return lease
+
+    def release_id_lease(self):
+        """
+        Give up the shard leased by this copy of the utility for
+        :data:`ALLOCATE_LEASED`, if any.
+
+        This modifies the lease table, so the transaction must be
+        committed for the release to take effect.
+        """
+        lease = self._v_lease
+        jar = self._p_jar
+        if jar is not None:
+            lease = _leases_by_connection.get(jar, {}).pop(self._p_oid, lease)
+        if lease is not None and self.id_leases is not None:
+            self.id_leases.release(lease[1], lease[0])
+        self._v_lease = None
+        self._v_nextid = None
+
+    def _register_block(self, start, obs):
+        refs = self.refs
+        done = 0
+        try:
+            for ob in obs:
+                uid = start + done
+                refs[uid] = ob
+                try:
+                    self._store_id(ob, uid)
+                except: # pylint:disable=bare-except
+                    del refs[uid]
+                    raise
+                done += 1
+        except: # pylint:disable=bare-except
+            # cleanup our mess
+            for i in range(done):
+                del refs[start + i]
+                self._clear_id(obs[i], start + i)
+            raise
+        self._registered()
+        for uid in range(start, start + done):
+            self._log_change(ADDED, uid)
+
+    def _key(self, ob):
+        """
+        Return the key reference for *ob*, or ``None`` if it cannot
+        have one.
+        """
+        try:
+            return IKeyReference(ob)
+        except (NotYet, TypeError, ValueError):
+            return None
+
+    def _indexed_id(self, ob):
+        """
+        Return the id of *ob* found in the reverse index, or ``None``.
+        """
+        key = self._key(ob)
+        if key is None:
+            return None
+        uid = self.ids.get(key)
+        if uid is None or self.refs.get(uid) is not ob:
+            return None
+        return uid
+
+    def _store_id(self, ob, uid):
+        """
+        Record that *ob* has *uid*: in its id attribute and, if
+        enabled, in the reverse index. If the object can be found
+        through the reverse index, the attribute is only set if
+        :attr:`store_attribute` is true, and failing to set it is not
+        an error.
+        """
+        key = self._key(ob) if self.ids is not None else None
+        if key is not None:
+            self.ids[key] = uid
+            if not self.store_attribute:
+                return
+        try:
+            setattr(ob, self.attribute, uid)
+        except (AttributeError, TypeError):
+            if key is None:
+                raise
+            logger.debug("Cannot set %s on %r, using the reverse index",
+                         self.attribute, type(ob))
+
+    def _clear_id(self, ob, uid):
+        """
+        The reverse of :meth:`_store_id`.
+        """
+        if self.ids is not None:
+            key = self._key(ob)
+            if key is not None and self.ids.get(key) == uid:
+                del self.ids[key]
+        if getattr(ob, self.attribute, None) is not None:
+            setattr(ob, self.attribute, None)
+
+    def enable_reverse_index(self):
+        """
+        Start keeping the reverse index :attr:`ids`, filling it from
+        the objects already registered. This loads every registered
+        object, so it should be done with the same care as any other
+        full scan (see :mod:`nti.intid.scan`).
+
+        Does nothing if the index is already enabled.
+        """
+        if self.ids is not None:
+            return
+        ids = self.family.OI.BTree()
+        for uid, ob in self.refs.iteritems():
+            key = self._key(ob)
+            if key is not None:
+                ids[key] = uid
+        self.ids = ids
+
+    def enable_changelog(self, max_records=None):
+        """
+        Start keeping the :attr:`changelog`, which records the changes
+        made from now on, keeping about *max_records* of them (by
+        default, :attr:`nti.intid.changelog.ChangeLog.max_records`).
+
+        Does nothing if the log is already enabled.
+        """
+        if self.changelog is None:
+            self.changelog = ChangeLog(max_records)
+
+    def _log_change(self, op, uid):
+        changelog = self.changelog
+        if changelog is not None:
+            changelog.record(op, uid)
 
     def unregister(self, ob, *unused_args, **unused_kwargs):
         """
@@ -100,22 +751,95 @@ class IntIds(_ZCIntIds):
 
         Unregister the :func:`Acquisition.aq_base` of *object*.
         """
-        return _ZCIntIds.unregister(self, aq_base(ob))
+        ob = unwrap(aq_base(ob))
+        uid = self.queryId(ob)
+        if uid is None:
+            return
+        self._forget_object(uid)
+        # This should not raise KeyError, we checked that in queryId
+        del self.refs[uid]
+        self._clear_id(ob, uid)
+        self._log_change(REMOVED, uid)
+        zope_notify(RemovedEvent(ob, self, uid))
 
     def getId(self, ob):
         """
         Get the id of the :func:`Acquisition.aq_base` of *ob*.
 
         See the note for :meth:`queryId`.
+
+        Objects without the id attribute are looked up in the reverse
+        index, if it is enabled.
         """
-        return _ZCIntIds.getId(self, aq_base(ob))
+        ob = aq_base(ob)
+        try:
+            return _ZCIntIds.getId(self, ob)
+        except IntIdMissingError:
+            if self.ids is None:
+                raise
+            uid = self._indexed_id(unwrap(ob))
+            if uid is None:
+                raise
+            return uid
     get_id = getId
 
+    def contains_many(self, ids):
+        """
+        Return the set of those *ids* that are registered, as a
+        ``family.II.Set``.
+
+        This only consults :attr:`refs`; none of the registered
+        objects are loaded. If :attr:`refs` is a BTree of
+        :attr:`family`, this is done by :mod:`BTrees` in C.
+        """
+        family = self.family
+        refs = self.refs
+        if isinstance(refs, family.IO.BTree):
+            if not isinstance(ids, (family.IO.Set, family.IO.TreeSet)):
+                ids = family.IO.Set(ids)
+            return family.II.Set(family.IO.intersection(ids, refs))
+        return family.II.Set(uid for uid in ids if uid in refs)
+
+    def iter_range(self, min_id=None, max_id=None,
+                   excludemin=False, excludemax=False):
+        """
+        Iterate, in ascending order, the registered ids between
+        *min_id* and *max_id*.
+
+        Either bound may be ``None`` to leave that end of the range
+        open. The bounds are included unless *excludemin* or
+        *excludemax* is true. This uses the native range search of
+        :attr:`refs` and is lazy, so it can be used to process the
+        catalog in bounded chunks: to continue after the last id
+        seen, pass it as *min_id* with *excludemin* set.
+        """
+        return self.refs.iterkeys(min_id, max_id,
+                                  excludemin=excludemin, excludemax=excludemax)
+
+    def items_range(self, min_id=None, max_id=None,
+                    excludemin=False, excludemax=False):
+        """
+        Iterate, in ascending order of id, the ``(id, object)`` pairs
+        whose id is between *min_id* and *max_id*.
+
+        The arguments are as for :meth:`iter_range`.
+        """
+        return self.refs.iteritems(min_id, max_id,
+                                   excludemin=excludemin, excludemax=excludemax)
+
     def force_register(self, uid, ob, check=True):
         unwrapped = unwrap(aq_base(ob))
-        if check and uid in self.refs:
-            raise IntIdInUseError(ob)
+        if uid in self.refs:
+            if check:
+                raise IntIdInUseError(ob)
+            self._forget_object(uid)
         self.refs[uid] = unwrapped
+        self._registered()
+        if self.ids is not None:
+            key = self._key(unwrapped)
+            if key is not None:
+                self.ids[key] = uid
+        self._log_change(ADDED, uid)
         return uid
     forceRegister = force_register
 
@@ -126,7 +850,14 @@ class IntIds(_ZCIntIds):
             unwrapped = unwrap(aq_base(ob))
             if self.refs[uid] is not unwrapped:
                 raise KeyError(ob)
+        registered = self.refs[uid]
         del self.refs[uid]
+        self._forget_object(uid)
+        if self.ids is not None:
+            key = self._key(registered)
+            if key is not None and self.ids.get(key) == uid:
+                del self.ids[key]
+        self._log_change(REMOVED, uid)
         if      remove_attribute \
             and ob is not None \
             and getattr(ob, self.attribute, None) is not None:
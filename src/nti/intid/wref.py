@@ -14,22 +14,25 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
+import bisect
+import struct
 import warnings
 import functools
 
-from zc.intid import IIntIds
+from array import array
 
-from zope import component
-from zope import interface
+import BTrees
 
-from nti.externalization.integer_strings import to_external_string
+from persistent import Persistent
 
-from nti.ntiids.ntiids import TYPE_MISSING
-from nti.ntiids.ntiids import make_ntiid
+from zope import interface
 
 from nti.wref.interfaces import ICachingWeakRef
 from nti.wref.interfaces import IWeakRefToMissing
 
+from nti.intid.lookup import get_intids
+
 logger = __import__('logging').getLogger(__name__)
 
 
@@ -51,8 +54,12 @@ class _AbstractWeakRef(object):
 
     __slots__ = ('_entity_id', '_entity_oid', '_v_entity_cache')
 
+    #: Whether calling this object uses (and fills) ``_v_entity_cache``
+    #: by default.
+    _allow_caching = True
+
     def __init__(self, content_object):
-        self._entity_id = component.getUtility(IIntIds).getId(content_object)
+        self._entity_id = get_intids().getId(content_object)
         # _v_entity_cache is a volatile attribute. It's either None, meaning we have
         # no idea, the resolved object, or False
         self._v_entity_cache = content_object
@@ -67,10 +74,13 @@ class _AbstractWeakRef(object):
             return self._v_entity_cache if self._v_entity_cache is not False else None
 
         try:
-            result = component.getUtility(IIntIds).getObject(self._entity_id)
+            result = get_intids().getObject(self._entity_id)
         except KeyError:
             result = None
 
+        return self._check_and_cache(result, allow_cached)
+
+    def _check_and_cache(self, result, allow_cached):
         if self._entity_oid is not None:
             result_oid = getattr(result, '_p_oid', None)
             if result_oid is None or result_oid != self._entity_oid:
@@ -87,6 +97,22 @@ class _AbstractWeakRef(object):
     def __call__(self, allow_cached=True):
         return self._cached(allow_cached)
 
+    def is_alive(self, check_oid=True, intids=None):
+        """
+        Is the intid still registered (and, if *check_oid* is true and
+        we know the OID, registered to the object with that OID)?
+
+        Unlike calling this object, this does not activate the
+        referenced object, or use or change the cache.
+
+        :keyword intids: The utility to use instead of the current one.
+        """
+        if intids is None:
+            intids = get_intids()
+        if not check_oid or self._entity_oid is None:
+            return bool(intids.contains_many((self._entity_id,)))
+        return _registered_oid(intids, self._entity_id) == self._entity_oid
+
     def __eq__(self, other):
         if self is other:
             return True
@@ -116,6 +142,11 @@ class _AbstractWeakRef(object):
                                self._entity_id)
 
     def make_missing_ntiid(self):
+        # These are rarely needed and slow to import.
+        # pylint:disable=import-outside-toplevel
+        from nti.externalization.integer_strings import to_external_string
+        from nti.ntiids.ntiids import TYPE_MISSING
+        from nti.ntiids.ntiids import make_ntiid
         eid = self._entity_id
         # This intid is probably no longer used, but we have no guarantee
         # of that. We do some trivial manipulation on it to make it less
@@ -197,5 +228,501 @@ class NoCachingArbitraryOrderableWeakRef(ArbitraryOrderableWeakRef):
     Does not allow caching.
     """
     __slots__ = ()
+    _allow_caching = False
     def __call__(self, unused_allow_cached=False):
         return ArbitraryOrderableWeakRef.__call__(self, allow_cached=False)
+
+
+def resolve_many(refs, intids=None):
+    """
+    Resolve each of the weak *refs* and return a list of the results,
+    in the same order. Entries whose object has gone away are
+    ``None``.
+
+    This produces the same results as calling each ref, and fills in
+    (or uses) each ref's cache the same way, but is much cheaper for
+    large numbers of refs: the intid utility is only looked up
+    once, the ids are looked up in sorted order so that the BTree
+    buckets are visited in a single ordered pass, and the objects that
+    will be returned are prefetched from their connections in bulk.
+
+    :keyword intids: The :class:`zc.intid.IIntIds` utility to use.
+        If not given, the current utility is found.
+    """
+    # pylint: disable=protected-access
+    refs = list(refs)
+    results = [None] * len(refs)
+    # intid -> [index, ...]
+    pending = {}
+    for i, ref in enumerate(refs):
+        if ref._allow_caching and ref._v_entity_cache is not None:
+            results[i] = ref._cached(True)
+        else:
+            pending.setdefault(ref._entity_id, []).append(i)
+
+    if not pending:
+        return results
+
+    if intids is None:
+        intids = get_intids()
+
+    # id(jar) -> [ghost, ...]
+    ghosts = {}
+    for intid in sorted(pending):
+        result = intids.queryObject(intid)
+        for i in pending[intid]:
+            ref = refs[i]
+            results[i] = found = ref._check_and_cache(result, ref._allow_caching)
+            if found is not None and getattr(found, '_p_changed', 0) is None:
+                ghosts.setdefault(id(found._p_jar), []).append(found)
+
+    for jar_obs in ghosts.values():
+        prefetch = getattr(jar_obs[0]._p_jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(jar_obs)
+    return results
+
+
+def _registered_oid(intids, intid):
+    # Getting the _p_oid of a ghost doesn't activate it.
+    ob = intids.refs.get(intid)
+    return getattr(ob, '_p_oid', None) if ob is not None else None
+
+
+def find_dead(refs, intids=None, check_oid=True):
+    """
+    Return a list of those weak *refs* whose intid is no longer
+    registered (or, if *check_oid* is true, is registered to a
+    different object), as :meth:`_AbstractWeakRef.is_alive` would,
+    but checking the ids in bulk with
+    :meth:`nti.intid.utility.IntIds.contains_many`. No referenced
+    object is activated.
+    """
+    # pylint: disable=protected-access
+    refs = list(refs)
+    if intids is None:
+        intids = get_intids()
+    registered = intids.contains_many(ref._entity_id for ref in refs)
+    dead = []
+    for ref in refs:
+        if ref._entity_id not in registered:
+            dead.append(ref)
+        elif check_oid and ref._entity_oid is not None \
+             and _registered_oid(intids, ref._entity_id) != ref._entity_oid:
+            dead.append(ref)
+    return dead
+
+
+#: Stands for an OID of ``None`` in compact storage. ZODB never
+#: allocates it.
+_NO_OID = b'\xff' * 8
+_OID_SIZE = 8
+
+
+def _ref_state(ob):
+    """
+    Return ``(intid, oid)`` for *ob*, which may be a weak reference or
+    a registered object.
+    """
+    # pylint: disable=protected-access
+    if isinstance(ob, _AbstractWeakRef):
+        return ob._entity_id, ob._entity_oid
+    return get_intids().getId(ob), getattr(ob, '_p_oid', None)
+
+
+def _pack_oid(oid):
+    if oid is None:
+        return _NO_OID
+    if len(oid) != _OID_SIZE:
+        raise ValueError("Can only store 8-byte OIDs", oid)
+    return oid
+
+
+class _CompactWeakRefs(Persistent):
+    """
+    Base for persistent collections of weak references that store only
+    the intids, in an ``array('q')``, and the OIDs, concatenated into a
+    single byte string. These pickle as two byte strings no matter how
+    many references they hold, instead of as a tuple and a class
+    reference per item.
+
+    The weak references are created, without a utility lookup, as
+    they are accessed; they are instances of :attr:`ref_class`, and
+    their caches do not outlive them. Use :meth:`resolve` to get all
+    the objects at once.
+    """
+
+    #: The class of the weak references handed out.
+    ref_class = WeakRef
+
+    def __init__(self, refs=()):
+        Persistent.__init__(self)
+        self._ids = array('q')
+        self._oids = bytearray()
+        self._extend(refs)
+
+    def _extend(self, refs):
+        for ref in refs:
+            self._add(*_ref_state(ref))
+
+    def _find(self, intid): # pylint:disable=unused-argument
+        """
+        Return the index at which *intid* belongs, and whether it is
+        already there. By default, new ids go at the end.
+        """
+        return len(self._ids), False
+
+    def _add(self, intid, oid):
+        i, found = self._find(intid)
+        packed = _pack_oid(oid)
+        start = i * _OID_SIZE
+        if found:
+            if self._oids[start:start + _OID_SIZE] == packed:
+                return
+            self._oids[start:start + _OID_SIZE] = packed
+        else:
+            self._ids.insert(i, intid)
+            self._oids[start:start] = packed
+        self._p_changed = True
+
+    def __getstate__(self):
+        # Any other attributes (such as a ``__name__``) are kept as
+        # Persistent would keep them; only the buffers are packed.
+        state = Persistent.__getstate__(self)
+        ids = state.pop('_ids')
+        if sys.byteorder != 'little': # pragma: no cover
+            ids = array('q', ids)
+            ids.byteswap()
+        state['ids'] = ids.tobytes()
+        state['oids'] = bytes(state.pop('_oids'))
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        ids = array('q')
+        ids.frombytes(state.pop('ids'))
+        if sys.byteorder != 'little': # pragma: no cover
+            ids.byteswap()
+        state['_ids'] = ids
+        state['_oids'] = bytearray(state.pop('oids'))
+        Persistent.__setstate__(self, state)
+
+    def _oid_at(self, index):
+        start = index * _OID_SIZE
+        oid = bytes(self._oids[start:start + _OID_SIZE])
+        return None if oid == _NO_OID else oid
+
+    def _ref_at(self, index):
+        ref = self.ref_class.__new__(self.ref_class)
+        ref.__setstate__((self._ids[index], self._oid_at(index)))
+        return ref
+
+    def _matches(self, index, oid):
+        # The same rule as _AbstractWeakRef.__eq__: a stored
+        # OID of None matches anything.
+        stored = self._oid_at(index)
+        return stored is None or stored == oid
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for i in range(len(self._ids)):
+            yield self._ref_at(i)
+
+    def intids(self):
+        """
+        Return a copy of the ids, as an ``array('q')``.
+        """
+        return array('q', self._ids)
+
+    def resolve(self, intids=None):
+        """
+        Return a list of the referenced objects, in order, with
+        ``None`` for those that have gone away. See
+        :func:`resolve_many`.
+        """
+        return resolve_many(self, intids)
+
+    def _delete_at(self, index):
+        del self._ids[index]
+        start = index * _OID_SIZE
+        del self._oids[start:start + _OID_SIZE]
+        self._p_changed = True
+
+    def clear(self):
+        if self._ids:
+            self._ids = array('q')
+            self._oids = bytearray()
+
+    def __repr__(self):
+        return "<%s.%s len=%d>" % (self.__class__.__module__,
+                                   self.__class__.__name__,
+                                   len(self))
+
+
+class WeakRefList(_CompactWeakRefs):
+    """
+    A persistent list of weak references, stored compactly.
+
+    Items may be added as weak references or as registered objects.
+    Membership tests take weak references and scan the list.
+    """
+
+    def append(self, ob):
+        self._add(*_ref_state(ob))
+
+    def extend(self, obs):
+        self._extend(obs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._ref_at(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._ref_at(index)
+
+    def __delitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        self._delete_at(index)
+
+    def index(self, ref):
+        try:
+            intid, oid = _ref_state(ref)
+        except KeyError:
+            # Not registered, so not here.
+            raise ValueError(ref)
+        ids = self._ids
+        start = 0
+        while True:
+            try:
+                i = ids.index(intid, start)
+            except ValueError:
+                raise ValueError(ref)
+            if self._matches(i, oid):
+                return i
+            start = i + 1
+
+    def __contains__(self, ref):
+        try:
+            self.index(ref)
+        except ValueError:
+            return False
+        return True
+
+    def remove(self, ref):
+        del self[self.index(ref)]
+
+
+class WeakRefSet(_CompactWeakRefs):
+    """
+    A persistent set of weak references, stored compactly, in
+    ascending order of intid. Membership tests are binary searches.
+
+    Each intid appears at most once; adding a reference with an intid
+    already present replaces the stored OID.
+    """
+
+    def _find(self, intid):
+        ids = self._ids
+        i = bisect.bisect_left(ids, intid)
+        return i, i < len(ids) and ids[i] == intid
+
+    def add(self, ob):
+        self._add(*_ref_state(ob))
+
+    def update(self, obs):
+        self._extend(obs)
+
+    def _index_of(self, ref):
+        try:
+            intid, oid = _ref_state(ref)
+        except KeyError:
+            # Not registered, so not here.
+            return None
+        i, found = self._find(intid)
+        return i if found and self._matches(i, oid) else None
+
+    def __contains__(self, ref):
+        return self._index_of(ref) is not None
+
+    def discard(self, ref):
+        i = self._index_of(ref)
+        if i is not None:
+            self._delete_at(i)
+
+    def remove(self, ref):
+        if ref not in self:
+            raise KeyError(ref)
+        self.discard(ref)
+
+
+_OID_AS_INT = struct.Struct('>q')
+#: :data:`_NO_OID` as stored by :class:`WeakRefTreeSet`.
+_NO_OID_INT = _OID_AS_INT.unpack(_NO_OID)[0]
+
+
+def _oid_to_int(oid):
+    return _OID_AS_INT.unpack(_pack_oid(oid))[0]
+
+
+def _int_to_oid(value):
+    return None if value == _NO_OID_INT else _OID_AS_INT.pack(value)
+
+
+def _oids_match(a, b):
+    # Stored OIDs, as integers. Unknown OIDs match anything.
+    return a == b or a == _NO_OID_INT or b == _NO_OID_INT
+
+
+class WeakRefTreeSet(Persistent):
+    """
+    A persistent set of weak references kept in a 64-bit integer
+    BTree mapping each intid to its object's OID (as an integer).
+
+    Unlike a set of :class:`ArbitraryOrderableWeakRef` objects in an
+    ``OOTreeSet``, the keys are compared and pickled natively, and
+    the set operations (:meth:`union`, :meth:`intersection`,
+    :meth:`difference`) use the C implementations from
+    :mod:`BTrees`; only the few entries whose OIDs must be compared
+    are looked at in Python. Like :class:`WeakRefSet`, each intid
+    appears once, and references are created (as :attr:`ref_class`)
+    when they are iterated. OIDs are compared as
+    :meth:`_AbstractWeakRef.__eq__` does.
+
+    The tree is a separate persistent object, so large sets are loaded
+    a bucket at a time.
+    """
+
+    #: The class of the weak references handed out.
+    ref_class = WeakRef
+
+    family = BTrees.family64
+
+    def __init__(self, refs=()):
+        Persistent.__init__(self)
+        self._refs = self.family.II.BTree()
+        self.update(refs)
+
+    @classmethod
+    def _coerce(cls, other):
+        return other if isinstance(other, WeakRefTreeSet) else cls(other)
+
+    def _new(self, tree):
+        result = self.__class__()
+        result._refs = tree # pylint:disable=protected-access
+        return result
+
+    def add(self, ob):
+        intid, oid = _ref_state(ob)
+        self._refs[intid] = _oid_to_int(oid)
+
+    def update(self, obs):
+        for ob in obs:
+            self.add(ob)
+
+    def _find(self, ob):
+        try:
+            intid, oid = _ref_state(ob)
+        except KeyError:
+            # Not registered, so not here.
+            return None
+        stored = self._refs.get(intid)
+        if stored is None or not _oids_match(stored, _oid_to_int(oid)):
+            return None
+        return intid
+
+    def __contains__(self, ob):
+        return self._find(ob) is not None
+
+    def discard(self, ob):
+        intid = self._find(ob)
+        if intid is not None:
+            del self._refs[intid]
+
+    def remove(self, ob):
+        intid = self._find(ob)
+        if intid is None:
+            raise KeyError(ob)
+        del self._refs[intid]
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        ref_class = self.ref_class
+        for intid, oid in self._refs.iteritems():
+            ref = ref_class.__new__(ref_class)
+            ref.__setstate__((intid, _int_to_oid(oid)))
+            yield ref
+
+    def intids(self):
+        """
+        Return the ids, in ascending order, as a ``LLTreeSet``
+        suitable for the functions in :mod:`BTrees`.
+        """
+        return self.family.II.TreeSet(self._refs.keys())
+
+    def resolve(self, intids=None):
+        """
+        Return a list of the referenced objects, in ascending order of
+        intid, with ``None`` for those that have gone away. See
+        :func:`resolve_many`.
+        """
+        return resolve_many(self, intids)
+
+    def union(self, other):
+        """
+        Return a new set of the references in this set or *other*
+        (any iterable of references or objects). Where both have an
+        intid, our OID is kept.
+        """
+        other = self._coerce(other)
+        tree = self.family.II.BTree(other._refs) # pylint:disable=protected-access
+        tree.update(self._refs)
+        return self._new(tree)
+
+    def intersection(self, other):
+        """
+        Return a new set of the references in both this set and
+        *other*.
+        """
+        # pylint:disable=protected-access
+        other = self._coerce(other)
+        mine, theirs = self._refs, other._refs
+        tree = self.family.II.BTree()
+        for intid in self.family.II.intersection(mine, theirs):
+            oid, other_oid = mine[intid], theirs[intid]
+            if _oids_match(oid, other_oid):
+                tree[intid] = oid if oid != _NO_OID_INT else other_oid
+        return self._new(tree)
+
+    def difference(self, other):
+        """
+        Return a new set of the references in this set but not in
+        *other*.
+        """
+        # pylint:disable=protected-access
+        other = self._coerce(other)
+        mine, theirs = self._refs, other._refs
+        II = self.family.II
+        tree = II.BTree(II.difference(mine, theirs))
+        for intid in II.intersection(mine, theirs):
+            # The same intid, but a different object.
+            if not _oids_match(mine[intid], theirs[intid]):
+                tree[intid] = mine[intid]
+        return self._new(tree)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __repr__(self):
+        return "<%s.%s len=%d>" % (self.__class__.__module__,
+                                   self.__class__.__name__,
+                                   len(self))